@@ -9,11 +9,31 @@ docker registries
 """
 
 import argparse
+import base64
+import contextlib
+import copy
+import fcntl
+import fnmatch
+import glob
+import hashlib
+import http.client
+import io
 import json
 import os
+import re
 import shlex
+import shutil
+import signal
 import subprocess
+import tempfile
 import sys
+import tarfile
+import threading
+import time
+import urllib.parse
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 import yaml
 
@@ -40,6 +60,93 @@ RETAIN_KEY = "retain"
 VALUES_KEY = "values"
 SET_KEY = "set"
 SET_STRING_KEY = "set_string"
+VALUES_MATRIX_KEY = "values_matrix"
+IMAGE_RULES_KEY = "image_rules"
+VERSION_PATTERN_KEY = "version_pattern"
+PATH_KEY = "path"
+KINDS_KEY = "kinds"
+REGEX_KEY = "regex"
+FIELDS_KEY = "fields"
+DEFAULT_IMAGE_FIELDS = {
+    "registry": "registry",
+    "repository": "repository",
+    "tag": "tag",
+    "digest": "digest",
+}
+# Fully qualified image references with a tag or digest, used to find
+# images in environment variables without matching arbitrary strings
+QUALIFIED_IMAGE_REGEX = (
+    r"^(?P<image>[a-z0-9][a-z0-9.-]*\.[a-z0-9.-]+(?::[0-9]+)?/[a-z0-9._/-]+"
+    r"(?::[A-Za-z0-9_][A-Za-z0-9_.-]*)?(?:@sha256:[a-f0-9]{64})?)$"
+)
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+SKIP_EXISTING_KEY = "skip_existing"
+WORKERS_KEY = "workers"
+TYPE_KEY = "type"
+HELM_REPO_TYPE = "helm"
+OCI_REPO_TYPE = "oci"
+OCI_SCHEME = "oci://"
+OCI_MANIFEST_MEDIA_TYPE = "application/vnd.oci.image.manifest.v1+json"
+HELM_CONFIG_MEDIA_TYPE = "application/vnd.cncf.helm.config.v1+json"
+HELM_CHART_MEDIA_TYPE = "application/vnd.cncf.helm.chart.content.v1.tar+gz"
+HELM_PROV_MEDIA_TYPE = "application/vnd.cncf.helm.chart.provenance.v1.prov"
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+SCRIPT_TIMEOUT_KEY = "script_timeout"
+SCRIPT_CACHE_KEY = "script_cache"
+DEFAULT_WORKERS = 4
+TIMEOUTS_KEY = "timeouts"
+DEFAULT_TIMEOUT_KEY = "default"
+STALL_TIMEOUT_KEY = "stall_timeout"
+HEDGE_PERCENTILE_KEY = "hedge_percentile"
+# operations reporting progress on their output as they transfer layers
+STALL_OPERATIONS = ("docker_pull", "docker_push")
+# seconds without any bytes received or sent after which registry
+# and chart repository requests fail unless stall_timeout is set
+HTTP_TIMEOUT = 60
+# seconds a killed command is given to exit before it is killed forcibly
+KILL_GRACE_PERIOD = 5
+# longest delay before a chart version that failed in watch mode is retried
+MAX_RETRY_BACKOFF = 3600
+HEDGE_MIN_SAMPLES = 5
+BLOB_CACHE_KEY = "blob_cache"
+MAX_SIZE_KEY = "max_size"
+SIZE_UNITS = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+IMAGES_KEY = "images"
+INCLUDE_KEY = "include"
+# sections of included configuration files appended to those of the includer
+INCLUDED_LIST_KEYS = (
+    CHARTS_KEY, REGISTRIES_KEY, IMAGES_KEY, INIT_SCRIPTS_KEY, IMAGE_RULES_KEY,
+)
+REPOSITORY_KEY = "repository"
+TAGS_KEY = "tags"
+TAG_CACHE_KEY = "tag_cache"
+MAX_AGE_KEY = "max_age"
+DEFAULT_TAG_CACHE_MAX_AGE = 300
+TAGS_PAGE_SIZE = 1000
+DOCKER_HUB_HOST = "docker.io"
+DOCKER_HUB_API_HOST = "registry-1.docker.io"
+DOCKER_HUB_ALIASES = (
+    "docker.io", "index.docker.io", "registry-1.docker.io", "hub.docker.com"
+)
+# docker architecture names of the machine types reported by uname
+PLATFORM_ARCHITECTURES = {"x86_64": "amd64", "aarch64": "arm64", "armv7l": "arm"}
+DOCKER_CONFIG_PATH = os.path.join(
+    os.environ.get("DOCKER_CONFIG", os.path.expanduser("~/.docker")), "config.json"
+)
+MANIFEST_LIST_MEDIA_TYPES = (
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+    "application/vnd.oci.image.index.v1+json",
+)
+MANIFEST_MEDIA_TYPES = MANIFEST_LIST_MEDIA_TYPES + (
+    "application/vnd.docker.distribution.manifest.v2+json",
+    "application/vnd.oci.image.manifest.v1+json",
+)
+OCI_INDEX_MEDIA_TYPE = "application/vnd.oci.image.index.v1+json"
+OCI_REF_NAME_ANNOTATION = "org.opencontainers.image.ref.name"
+BUNDLE_KIND_ANNOTATION = "io.helm-image-mirror.kind"
+BUNDLE_REPO_ANNOTATION = "io.helm-image-mirror.repo"
+BUNDLE_CHART_ANNOTATION = "io.helm-image-mirror.chart"
+BUNDLE_VERSION_ANNOTATION = "io.helm-image-mirror.version"
 DEBUG_HELP_MSG = "Use --debug option to see more information"
 
 
@@ -55,31 +162,162 @@ class Errors:
         return "invalid value {} for key {}".format(value, key)
 
 
+class UploadError(Exception):
+    """Raised when a chart or blob could not be uploaded to a repository"""
+
+
+class CommandTimeout(subprocess.CalledProcessError):
+    """Raised when a command is killed because it has timed out,
+    stalled or was cancelled"""
+
+    def __init__(self, returncode, cmd, output=None, stderr=None, reason=""):
+        stderr = (stderr or b"") + "\n{}".format(reason).encode()
+        super().__init__(returncode, cmd, output, stderr)
+        self.reason = reason
+
+    def __str__(self):
+        return "Command '{}' {}".format(self.cmd, self.reason)
+
+
+class EventLog:
+    """Records completed operations. Each operation is aggregated into
+    per operation counters and, if a stream is set, written to it as
+    one JSON line as soon as it completes"""
+
+    # operations whose bytes count towards the transfer throughput
+    TRANSFER_OPS = ("image_pull", "image_push", "chart_pull", "chart_push")
+
+    def __init__(self, stream=None):
+        self.stream = stream
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.ops = {}
+
+    def emit(self, op, target, status="ok", duration=0.0, bytes=0, **fields):
+        """Records a completed operation
+
+        :param op: operation type e.g. image_pull
+        :type op: str
+        :param target: object of the operation e.g. image name
+        :type target: str
+        :param status: outcome of the operation, defaults to "ok"
+        :type status: str, optional
+        :param duration: duration in seconds, defaults to 0.0
+        :type duration: float, optional
+        :param bytes: bytes transferred, defaults to 0
+        :type bytes: int, optional
+        """
+        event = {
+            "ts": round(time.time(), 3),
+            "event": op,
+            "target": target,
+            "status": status,
+            "duration": round(duration, 3),
+            "bytes": bytes,
+            **fields,
+        }
+        with self.lock:
+            stats = self.ops.setdefault(op, {"duration": 0.0, "bytes": 0})
+            stats[status] = stats.get(status, 0) + 1
+            stats["duration"] = round(stats["duration"] + duration, 3)
+            stats["bytes"] += bytes
+            if self.stream:
+                self.stream.write(json.dumps(event, default=sorted) + "\n")
+                self.stream.flush()
+
+    @contextlib.contextmanager
+    def timed(self, op, target, **fields):
+        """Context manager emitting an event for the enclosed operation.
+        It yields a dictionary the operation can set status, bytes and
+        other fields in. Exceptions mark the operation as failed"""
+        event = dict(fields)
+        start = time.monotonic()
+        try:
+            yield event
+        except Exception as e:
+            # only the type is recorded as messages may contain credentials
+            event.setdefault("status", "failed")
+            event.setdefault("error", type(e).__name__)
+            raise
+        finally:
+            self.emit(op, target, duration=time.monotonic() - start, **event)
+
+    def summary(self):
+        """Returns the summary aggregated from all emitted events
+
+        :rtype: Dict
+        """
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        with self.lock:
+            ops = {op: dict(stats) for op, stats in self.ops.items()}
+        images = ops.get("image_push", {}).get("ok", 0)
+        transferred = sum(
+            ops.get(op, {}).get("bytes", 0) for op in self.TRANSFER_OPS
+        )
+        return {
+            "operations": ops,
+            "elapsed": round(elapsed, 3),
+            "images_per_min": round(images * 60 / elapsed, 2),
+            "mb_per_s": round(transferred / elapsed / 1e6, 3),
+        }
+
+    def finish(self):
+        """Emits the summary and prints the throughput line"""
+        summary = self.summary()
+        if self.stream:
+            with self.lock:
+                self.stream.write(json.dumps({"event": "summary", **summary}) + "\n")
+                self.stream.flush()
+        print("Throughput: {} images/min, {} MB/s in {}s".format(
+            summary["images_per_min"], summary["mb_per_s"], summary["elapsed"]))
+        return summary
+
+
+EVENTS = EventLog()
+
+
 class Chart:
-    """Helm chart configuration"""
+    """Helm chart configuration. Configurations may list thousands
+    of chart versions, so instances have no __dict__ and versions
+    of a chart share its values, push targets and scripts"""
+
+    __slots__ = (
+        "repo_name", "chart_name", "version", "local_dir", "fetch_policy",
+        "values", "push_targets", "scripts", "values_matrix", "source_repo",
+    )
 
     def __init__(
-        self, repo_name, chart_name, version, 
-        local_dir, fetch_policy, values={}, push=[],
-        scripts=[]
+        self, repo_name, chart_name, version,
+        local_dir, fetch_policy, values=None, push=None,
+        scripts=None, values_matrix=None
     ):
         self.repo_name = repo_name
         self.chart_name = chart_name
         self.version = version
         self.local_dir = local_dir
         self.fetch_policy = fetch_policy
-        self.values = values
-        self.combined_name = "{}/{}-{}".format(
-            self.repo_name, self.chart_name, self.version
-        )
-        self.push_targets = push
-        self.scripts = scripts
+        self.values = {} if values is None else values
+        self.push_targets = [] if push is None else push
+        self.scripts = [] if scripts is None else scripts
+        self.values_matrix = [] if values_matrix is None else values_matrix
+        # set for charts hosted in OCI registries
+        self.source_repo = None
+
+    @property
+    def combined_name(self):
+        return "{}/{}-{}".format(self.repo_name, self.chart_name, self.version)
+
+    def reference(self):
+        """Returns the reference of the chart understood by helm"""
+        if self.source_repo:
+            return "{}/{}".format(self.source_repo.remote.rstrip("/"), self.chart_name)
+        return "{}/{}".format(self.repo_name, self.chart_name)
 
     def fetch(self):
         if self.fetch_policy:
             helm(
-                "fetch --untar --untardir {}  --version {} {}/{}".format(
-                    self.local_dir, self.version, self.repo_name, self.chart_name
+                "fetch --untar --untardir {}  --version {} {}".format(
+                    self.local_dir, self.version, self.reference()
                 )
             )
         else:
@@ -93,22 +331,56 @@ class Chart:
     def pull(self):
         print("Pulling chart {}".format(self.combined_name))
         os.makedirs(self.local_dir, exist_ok=True)
-        helm("pull {}/{} --version {} --destination {} --devel".format(
-            self.repo_name, self.chart_name, self.version, self.local_dir
+        helm("pull {} --version {} --destination {} --devel".format(
+            self.reference(), self.version, self.local_dir
         ))
         
 
+    def archive_path(self):
+        """Returns path of the chart archive saved by pull"""
+        saved_chart_name = '{}-{}.tgz'.format(self.chart_name, self.version)
+        return os.path.join(self.local_dir, saved_chart_name)
+
+    def digest(self):
+        """Returns sha256 digest of the pulled chart archive as
+        listed in helm repository indexes
+
+        :rtype: str
+        """
+        sha256 = hashlib.sha256()
+        with open(self.archive_path(), "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                sha256.update(chunk)
+        return sha256.hexdigest()
+
     def push(self, target_repo):
         print("Pushing chart {} to {} repository".format(
             self.combined_name, target_repo.name))
-        saved_chart_name = '{}-{}.tgz'.format(self.chart_name, self.version)
-        saved_chart_path = os.path.join(self.local_dir, saved_chart_name)
-        helm("push {} {}".format(saved_chart_path, target_repo.name))
+        uploader = UPLOADERS.get(target_repo.repo_type)
+        if target_repo.is_oci():
+            push_oci_chart(self, target_repo)
+        elif uploader:
+            uploader.upload(target_repo, self.archive_path())
+        else:
+            helm("push {} {}".format(self.archive_path(), target_repo.name))
 
 
-    def get_flags(self):
-        set_flag = self.values.get(SET_KEY)
-        set_string_flag = self.values.get(SET_STRING_KEY)
+    def metadata(self):
+        """Returns contents of Chart.yaml in the pulled chart archive
+
+        :rtype: Dict
+        """
+        with tarfile.open(self.archive_path(), "r:gz") as tar:
+            for member in tar.getmembers():
+                if member.name.split("/")[1:] == ["Chart.yaml"]:
+                    return yaml.safe_load(tar.extractfile(member))
+        raise UploadError("Chart.yaml not found in " + self.archive_path())
+
+    def get_flags(self, values=None):
+        if values is None:
+            values = self.values
+        set_flag = values.get(SET_KEY)
+        set_string_flag = values.get(SET_STRING_KEY)
         flags = ""
         if set_flag:
             flags = "{} --set {}".format(flags, set_flag)
@@ -116,31 +388,60 @@ class Chart:
             flags = "{} --set-string {}".format(flags, set_string_flag)
         return flags
 
-    def get_template_cmd(self):
-        flags = self.get_flags()
+    def get_template_cmd(self, values=None):
+        flags = self.get_flags(values)
         return "template {} {}/{}".format(flags, self.local_dir, self.chart_name)
 
-    def template(self):
-        cmd = self.get_template_cmd()
+    def template(self, values=None):
+        cmd = self.get_template_cmd(values)
         return helm(cmd)
 
-    def images(self):
+    def value_sets(self):
+        """Returns the value sets the chart is rendered with. Each
+        values_matrix entry is applied on top of the chart values
+
+        :rtype: [Dict]
+        """
+        value_sets = [self.values]
+        for variant in self.values_matrix:
+            merged = {}
+            for key in (SET_KEY, SET_STRING_KEY):
+                flags = [v for v in (self.values.get(key), variant.get(key)) if v]
+                if flags:
+                    merged[key] = ",".join(flags)
+            value_sets.append(merged)
+        return value_sets
+
+    def render_images(self, values):
+        with EVENTS.timed("chart_template", self.combined_name) as event:
+            rendered = self.template(values)
+            event["bytes"] = len(rendered)
+        return parse_images(rendered)
+
+    def images(self, workers=DEFAULT_WORKERS):
         print("Finding images in chart", self.combined_name)
-        images = parse_images(self.template())
+        value_sets = self.value_sets()
+        images = set()
+        # all value sets are rendered from the same extracted chart
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for found in executor.map(self.render_images, value_sets):
+                images.update(found)
         if not images:
             print("No images found")
         else:
             print("Found images:", images)
         return images
     
-    def run_scripts(self):
+    def run_scripts(self, timeout=None, cache=None):
         print("Running scripts for chart", self.combined_name)
         return run_scripts(
-            self.scripts, [self.repo_name, self.chart_name, self.version])
+            self.scripts, [self.repo_name, self.chart_name, self.version],
+            timeout=timeout, cache=cache)
 
     def __eq__(self, other):
-        return isinstance(other, self.__class__) and \
-            self.__dict__ == other.__dict__
+        return isinstance(other, self.__class__) and all(
+            getattr(self, slot) == getattr(other, slot) for slot in self.__slots__
+        )
 
     def __ne__(self, other):
         return not self.__eq__(other)
@@ -154,7 +455,35 @@ class Registry:
         self.push = push
         self.retain = retain
 
-    def tag_and_push(self, images):
+    def target_name(self, image):
+        """Returns the name given image is re-tagged to
+        for this registry
+
+        :param image: source image reference
+        :type image: str
+        :return: target image reference
+        :rtype: str
+        """
+        image_name = image.split("/")[-1]
+        if self.name == "hub.docker.com":
+            # Default dockerhub domain doesn't need prefix
+            return image_name
+        return "{}/{}".format(self.name, image_name)
+
+    def tag_and_push(self, images, waves=None, workers=1):
+        """Re-tags given images and pushes them to the registry
+
+        :param images: images to be pushed
+        :type images: [str]
+        :param waves: groups of images pushed one after another,
+            images within a group are pushed concurrently. Defaults
+            to None in which case all images are pushed concurrently
+        :type waves: [[str]], optional
+        :param workers: number of concurrent pushes, defaults to 1
+        :type workers: int, optional
+        :return: succeeded pushes and tag, push and cleanup failures
+        :rtype: (set, set, set, set)
+        """
         if not self.push:
             print(
                 "Not pushing images to registry",
@@ -166,30 +495,48 @@ class Registry:
         push_failures = set()
         cleanup_failures = set()
         succeeded = set()
-        for image in images:
-            image_name = image.split("/")[-1]
-            if self.name == "hub.docker.com":
-                # Default dockerhub domain doesn't need prefix
-                target_name = image_name
-            else:
-                target_name = "{}/{}".format(self.name, image_name)
-            try:
-                docker("tag {} {}".format(image, target_name))
-            except subprocess.CalledProcessError:
-                tag_failures.add((image, target_name))
-                continue
-            try:
+        if waves is None:
+            waves = [list(images)]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for wave in waves:
+                for image, target_name, failure in executor.map(self.push_image, wave):
+                    if failure == "tag":
+                        tag_failures.add((image, target_name))
+                        continue
+                    if failure == "push":
+                        push_failures.add(target_name)
+                    else:
+                        succeeded.add(target_name)
+                    if failure == "cleanup":
+                        cleanup_failures.add(target_name)
+        return succeeded, tag_failures, push_failures, cleanup_failures
+
+    def push_image(self, image):
+        """Re-tags and pushes given image
+
+        :return: (image, target name, failed step or None)
+        :rtype: (str, str, str)
+        """
+        target_name = self.target_name(image)
+        try:
+            docker("tag {} {}".format(image, target_name))
+        except subprocess.CalledProcessError:
+            return image, target_name, "tag"
+        try:
+            with EVENTS.timed("image_push", target_name) as event:
                 docker("push {}".format(target_name))
-            except subprocess.CalledProcessError:
-                push_failures.add(target_name)
-            else:
-                succeeded.add(target_name)
-            if not self.retain:
-                try:
+                event["bytes"] = image_size(target_name)
+        except subprocess.CalledProcessError:
+            failure = "push"
+        else:
+            failure = None
+        if not self.retain:
+            try:
+                with EVENTS.timed("image_rmi", target_name):
                     docker("rmi {}".format(target_name))
-                except subprocess.CalledProcessError:
-                    cleanup_failures.add(target_name)
-        return succeeded, tag_failures, push_failures, cleanup_failures
+            except subprocess.CalledProcessError:
+                failure = failure or "cleanup"
+        return image, target_name, failure
 
     def __eq__(self, other):
         return isinstance(other, self.__class__) and self.__dict__ == other.__dict__
@@ -201,11 +548,12 @@ class Registry:
 class Repo:
     """Helm repository configuration"""
 
-    def __init__(self, name, remote, username, password):
+    def __init__(self, name, remote, username, password, repo_type=HELM_REPO_TYPE):
         self.name = name
         self.remote = remote
         self.username = username
         self.password = password
+        self.repo_type = repo_type
 
     def get_add_cmd(self, mask_pw=False):
         add_cmd = "repo add {name} {remote}".format(name=self.name, remote=self.remote)
@@ -220,51 +568,736 @@ class Repo:
             return add_cmd_with_credentials
         return add_cmd
 
+    def is_oci(self):
+        return self.repo_type == OCI_REPO_TYPE
+
+    def oci_reference(self, chart_name):
+        """Returns (host, repository) of given chart in the OCI registry
+
+        :rtype: (str, str)
+        """
+        host, _, path = self.remote[len(OCI_SCHEME):].rstrip("/").partition("/")
+        return host, "/".join(filter(None, [path, chart_name]))
+
+    def registry_client(self):
+        host = self.remote[len(OCI_SCHEME):].split("/")[0]
+        return get_registry_client(host, self.username, self.password)
+
+    def index_url(self):
+        return "{}/index.yaml".format(self.remote.rstrip("/"))
+
+    def auth_headers(self):
+        if not (self.username and self.password):
+            return {}
+        return {"Authorization": basic_auth(self.username, self.password)}
+
+    def fetch_index(self, validators={}):
+        """Downloads and parses the index of the repository. If validators
+        of a previous response are given, the index is only downloaded
+        if it has been modified since
+
+        :param validators: ETag and Last-Modified headers of the
+            previous response, defaults to {}
+        :type validators: Dict, optional
+        :return: repository index or None if it has not been modified,
+            and the validators of the response
+        :rtype: (Dict, Dict)
+
+        :raises: OSError
+        """
+        headers = self.auth_headers()
+        if validators.get("ETag"):
+            headers["If-None-Match"] = validators["ETag"]
+        if validators.get("Last-Modified"):
+            headers["If-Modified-Since"] = validators["Last-Modified"]
+        status, resp_headers, body = HTTP_SESSION.request(
+            "GET", self.index_url(), headers
+        )
+        if status == 304 and validators:
+            return None, validators
+        if status != 200:
+            raise OSError("GET {} returned {}".format(self.index_url(), status))
+        validators = {
+            key: resp_headers[key] for key in ("ETag", "Last-Modified")
+            if resp_headers.get(key)
+        }
+        return yaml.load(body, Loader=YAML_LOADER) or {}, validators
+
     def add(self):
         cmd = self.get_add_cmd(mask_pw=False)
         masked_cmd = self.get_add_cmd(mask_pw=True)
         debug("helm " + masked_cmd)
         helm(cmd, print_cmd=False)
 
+    def login(self):
+        """Logs helm in to the OCI registry so that charts can be
+        fetched and pulled from it. The password is passed on stdin"""
+        host = self.remote[len(OCI_SCHEME):].split("/")[0]
+        helm(
+            "registry login {} --username {} --password-stdin".format(
+                host, shlex.quote(self.username)
+            ),
+            input=self.password.encode(),
+        )
+
     def __eq__(self, other):
         return isinstance(other, self.__class__) and self.__dict__ == other.__dict__
 
     def __ne__(self, other):
         return not self.__eq__(other)
 
-        
+
+class HTTPSession:
+    """Thread safe pool of keep-alive HTTP connections shared
+    by all requests sent to the same host. Requests fail once no
+    bytes have been received or sent for timeout seconds, however
+    long the transfer takes as a whole"""
+
+    def __init__(self, timeout=HTTP_TIMEOUT, max_idle=DEFAULT_WORKERS * 2):
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def connection(self, scheme, netloc):
+        with self.lock:
+            pool = self.idle.get((scheme, netloc))
+            if pool:
+                return pool.pop()
+        if scheme == "https":
+            return http.client.HTTPSConnection(netloc, timeout=self.timeout)
+        return http.client.HTTPConnection(netloc, timeout=self.timeout)
+
+    def release(self, scheme, netloc, conn):
+        with self.lock:
+            pool = self.idle.setdefault((scheme, netloc), [])
+            if len(pool) < self.max_idle:
+                pool.append(conn)
+                return
+        conn.close()
+
+    def send(self, method, url, headers, body, sink=None):
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path or "/"
+        if parts.query:
+            path = "{}?{}".format(path, parts.query)
+        # a pooled connection may have been closed by the server, such
+        # requests are retried once on a new connection unless repeating
+        # them could fail e.g. a chart upload that reached the server
+        retry = (body is None or isinstance(body, bytes)) and idempotent(method, parts)
+        while True:
+            conn = self.connection(parts.scheme, parts.netloc)
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                response = conn.getresponse()
+                if sink is not None and response.status == 200:
+                    shutil.copyfileobj(response, sink, 1 << 20)
+                    data = b""
+                else:
+                    data = response.read()
+            except (http.client.HTTPException, ConnectionError) as e:
+                conn.close()
+                if retry:
+                    if sink is not None:
+                        sink.seek(0)
+                        sink.truncate()
+                    retry = False
+                    continue
+                raise ConnectionError("{} {}: {}".format(method, url, e))
+            except OSError:
+                conn.close()
+                raise
+            if response.will_close:
+                conn.close()
+            else:
+                self.release(parts.scheme, parts.netloc, conn)
+            return response.status, response.headers, data
+
+    def request(self, method, url, headers=None, body=None, sink=None):
+        """Sends a request following redirects
+
+        :param method: HTTP method
+        :type method: str
+        :param url: request URL
+        :type url: str
+        :param headers: request headers, defaults to None
+        :type headers: Dict, optional
+        :param body: request body, defaults to None
+        :type body: bytes or file, optional
+        :param sink: file a successful response body is streamed
+            to instead of being returned, defaults to None
+        :type sink: file, optional
+        :return: response status, headers and body
+        :rtype: (int, http.client.HTTPMessage, bytes)
+
+        :raises: OSError
+        """
+        headers = dict(headers or {})
+        for _ in range(5):
+            status, resp_headers, data = self.send(method, url, headers, body, sink)
+            if status not in REDIRECT_STATUSES or not resp_headers.get("Location"):
+                break
+            location = urllib.parse.urljoin(url, resp_headers["Location"])
+            if urllib.parse.urlsplit(location).netloc != urllib.parse.urlsplit(url).netloc:
+                # credentials are not sent to other hosts e.g. blob storage
+                headers.pop("Authorization", None)
+            url = location
+        return status, resp_headers, data
+
+
+HTTP_SESSION = HTTPSession()
+
+
+def idempotent(method, parts):
+    """Returns True if a request may be sent again without changing
+    its outcome. PUTs are only repeated for content addressed
+    registry uploads of blobs and manifests
+
+    :param method: HTTP method
+    :type method: str
+    :param parts: request URL
+    :type parts: urllib.parse.SplitResult
+    :rtype: bool
+    """
+    if method in ("GET", "HEAD"):
+        return True
+    return method == "PUT" and (
+        "/manifests/" in parts.path
+        or "digest" in urllib.parse.parse_qs(parts.query)
+    )
+
+
+class ChartUploader:
+    """Uploads chart archives to helm repositories over HTTP
+    without the helm-push plugin"""
+
+    def upload_request(self, repo, path, data):
+        """Returns the request that uploads given chart archive
+
+        :return: (method, url, headers, body)
+        :rtype: (str, str, Dict, bytes)
+        """
+        raise NotImplementedError
+
+    def upload(self, repo, path):
+        """Uploads given chart archive to given repository
+
+        :param repo: target repository
+        :type repo: Repo
+        :param path: path of the chart archive
+        :type path: str
+
+        :raises: UploadError
+        """
+        with open(path, "rb") as f:
+            data = f.read()
+        method, url, headers, body = self.upload_request(repo, path, data)
+        headers.update(repo.auth_headers())
+        try:
+            status, _, resp = HTTP_SESSION.request(method, url, headers, body)
+        except OSError as e:
+            raise UploadError(str(e))
+        if status not in (200, 201, 202, 204):
+            raise UploadError("{} {} returned {}: {}".format(
+                method, url, status, resp.decode(errors="replace").strip()))
+
+
+class ChartMuseumUploader(ChartUploader):
+    """ChartMuseum API. Repositories served under a path are
+    uploaded to the api prefixed path e.g. /api/org/repo/charts"""
+
+    def upload_request(self, repo, path, data):
+        parts = urllib.parse.urlsplit(repo.remote.rstrip("/"))
+        url = "{}://{}/api{}/charts".format(parts.scheme, parts.netloc, parts.path)
+        headers = {"Content-Type": "application/octet-stream"}
+        return "POST", url, headers, data
+
+
+class HarborUploader(ChartUploader):
+    """Harbor chart repository API. Repository remote is expected
+    to be of the form https://harbor/chartrepo/<project>"""
+
+    def upload_request(self, repo, path, data):
+        parts = urllib.parse.urlsplit(repo.remote.rstrip("/"))
+        url = "{}://{}/api{}/charts".format(parts.scheme, parts.netloc, parts.path)
+        boundary = uuid.uuid4().hex
+        body = b"".join([
+            "--{}\r\n".format(boundary).encode(),
+            'Content-Disposition: form-data; name="chart"; filename="{}"\r\n'.format(
+                os.path.basename(path)).encode(),
+            b"Content-Type: application/octet-stream\r\n\r\n",
+            data,
+            "\r\n--{}--\r\n".format(boundary).encode(),
+        ])
+        headers = {"Content-Type": "multipart/form-data; boundary=" + boundary}
+        return "POST", url, headers, body
+
+
+class NexusUploader(ChartUploader):
+    """Nexus helm hosted repository. Charts are uploaded
+    with a PUT of the archive to the repository URL"""
+
+    def upload_request(self, repo, path, data):
+        url = "{}/{}".format(repo.remote.rstrip("/"), os.path.basename(path))
+        headers = {"Content-Type": "application/octet-stream"}
+        return "PUT", url, headers, data
+
+
+UPLOADERS = {
+    "chartmuseum": ChartMuseumUploader(),
+    "harbor": HarborUploader(),
+    "nexus": NexusUploader(),
+}
+
+
+class RegistryClient:
+    """Minimal docker registry HTTP API v2 client"""
+
+    def __init__(self, host, username=None, password=None):
+        self.host = host
+        self.username = username
+        self.password = password
+        self.scheme = registry_scheme(host)
+        self.token = None
+
+    def url(self, path):
+        """Returns URL of given path relative to /v2/. Absolute paths
+        and URLs such as upload locations are used as is"""
+        if "://" in path:
+            return path
+        if path.startswith("/"):
+            return "{}://{}{}".format(self.scheme, self.host, path)
+        return "{}://{}/v2/{}".format(self.scheme, self.host, path)
+
+    def basic_auth(self):
+        if not (self.username and self.password):
+            return None
+        return basic_auth(self.username, self.password)
+
+    def authenticate(self, challenge):
+        """Obtains authorization for given WWW-Authenticate challenge
+
+        :param challenge: value of WWW-Authenticate response header
+        :type challenge: str
+        :return: True if the request should be retried
+        :rtype: bool
+        """
+        scheme, _, params = (challenge or "").partition(" ")
+        if scheme.lower() == "basic":
+            if self.token or not self.basic_auth():
+                return False
+            self.token = self.basic_auth()
+            return True
+        if scheme.lower() != "bearer":
+            return False
+        params = dict(re.findall(r'(\w+)="([^"]*)"', params))
+        realm = params.pop("realm", None)
+        if not realm:
+            return False
+        url = "{}?{}".format(realm, urllib.parse.urlencode(params))
+        headers = {}
+        if self.basic_auth():
+            headers["Authorization"] = self.basic_auth()
+        status, _, body = HTTP_SESSION.request("GET", url, headers)
+        if status != 200:
+            return False
+        body = json.loads(body)
+        token = body.get("token") or body.get("access_token")
+        if not token or self.token == "Bearer " + token:
+            return False
+        self.token = "Bearer " + token
+        return True
+
+    def request(self, method, path, headers=None, data=None, sink=None):
+        """Sends a request to the registry, authenticating
+        if the registry asks for it
+
+        :param method: HTTP method
+        :type method: str
+        :param path: path relative to /v2/
+        :type path: str
+        :return: response status, headers and body
+        :rtype: (int, http.client.HTTPMessage, bytes)
+
+        :raises: OSError
+        """
+        retry = True
+        while True:
+            request_headers = dict(headers or {})
+            if self.token:
+                request_headers["Authorization"] = self.token
+            status, resp_headers, body = HTTP_SESSION.request(
+                method, self.url(path), request_headers, data, sink
+            )
+            if retry and status == 401 and self.authenticate(
+                resp_headers.get("WWW-Authenticate")
+            ):
+                retry = False
+                continue
+            return status, resp_headers, body
+
+    def manifest_digests(self, repository, reference):
+        """Returns the digests the given manifest is known by. For
+        multi-arch images, digests of the per platform manifests
+        are included as well since docker pushes only one of them
+
+        :param repository: repository name
+        :type repository: str
+        :param reference: tag or digest
+        :type reference: str
+        :return: set of digests, empty if the manifest does not exist
+        :rtype: set(str)
+        """
+        headers = {"Accept": ", ".join(MANIFEST_MEDIA_TYPES)}
+        path = "{}/manifests/{}".format(repository, reference)
+        status, resp_headers, _ = self.request("HEAD", path, headers)
+        if status != 200:
+            return set()
+        digests = set()
+        if resp_headers.get("Docker-Content-Digest"):
+            digests.add(resp_headers["Docker-Content-Digest"])
+        content_type = resp_headers.get("Content-Type", "").split(";")[0]
+        if content_type in MANIFEST_LIST_MEDIA_TYPES:
+            status, _, body = self.request("GET", path, headers)
+            if status == 200:
+                for manifest in json.loads(body).get("manifests", []):
+                    digests.add(manifest["digest"])
+        return digests
+
+    def manifest_digest(self, repository, reference):
+        """Returns the digest of given manifest
+
+        :return: digest or None if the manifest does not exist
+        :rtype: str
+        """
+        headers = {"Accept": ", ".join(MANIFEST_MEDIA_TYPES)}
+        path = "{}/manifests/{}".format(repository, reference)
+        status, resp_headers, _ = self.request("HEAD", path, headers)
+        if status != 200:
+            return None
+        return resp_headers.get("Docker-Content-Digest")
+
+    def get_manifest(self, repository, reference):
+        """Downloads given manifest
+
+        :return: (media type, body, digest) or None if the
+            manifest does not exist
+        :rtype: (str, bytes, str)
+        """
+        headers = {"Accept": ", ".join(MANIFEST_MEDIA_TYPES)}
+        path = "{}/manifests/{}".format(repository, reference)
+        status, resp_headers, body = self.request("GET", path, headers)
+        if status != 200:
+            return None
+        media_type = resp_headers.get("Content-Type", "").split(";")[0]
+        digest = resp_headers.get("Docker-Content-Digest") or sha256_digest(body)
+        return media_type or json.loads(body).get("mediaType"), body, digest
+
+    def put_manifest(self, repository, reference, media_type, body):
+        """Uploads given manifest
+
+        :raises: UploadError
+        """
+        path = "{}/manifests/{}".format(repository, reference)
+        status, _, resp = self.request(
+            "PUT", path, {"Content-Type": media_type}, body
+        )
+        if status not in (200, 201):
+            raise UploadError("PUT {} returned {}: {}".format(
+                self.url(path), status, resp.decode(errors="replace").strip()))
+
+    def list_tags(self, repository, etag=None, page_size=TAGS_PAGE_SIZE):
+        """Lists tags of given repository following the pagination
+        links returned by the registry
+
+        :param repository: repository name
+        :type repository: str
+        :param etag: ETag of the tag list returned by an earlier
+            call, defaults to None
+        :type etag: str, optional
+        :return: tags or None if the list has not changed since etag,
+            and ETag of the list. Lists spanning several pages have no
+            ETag since a change may not show on the first page
+        :rtype: ([str], str)
+
+        :raises: OSError
+        """
+        path = "{}/tags/list?{}".format(
+            repository, urllib.parse.urlencode({"n": page_size})
+        )
+        headers = {"If-None-Match": etag} if etag else {}
+        tags = []
+        pages = 0
+        while path:
+            status, resp_headers, body = self.request("GET", path, headers)
+            if status == 304 and etag:
+                return None, etag
+            if status == 404 and not pages:
+                # repositories are created by the first push
+                return [], None
+            if status != 200:
+                raise OSError("GET {} returned {}".format(self.url(path), status))
+            tags.extend(json.loads(body).get("tags") or [])
+            pages += 1
+            link = re.search(
+                r'<([^>]+)>\s*;\s*rel="?next"?', resp_headers.get("Link", "")
+            )
+            path = link and link.group(1)
+            headers = {}
+        return tags, resp_headers.get("ETag") if pages == 1 else None
+
+    def blob_exists(self, repository, digest):
+        path = "{}/blobs/{}".format(repository, digest)
+        status, _, _ = self.request("HEAD", path)
+        return status == 200
+
+    def get_blob(self, repository, digest):
+        """Downloads given blob, from the local blob store if
+        it is configured
+
+        :raises: OSError
+        """
+        if BLOB_STORE:
+            with open(self.cached_blob(repository, digest), "rb") as f:
+                return f.read()
+        path = "{}/blobs/{}".format(repository, digest)
+        status, _, body = self.request("GET", path)
+        if status != 200:
+            raise OSError("GET {} returned {}".format(self.url(path), status))
+        return body
+
+    def download_blob(self, repository, digest, f):
+        """Streams given blob to file f without holding it in memory,
+        from the local blob store if it is configured
+
+        :raises: OSError
+        """
+        if BLOB_STORE:
+            with open(self.cached_blob(repository, digest), "rb") as src:
+                shutil.copyfileobj(src, f, 1 << 20)
+            return
+        self.stream_blob(repository, digest, f)
+
+    def stream_blob(self, repository, digest, f):
+        path = "{}/blobs/{}".format(repository, digest)
+        status, _, _ = self.request("GET", path, sink=f)
+        if status != 200:
+            raise OSError("GET {} returned {}".format(self.url(path), status))
+
+    def cached_blob(self, repository, digest):
+        """Returns path of given blob in the local blob store,
+        downloading it into the store on a miss"""
+        return BLOB_STORE.fetch(
+            digest, lambda f: self.stream_blob(repository, digest, f)
+        )
+
+    def start_upload(self, repository, mount=None, source=None):
+        """Starts a blob upload. If mount and source are given, the
+        registry is asked to mount the blob from source repository
+
+        :return: upload location or None if the blob was mounted
+        :rtype: str
+
+        :raises: UploadError
+        """
+        path = "{}/blobs/uploads/".format(repository)
+        if mount:
+            path = "{}?{}".format(
+                path, urllib.parse.urlencode({"mount": mount, "from": source})
+            )
+        status, headers, resp = self.request("POST", path, {"Content-Length": "0"})
+        if status == 201 and mount:
+            return None
+        if status != 202 or not headers.get("Location"):
+            raise UploadError("POST {} returned {}: {}".format(
+                self.url(path), status, resp.decode(errors="replace").strip()))
+        return headers["Location"]
+
+    def upload_blob(self, location, digest, data, size=None):
+        """Completes blob upload started at given location
+        with a single request
+
+        :param data: blob content or file it is streamed from
+        :type data: bytes or file
+        :param size: size of the blob if data is a file, defaults to None
+        :type size: int, optional
+
+        :raises: UploadError
+        """
+        separator = "&" if "?" in location else "?"
+        url = "{}{}{}".format(location, separator, urllib.parse.urlencode(
+            {"digest": digest}))
+        headers = {"Content-Type": "application/octet-stream"}
+        if size is not None:
+            headers["Content-Length"] = str(size)
+        status, _, resp = self.request("PUT", url, headers, data)
+        if status not in (201, 204):
+            raise UploadError("PUT {} returned {}: {}".format(
+                self.url(url), status, resp.decode(errors="replace").strip()))
+
 
 def debug(*args, **kwargs):
     if DEBUG:
         print(*args, **kwargs)
 
 
-def load_config(file):
+def load_config(file, including=()):
     """Loads given config file
-    into memory
+    into memory. Files listed under include are loaded
+    and merged into the configuration
 
     :param file: path to config file
     :type file: str
+    :param including: paths of the files including this
+        file, defaults to ()
+    :type including: tuple, optional
     :return: loaded config
     :rtype: Dict
     """
     try:
         with open(file, "r") as f:
-            config = yaml.safe_load(f)
+            config = yaml.load(f, Loader=YAML_LOADER)
     except IOError as e:
         print(e)
         return None
+    if not isinstance(config, dict) or not config.get(INCLUDE_KEY):
+        return config
+    including = including + (os.path.realpath(file),)
+    includes = config.pop(INCLUDE_KEY)
+    if isinstance(includes, str):
+        includes = [includes]
+    for pattern in includes:
+        # patterns are relative to the including file
+        pattern = os.path.join(os.path.dirname(file), os.path.expanduser(pattern))
+        paths = sorted(glob.glob(pattern))
+        if not paths and not glob.has_magic(pattern):
+            print("Included configuration file", pattern, "does not exist")
+            return None
+        for path in paths:
+            if os.path.realpath(path) in including:
+                print("Configuration file", path, "includes itself")
+                return None
+            included = load_config(path, including)
+            if included is None:
+                return None
+            merge_included(config, included)
     return config
 
 
-def execute(command, print_cmd=True, split=True):
-    """Executes given command in a subprocess
+def merge_included(config, included):
+    """Merges an included configuration into the including one. Lists
+    of charts, registries etc. and repositories are appended, other
+    settings of the including configuration take precedence
+
+    :param config: including configuration
+    :type config: Dict
+    :param included: included configuration
+    :type included: Dict
+    """
+    for key, value in (included or {}).items():
+        if key in INCLUDED_LIST_KEYS:
+            config[key] = config.get(key) or []
+            config[key].extend(value or [])
+        elif key == REPOS_KEY and value:
+            repos = config.get(REPOS_KEY) or {}
+            config[REPOS_KEY] = repos
+            for repos_key, repos_value in value.items():
+                if repos_key == REPOS_ADD_KEY:
+                    repos[REPOS_ADD_KEY] = repos.get(REPOS_ADD_KEY) or []
+                    repos[REPOS_ADD_KEY].extend(repos_value or [])
+                else:
+                    repos.setdefault(repos_key, repos_value)
+        else:
+            config.setdefault(key, value)
+
+
+# operation e.g. docker_pull -> seconds after which it is killed
+TIMEOUTS = {}
+# seconds without output after which transfers are killed
+STALL_TIMEOUT = None
+# set to kill all running commands and not start new ones
+CANCELLED = threading.Event()
+_running = set()
+_running_lock = threading.Lock()
+
+
+def get_timeouts(timeouts, parents=[]):
+    """Validates timeouts configuration
+
+    :param timeouts: dictionary mapping operation e.g. docker_pull
+        or default to seconds
+    :type timeouts: Dict
+    :param parents: list of parent keys in the configuration
+        to be used for constructing appropriate error messages
+        for configuration errors
+    :type parents: [str]
+    :return: dictionary mapping operation to seconds
+    :rtype: Dict
+    """
+    valid = {}
+    for operation, seconds in (timeouts or {}).items():
+        if isinstance(seconds, bool) or not isinstance(seconds, (int, float)) \
+                or seconds <= 0:
+            error(Errors.invalid_value(operation, seconds), parents=parents)
+            continue
+        valid[operation] = seconds
+    return valid
+
+
+def kill_process_group(proc):
+    """Terminates given process along with its children, killing
+    them if they do not exit within the grace period"""
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+        proc.wait(KILL_GRACE_PERIOD)
+    except ProcessLookupError:
+        pass
+    except subprocess.TimeoutExpired:
+        with contextlib.suppress(ProcessLookupError):
+            os.killpg(proc.pid, signal.SIGKILL)
+    proc.wait()
+
+
+def cancel_commands():
+    """Kills all running commands and prevents new ones from starting"""
+    CANCELLED.set()
+    with _running_lock:
+        running = list(_running)
+    for proc in running:
+        kill_process_group(proc)
+
+
+def execute(
+    command, print_cmd=True, split=True, operation=None, cancel=None, input=None,
+    timeout=None, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+):
+    """Executes given command in a subprocess. The command is killed
+    along with its children if it runs longer than the timeout of
+    the operation, stops producing output for longer than the stall
+    timeout, is cancelled or is interrupted
 
     :param command: command to execute
     :type command: str
     :param print_cmd: prints command being executed if True,
         defaults to True
     :type print_cmd: bool, optional
+    :param operation: operation the command performs e.g. docker_pull,
+        used to look up its timeouts, defaults to None
+    :type operation: str, optional
+    :param cancel: event cancelling the command, defaults to None
+    :type cancel: threading.Event, optional
+    :param input: data written to the standard input of the
+        command e.g. a password, defaults to None
+    :type input: bytes, optional
+    :param timeout: seconds after which the command is killed, defaults
+        to the timeout of the operation
+    :type timeout: float, optional
+    :param stdout: where the output of the command goes, it is captured
+        and returned if subprocess.PIPE, defaults to subprocess.PIPE
+    :type stdout: int, optional
+    :param stderr: where the errors of the command go, they are captured
+        if subprocess.PIPE, defaults to subprocess.PIPE
+    :type stderr: int, optional
     :return: output from command
     :rtype: str
 
@@ -274,577 +1307,3856 @@ def execute(command, print_cmd=True, split=True):
         debug(command)
     if split:
         command = shlex.split(command)
-    return subprocess.run(command, check=True, capture_output=True).stdout
+    if CANCELLED.is_set():
+        raise CommandTimeout(-signal.SIGTERM, command, reason="was cancelled")
+    if timeout is None and operation:
+        timeout = TIMEOUTS.get(operation, TIMEOUTS.get(DEFAULT_TIMEOUT_KEY))
+    stall_timeout = STALL_TIMEOUT if operation in STALL_OPERATIONS else None
+    proc = subprocess.Popen(
+        command, stdout=stdout, stderr=stderr,
+        stdin=subprocess.PIPE if input is not None else None,
+        start_new_session=True,
+    )
+    if input is not None:
+        with contextlib.suppress(BrokenPipeError):
+            proc.stdin.write(input)
+        proc.stdin.close()
+    started = progressed = time.monotonic()
+    output = {pipe: [] for pipe in (proc.stdout, proc.stderr) if pipe}
+
+    def read(pipe):
+        nonlocal progressed
+        for chunk in iter(lambda: os.read(pipe.fileno(), 1 << 16), b""):
+            output[pipe].append(chunk)
+            progressed = time.monotonic()
+        pipe.close()
+
+    readers = [threading.Thread(target=read, args=(pipe,)) for pipe in output]
+    for reader in readers:
+        reader.start()
+    with _running_lock:
+        _running.add(proc)
+    reason = None
+    try:
+        while reason is None:
+            try:
+                proc.wait(timeout=min(timeout or 1, 1))
+                break
+            except subprocess.TimeoutExpired:
+                pass
+            now = time.monotonic()
+            if CANCELLED.is_set() or (cancel is not None and cancel.is_set()):
+                reason = "was cancelled"
+            elif timeout and now - started > timeout:
+                reason = "timed out after {} seconds".format(timeout)
+            elif stall_timeout and now - progressed > stall_timeout:
+                reason = "stalled without progress for {} seconds".format(stall_timeout)
+        if reason:
+            kill_process_group(proc)
+        for reader in readers:
+            reader.join()
+    except BaseException:
+        # e.g. KeyboardInterrupt, the command does not receive the
+        # interrupt itself as it runs in its own session
+        kill_process_group(proc)
+        raise
+    finally:
+        with _running_lock:
+            _running.discard(proc)
+    stdout, stderr = (
+        b"".join(output[pipe]) if pipe else None for pipe in (proc.stdout, proc.stderr)
+    )
+    if reason:
+        raise CommandTimeout(proc.returncode, command, stdout, stderr, reason)
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, command, stdout, stderr)
+    return stdout
+
 
+def operation_name(tool, command):
+    """Returns the operation a command performs e.g. docker_pull"""
+    return "{}_{}".format(tool, command.split(" ", 1)[0])
 
-def helm(command, run=True, print_cmd=True):
+
+def helm(command, run=True, print_cmd=True, input=None):
     """Runs helm cli command
 
     :param command: sub command
     :type command: str
+    :param input: data written to the standard input of
+        helm, defaults to None
+    :type input: bytes, optional
     :return: output from command
     :rtype: str
     """
     cmd = "helm " + command
     try:
-        return execute(cmd, print_cmd=print_cmd)
+        return execute(
+            cmd, print_cmd=print_cmd, operation=operation_name("helm", command),
+            input=input,
+        )
     except subprocess.CalledProcessError as e:
         print(e.output, e.stderr)
         raise
 
 
-def docker(command):
+def docker(command, cancel=None):
     """Runs docker cli command
 
     :param command: sub command
     :type command: str
+    :param cancel: event cancelling the command, defaults to None
+    :type cancel: threading.Event, optional
     :return: output from command
     :rtype: str
     """
     cmd = "docker " + command
     try:
-        return execute(cmd)
+        return execute(cmd, operation=operation_name("docker", command), cancel=cancel)
     except subprocess.CalledProcessError as e:
         print(e.output, e.stderr)
         raise
 
 
-def parse_images(documents):
-    """Get all images in given yaml
-    documents
+class Hedger:
+    """Starts a second attempt of an operation once the first one has
+    taken longer than given percentile of the durations of completed
+    operations. The first attempt to succeed wins and the other one
+    is cancelled"""
 
-    :param documents: yaml documents
-    :type documents: str
-    :return: list of images
-    :rtype: [str]
-    """
+    def __init__(self, percentile, min_samples=HEDGE_MIN_SAMPLES):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.durations = []
+        self.hedged = 0
+        self.lock = threading.Lock()
 
-    def get_images(obj):
-        images = set()
-        if isinstance(obj, list) or isinstance(obj, set):
-            for value in obj:
-                images.update(get_images(value))
-        if isinstance(obj, dict):
-            for key, value in obj.items():
-                if key == "image" and isinstance(value, str):
-                    debug("Adding image", value)
-                    images.add(value)
-                images.update(get_images(value))
-        return images
+    def delay(self):
+        """Returns seconds after which an attempt is hedged or None
+        if not enough operations have completed yet"""
+        with self.lock:
+            durations = sorted(self.durations)
+        if len(durations) < self.min_samples:
+            return None
+        index = min(len(durations) - 1, int(len(durations) * self.percentile / 100))
+        return durations[index]
 
-    docs = yaml.safe_load_all(documents)
-    images = set()
-    for doc in docs:
-        debug(doc)
-        images.update(get_images(doc))
-    return images
+    def run(self, attempt):
+        """Runs given attempt, hedging it if it is slow
 
+        :param attempt: function called with a cancel event
+        :type attempt: callable
+        :return: result of the first successful attempt
 
-def run_scripts(scripts, args=[]):
-    """Executes given scripts
+        :raises: subprocess.CalledProcessError
+        """
+        started = time.monotonic()
+        delay = self.delay()
+        cancels = [threading.Event(), threading.Event()]
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            pending = {executor.submit(attempt, cancels[0])}
+            if delay is not None and not wait(pending, timeout=delay)[0]:
+                with self.lock:
+                    self.hedged += 1
+                pending.add(executor.submit(attempt, cancels[1]))
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        result = future.result()
+                    except subprocess.CalledProcessError as e:
+                        failure = e
+                        continue
+                    for cancel in cancels:
+                        cancel.set()
+                    with self.lock:
+                        self.durations.append(time.monotonic() - started)
+                    return result
+        raise failure
 
-    :param init_scripts: path of scripts
-        to be executed
-    :type init_scripts: [str]
-    """
-    failures = {}
-    for script in scripts:
-        # if the script has hardcoded arguments, those are used instead
-        # of the defaults
-        script_tokens = script.split()
-        script_path, user_args = script_tokens[0], script_tokens[1:]
-        if not os.path.isfile(script_path):
-            print(script_path, "not found!")
-            failures[script_path] = "File not found"
-            continue
-        abspath = os.path.abspath(script_path)
-        args = user_args or args
-        print("Executing:", abspath, *args)
-        try:
-            subprocess.run([abspath, *args], check=True)
-        except subprocess.CalledProcessError as exp:
-            failures[script] = str(exp)
-    return failures
 
+# hedges slow image pulls if hedge_percentile is configured
+PULL_HEDGER = None
 
-def run_init_scripts(init_scripts):
-    """Executes given initialization scripts
 
-    :param init_scripts: path of scripts
-        to be executed
-    :type init_scripts: [str]
+def basic_auth(username, password):
+    """Returns value of Authorization header for basic authentication"""
+    credentials = "{}:{}".format(username, password)
+    return "Basic " + base64.b64encode(credentials.encode()).decode()
+
+
+def registry_scheme(host):
+    """Returns the URL scheme to be used for given registry host.
+    Like docker, registries on localhost are accessed over plain http
     """
-    print("Executing initialization scripts")
-    run_scripts(init_scripts)
-    print("Finished executing initialization scripts")
+    hostname = host.split(":")[0]
+    if hostname in ("localhost", "127.0.0.1"):
+        return "http"
+    return "https"
 
 
-def error(error, parents=[], index=None):
-    """Constructs configuration related error messages
+def parse_image_reference(image):
+    """Splits given image into registry host, repository and
+    reference (tag or digest) the way docker does
 
-    :param error: error messages
-    :type error: str
-    :param parents: list of parent keys of
-        the field that has error, defaults to []
-    :type parents: [str], optional
-    :param index: optional index in a list if the
-        error is in a list item, defaults to None
-    :type index: int, optional
+    :param image: image reference. e.g. redis:6.0
+    :type image: str
+    :return: (host, repository, reference) e.g.
+        ("docker.io", "library/redis", "6.0")
+    :rtype: (str, str, str)
     """
-    msg = "Error: {}".format(error)
-    if parents:
-        # join parents - ["repos", "add"] -> "repos.add"
-        if isinstance(parents, list):
-            parents = ".".join(parents)
-        msg = "{} in section {}".format(msg, parents)
-    if isinstance(index, int):
-        msg = "{} at index {}".format(msg, index)
-    print(msg)
+    name, _, digest = image.partition("@")
+    tag = None
+    if ":" in name.split("/")[-1]:
+        name, tag = name.rsplit(":", 1)
+    host, _, repository = name.partition("/")
+    if not repository or not (
+        "." in host or ":" in host or host == "localhost"
+    ):
+        host, repository = DOCKER_HUB_HOST, name
+    if host in DOCKER_HUB_ALIASES:
+        host = DOCKER_HUB_HOST
+        if "/" not in repository:
+            repository = "library/" + repository
+    return host, repository, digest or tag or "latest"
 
 
-def get_repo_username_password(repo, g_username, g_password):
-    """Returns username password configured for given helm repository
+def helper_credentials(helper, server):
+    """Returns credentials of given server stored by a docker
+    credential helper e.g. desktop, pass or ecr-login
 
-    If username or password keys are specified in repo configuration,
-    return them else fallback to g_username, g_password
+    :param helper: name of the helper, run as docker-credential-<helper>
+    :type helper: str
+    :param server: server the credentials are stored for
+    :type server: str
+    :return: (username, password), (None, None) if not stored
+    :rtype: (str, str)
+    """
+    try:
+        output = execute(
+            ["docker-credential-" + helper, "get"], print_cmd=False, split=False,
+            input=server.encode(),
+        )
+        credentials = json.loads(output)
+    except (subprocess.CalledProcessError, OSError, ValueError):
+        return None, None
+    return credentials.get("Username"), credentials.get("Secret")
 
-    :param repo: Repository configuration
-    :type repo: Dict
-    :param g_username: fallback username
-    :type g_username: str
-    :param g_password: fallback password
-    :type g_password: str
-    :return: (username, password)
+
+def docker_credentials(host):
+    """Returns credentials stored by `docker login` for given host,
+    either in the docker configuration or in the credential helper
+    it names
+
+    :param host: registry host
+    :type host: str
+    :return: (username, password), (None, None) if not logged in
     :rtype: (str, str)
     """
-    if USERNAME_KEY not in repo:
-        username = g_username
-    else:
-        username = repo.get(USERNAME_KEY)
-    if PASSWORD_KEY not in repo:
-        password = g_password
-    else:
-        password = repo.get(PASSWORD_KEY)
-    return username, password
+    try:
+        with open(DOCKER_CONFIG_PATH, "r") as f:
+            config = json.load(f)
+    except (IOError, ValueError):
+        return None, None
+    auths = config.get("auths") or {}
+    helpers = config.get("credHelpers") or {}
+    candidates = [host, "https://" + host, "http://" + host]
+    if host == DOCKER_HUB_HOST:
+        candidates.append("https://index.docker.io/v1/")
+    for candidate in candidates:
+        if helpers.get(candidate):
+            return helper_credentials(helpers[candidate], candidate)
+    for candidate in candidates:
+        auth = auths.get(candidate, {}).get("auth")
+        if auth:
+            username, _, password = base64.b64decode(auth).decode().partition(":")
+            return username, password
+    if config.get("credsStore"):
+        for candidate in candidates:
+            username, password = helper_credentials(config["credsStore"], candidate)
+            if username and password:
+                return username, password
+    return None, None
 
 
-def get_repo_objs(repos, g_username, g_password, parents=[]):
-    """Return Repo class instances instantiated from given
-    repos configuration
+_registry_clients = {}
 
-    :param repos: List of helm repository configurations
-    :type repos: [Dict]
-    :param g_username: global username
-    :type g_username: str
-    :param g_password: global password
-    :type g_password: str
+
+class BlobStore:
+    """Content addressed store of blobs on local disk shared by runs
+    and processes on the same host. The least recently used blobs are
+    evicted once the store grows beyond its maximum size"""
+
+    def __init__(self, path, max_size=None):
+        self.path = path
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.stats = {
+            "Hits": 0, "Misses": 0, "Bytes served": 0, "Bytes stored": 0, "Evicted": 0,
+        }
+        os.makedirs(os.path.join(path, "sha256"), exist_ok=True)
+        self.size = self.scan_size()
+
+    def blob_path(self, digest):
+        return os.path.join(self.path, *digest.split(":", 1))
+
+    def scan_size(self):
+        return sum(size for _, size, _ in self.blobs())
+
+    def blobs(self):
+        """Returns (modification time, size, path) of stored blobs"""
+        blobs = []
+        for algorithm in os.listdir(self.path):
+            directory = os.path.join(self.path, algorithm)
+            if not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                if name.endswith((".tmp", ".lock")):
+                    continue
+                path = os.path.join(directory, name)
+                with contextlib.suppress(FileNotFoundError):
+                    stat = os.stat(path)
+                    blobs.append((stat.st_mtime, stat.st_size, path))
+        return blobs
+
+    def count(self, stat, value=1):
+        with self.lock:
+            self.stats[stat] += value
+
+    def hit(self, path):
+        # modification time tracks use, access times are often not updated
+        with contextlib.suppress(FileNotFoundError):
+            os.utime(path)
+            self.count("Hits")
+            self.count("Bytes served", os.path.getsize(path))
+            return True
+        return False
+
+    @contextlib.contextmanager
+    def locked(self, path):
+        """Holds an exclusive lock on given lock file, shared by
+        threads and processes"""
+        with open(path, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def fetch(self, digest, download):
+        """Returns path of given blob in the store. On a miss the blob
+        is downloaded once, other threads and processes fetching the
+        same blob wait for it
+
+        :param digest: blob digest
+        :type digest: str
+        :param download: function writing the blob to given file
+        :type download: callable
+        :rtype: str
+
+        :raises: OSError
+        """
+        path = self.blob_path(digest)
+        if os.path.isfile(path) and self.hit(path):
+            return path
+        with self.locked(path + ".lock"):
+            if os.path.isfile(path) and self.hit(path):
+                return path
+            self.count("Misses")
+            tmp = "{}.{}.tmp".format(path, uuid.uuid4().hex)
+            try:
+                with open(tmp, "wb") as f:
+                    download(f)
+                if file_digest(tmp) != digest:
+                    raise OSError("downloaded blob does not match " + digest)
+                size = os.path.getsize(tmp)
+                os.replace(tmp, path)
+            finally:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+        self.count("Bytes stored", size)
+        with self.lock:
+            self.size += size
+            full = self.max_size is not None and self.size > self.max_size
+        if full:
+            self.evict(keep=path)
+        return path
+
+    def evict(self, keep=None):
+        """Removes least recently used blobs until the store fits
+        its maximum size
+
+        :param keep: path of a blob that must not be evicted
+        :type keep: str, optional
+        """
+        with self.locked(os.path.join(self.path, ".lock")):
+            blobs = sorted(self.blobs())
+            size = sum(blob_size for _, blob_size, _ in blobs)
+            for _, blob_size, path in blobs:
+                if size <= self.max_size:
+                    break
+                if path == keep:
+                    continue
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path)
+                    self.count("Evicted")
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path + ".lock")
+                size -= blob_size
+        with self.lock:
+            self.size = size
+
+    def summary(self):
+        with self.lock:
+            stats = dict(self.stats)
+        lookups = stats["Hits"] + stats["Misses"]
+        stats["Hit ratio"] = round(stats["Hits"] / lookups, 3) if lookups else 0
+        return stats
+
+
+def parse_size(value):
+    """Parses sizes such as 512M or 20G into bytes
+
+    :raises: ValueError
+    """
+    match = re.match(r"^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*$", str(value), re.I)
+    if not match:
+        raise ValueError("invalid size " + str(value))
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).upper()])
+
+
+def get_blob_store(config, parents=[]):
+    """Get BlobStore configured by given blob cache configuration
+
+    :param config: blob cache configuration
+    :type config: Dict
     :param parents: list of parent keys in the configuration
         to be used for constructing appropriate error messages
-        for configuration errors, defaults to []
-    :type parents: list, optional
-    :return: list of Repo objects
-    :rtype: [Repo]
+        for configuration errors
+    :type parents: [str]
+    :return: blob store or None if it is not configured
+    :rtype: BlobStore
     """
-    repo_objs = []
-    for i, repo in enumerate(repos):
-        is_err = False
-        name = repo.get(NAME_KEY)
-        if not name:
-            err = get_error_type(NAME_KEY, name, repo)
-            error(err, parents=parents, index=i)
-            is_err = True
-        remote = repo.get(REMOTE_KEY)
-        if not remote:
-            err = get_error_type(REMOTE_KEY, remote, repo)
-            error(err, parents=parents, index=i)
-            is_err = True
-        if is_err:
-            continue
-        username, password = get_repo_username_password(repo, g_username, g_password)
-        repo_objs.append(
-            Repo(
-                name=name,
-                remote=remote,
-                username=username,
-                password=password,
-            )
+    if not config:
+        return None
+    path = config.get(PATH_KEY)
+    if not path:
+        error(get_error_type(PATH_KEY, path, config), parents=parents)
+        return None
+    max_size = config.get(MAX_SIZE_KEY)
+    if max_size is not None:
+        try:
+            max_size = parse_size(max_size)
+        except ValueError:
+            error(Errors.invalid_value(MAX_SIZE_KEY, max_size), parents=parents)
+            return None
+    return BlobStore(os.path.expanduser(path), max_size)
+
+
+# local blob store consulted before registries if blob_cache is configured
+BLOB_STORE = None
+
+
+class TagCache:
+    """Tag lists of repositories kept between runs in a json file.
+    Lists younger than max_age seconds are used without asking the
+    registry, older ones are revalidated with their ETag if they
+    have one"""
+
+    def __init__(self, path, max_age=DEFAULT_TAG_CACHE_MAX_AGE):
+        self.path = path
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.stats = {"Hits": 0, "Revalidated": 0, "Fetched": 0}
+        self.entries = {}
+        try:
+            with open(path) as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            print("Ignoring unreadable tag cache", path, e)
+
+    def tags(self, host, repository):
+        """Returns tags of given repository
+
+        :rtype: set(str)
+
+        :raises: OSError
+        """
+        key = "{}/{}".format(host, repository)
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry and time.time() - entry["time"] < self.max_age:
+            with self.lock:
+                self.stats["Hits"] += 1
+            return set(entry["tags"])
+        tags, etag = get_registry_client(host).list_tags(
+            repository, etag=entry and entry.get("etag")
         )
-    return repo_objs
+        with self.lock:
+            if tags is None:
+                self.stats["Revalidated"] += 1
+                tags = entry["tags"]
+            else:
+                self.stats["Fetched"] += 1
+            self.entries[key] = {"tags": sorted(tags), "etag": etag, "time": time.time()}
+        return set(tags)
 
+    def add(self, image):
+        """Records given image pushed by this run in the
+        tag list of its repository if it is cached"""
+        host, repository, tag = parse_image_reference(image)
+        with self.lock:
+            entry = self.entries.get("{}/{}".format(host, repository))
+            if entry and tag not in entry["tags"]:
+                entry["tags"].append(tag)
+                # the list is fetched again once it expires
+                entry["etag"] = None
 
-def get_repos(repos, parents):
-    """Configures helm repositories
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self.lock:
+            data = json.dumps(self.entries)
+        tmp = "{}.{}.tmp".format(self.path, os.getpid())
+        with open(tmp, "w") as f:
+            f.write(data)
+        os.replace(tmp, self.path)
 
-    :param repos: repos configuration
-    :type repos: Dict
+    def summary(self):
+        with self.lock:
+            return dict(self.stats)
+
+
+def get_tag_cache(config, parents=[]):
+    """Get TagCache configured by given tag cache configuration
+
+    :param config: tag cache configuration
+    :type config: Dict
     :param parents: list of parent keys in the configuration
         to be used for constructing appropriate error messages
         for configuration errors
     :type parents: [str]
+    :return: tag cache or None if it is not configured
+    :rtype: TagCache
     """
-    g_username, g_password = repos[USERNAME_KEY], repos[PASSWORD_KEY]
-    parents.append(REPOS_ADD_KEY)
-    repos_to_add = repos.get(REPOS_ADD_KEY, [])
-    return get_repo_objs(repos_to_add, g_username, g_password, parents=parents)
+    if not config:
+        return None
+    path = config.get(PATH_KEY)
+    if not path:
+        error(get_error_type(PATH_KEY, path, config), parents=parents)
+        return None
+    max_age = config.get(MAX_AGE_KEY, DEFAULT_TAG_CACHE_MAX_AGE)
+    if not isinstance(max_age, (int, float)) or max_age < 0:
+        error(Errors.invalid_value(MAX_AGE_KEY, max_age), parents=parents)
+        return None
+    return TagCache(os.path.expanduser(path), max_age)
+
+
+# tag lists kept between runs if tag_cache is configured
+TAG_CACHE = None
+
+
+def list_tags(image):
+    """Returns tags of the repository of given image
+
+    :rtype: set(str)
+
+    :raises: OSError
+    """
+    host, repository, _ = parse_image_reference(image)
+    if TAG_CACHE:
+        return TAG_CACHE.tags(host, repository)
+    return set(get_registry_client(host).list_tags(repository)[0])
+
+
+def get_registry_client(host, username=None, password=None):
+    """Returns a cached RegistryClient for given registry host. Credentials
+    stored by `docker login` are used if none are given
+
+    :param host: registry host
+    :type host: str
+    :rtype: RegistryClient
+    """
+    key = (host, username)
+    if key not in _registry_clients:
+        if not (username and password):
+            username, password = docker_credentials(host)
+        api_host = DOCKER_HUB_API_HOST if host == DOCKER_HUB_HOST else host
+        _registry_clients[key] = RegistryClient(api_host, username, password)
+    return _registry_clients[key]
+
+
+def sha256_digest(data):
+    return "sha256:" + hashlib.sha256(data).hexdigest()
+
+
+# digest -> set of (registry host, repository) the blob is known to exist in
+_known_blobs = {}
+_blob_locks = {}
+_known_blobs_lock = threading.Lock()
+
+
+def record_blob(client, repository, digest):
+    with _known_blobs_lock:
+        _known_blobs.setdefault(digest, set()).add((client.host, repository))
+
+
+def ensure_blob(client, repository, digest, fetch, size=None):
+    """Makes sure given blob exists in the repository. Blobs that exist
+    in another repository of the same registry are mounted from there
+    instead of being uploaded again
+
+    :param client: target registry client
+    :type client: RegistryClient
+    :param repository: target repository
+    :type repository: str
+    :param digest: blob digest
+    :type digest: str
+    :param fetch: function returning the blob content or
+        a file it is streamed from
+    :type fetch: callable
+    :param size: size of the blob, required if fetch returns
+        a file, defaults to None
+    :type size: int, optional
+    :return: True if the blob had to be uploaded
+    :rtype: bool
+
+    :raises: UploadError, OSError
+    """
+    with _known_blobs_lock:
+        lock = _blob_locks.setdefault(digest, threading.Lock())
+    # the same blob is uploaded by one worker at a time so that
+    # other workers can mount it once it is uploaded
+    with lock:
+        with _known_blobs_lock:
+            known = set(_known_blobs.get(digest, ()))
+        if (client.host, repository) in known or client.blob_exists(
+            repository, digest
+        ):
+            record_blob(client, repository, digest)
+            return False
+        location = None
+        for host, source in sorted(known):
+            if host != client.host:
+                continue
+            location = client.start_upload(repository, mount=digest, source=source)
+            if location is None:
+                debug("Mounted blob", digest, "from", source, "to", repository)
+                record_blob(client, repository, digest)
+                return False
+            break
+        location = location or client.start_upload(repository)
+        data = fetch()
+        try:
+            client.upload_blob(location, digest, data, size)
+        finally:
+            if hasattr(data, "close"):
+                data.close()
+        record_blob(client, repository, digest)
+        return True
+
+
+def copy_manifest(src, src_repository, reference, dst, dst_repository, tag):
+    """Copies given manifest along with its blobs between registries
+
+    :param src: source registry client
+    :type src: RegistryClient
+    :param dst: target registry client
+    :type dst: RegistryClient
+    :return: True if the manifest was copied, False if it already
+        existed in the target with the same digest
+    :rtype: bool
+
+    :raises: UploadError, OSError
+    """
+    manifest = src.get_manifest(src_repository, reference)
+    if not manifest:
+        raise OSError("manifest {}:{} not found".format(src_repository, reference))
+    media_type, body, digest = manifest
+    if dst.manifest_digest(dst_repository, tag) == digest:
+        return False
+    content = json.loads(body)
+    for child in content.get("manifests", []):
+        copy_manifest(
+            src, src_repository, child["digest"],
+            dst, dst_repository, child["digest"],
+        )
+    blobs = [content["config"]] if "config" in content else []
+    for blob in blobs + content.get("layers", []):
+        record_blob(src, src_repository, blob["digest"])
+        ensure_blob(
+            dst, dst_repository, blob["digest"],
+            lambda blob=blob: src.get_blob(src_repository, blob["digest"]),
+        )
+    dst.put_manifest(dst_repository, tag, media_type, body)
+    return True
+
+
+def oci_tag(version):
+    """Returns the tag of a chart version in an OCI registry.
+    Like helm, + is replaced as it is not allowed in tags"""
+    return str(version).replace("+", "_")
+
+
+def push_oci_chart(chart, repo):
+    """Pushes chart to given OCI registry repository. Charts hosted in
+    OCI registries are copied registry to registry, other charts are
+    pushed as helm OCI artifacts built from the pulled archive
+
+    :param chart: chart to be pushed
+    :type chart: Chart
+    :param repo: target OCI repository
+    :type repo: Repo
+    :return: True if the chart was pushed, False if it was already published
+    :rtype: bool
+
+    :raises: UploadError, OSError
+    """
+    client = repo.registry_client()
+    _, repository = repo.oci_reference(chart.chart_name)
+    tag = oci_tag(chart.version)
+    if chart.source_repo:
+        src = chart.source_repo.registry_client()
+        _, src_repository = chart.source_repo.oci_reference(chart.chart_name)
+        return copy_manifest(src, src_repository, tag, client, repository, tag)
+
+    config, layers, manifest = chart_artifact(chart)
+    # chart content is checked by digest rather than by manifest digest
+    # so that charts pushed by helm with other annotations are recognized
+    existing = client.get_manifest(repository, tag)
+    if existing:
+        existing_layers = json.loads(existing[1]).get("layers", [])
+        if layers[0][1]["digest"] in [l["digest"] for l in existing_layers]:
+            return False
+    config_digest = json.loads(manifest)["config"]["digest"]
+    ensure_blob(client, repository, config_digest, lambda: config)
+    for path, descriptor in layers:
+        ensure_blob(
+            client, repository, descriptor["digest"],
+            lambda path=path: open(path, "rb").read(),
+        )
+    client.put_manifest(repository, tag, OCI_MANIFEST_MEDIA_TYPE, manifest)
+    return True
+
+
+def chart_artifact(chart):
+    """Builds the helm OCI artifact of the pulled chart archive
+
+    :param chart: pulled chart
+    :type chart: Chart
+    :return: config blob, (path, descriptor) of each layer
+        and the manifest of the artifact
+    :rtype: (bytes, [(str, Dict)], bytes)
+    """
+    archive = chart.archive_path()
+    paths = [(HELM_CHART_MEDIA_TYPE, archive)]
+    if os.path.isfile(archive + ".prov"):
+        paths.append((HELM_PROV_MEDIA_TYPE, archive + ".prov"))
+    layers = []
+    for media_type, path in paths:
+        with open(path, "rb") as f:
+            data = f.read()
+        layers.append((path, {
+            "mediaType": media_type, "digest": sha256_digest(data), "size": len(data)
+        }))
+    config = json.dumps(chart.metadata(), sort_keys=True).encode()
+    manifest = json.dumps({
+        "schemaVersion": 2,
+        "mediaType": OCI_MANIFEST_MEDIA_TYPE,
+        "config": {
+            "mediaType": HELM_CONFIG_MEDIA_TYPE,
+            "digest": sha256_digest(config),
+            "size": len(config),
+        },
+        "layers": [descriptor for _, descriptor in layers],
+    }).encode()
+    return config, layers, manifest
+
+
+def image_digests(image):
+    """Returns the digests of given image as reported
+    by the registry API
+
+    :param image: image reference
+    :type image: str
+    :return: set of digests, empty if the digests could not be determined
+    :rtype: set(str)
+    """
+    host, repository, reference = parse_image_reference(image)
+    try:
+        return get_registry_client(host).manifest_digests(repository, reference)
+    except (OSError, ValueError) as e:
+        debug("Unable to get digest of image", image, e)
+        return set()
+
+
+def find_present_images(images, registries, targets=None):
+    """Finds images whose manifest already exists in the target
+    registries with the same digest as in the source registry
+
+    :param images: list of images
+    :type images: [str]
+    :param registries: list of Registries
+    :type registries: [Registry]
+    :param targets: dictionary mapping registry name to the images
+        to be pushed to it, defaults to None in which case all images
+        are checked in all registries
+    :type targets: Dict, optional
+    :return: dictionary mapping registry name to images that
+        are already present in the registry
+    :rtype: Dict
+    """
+    present = {registry.name: set() for registry in registries}
+    push_registries = [registry for registry in registries if registry.push]
+    if not push_registries:
+        return present
+    print("Checking images already present in target registries")
+    for image in images:
+        checked = [
+            registry for registry in push_registries
+            if targets is None or image in targets.get(registry.name, ())
+        ]
+        if not checked:
+            continue
+        with EVENTS.timed("image_check", image) as event:
+            find_present_image(image, checked, present)
+            missing = [r.name for r in checked if image not in present[r.name]]
+            event["status"] = "missing" if missing else "present"
+    return present
+
+
+def find_present_image(image, registries, present):
+    """Adds given image to the present images of each registry
+    it already exists in with the same digest
+
+    :param image: image reference
+    :type image: str
+    :param registries: list of target Registries
+    :type registries: [Registry]
+    :param present: dictionary mapping registry name to present images
+    :type present: Dict
+    """
+    source_digests = image_digests(image)
+    if source_digests:
+        for registry in registries:
+            target = registry.target_name(image)
+            host, repository, reference = parse_image_reference(target)
+            try:
+                digest = get_registry_client(host).manifest_digest(
+                    repository, reference
+                )
+            except OSError as e:
+                debug("Unable to get digest of image", target, e)
+                continue
+            if digest in source_digests:
+                debug("Image", target, "is already present")
+                present[registry.name].add(image)
+
+
+def image_layers(image):
+    """Returns the layers of given pulled image as recorded by the
+    docker daemon so that no requests are sent to the source registry,
+    which may count them towards its pull rate limits. Layers are
+    identified by their uncompressed diff ids and sizes are taken from
+    the image history
+
+    :param image: image reference
+    :type image: str
+    :return: dictionary mapping layer diff id to its size, empty if
+        the image could not be inspected. Sizes are 0 if they can not
+        be matched to the layers
+    :rtype: Dict
+    """
+    try:
+        layers = json.loads(docker(
+            "image inspect --format '{{json .RootFS.Layers}}' " + image
+        )) or []
+        history = docker(
+            "history --no-trunc --human=false --format '{{.Size}}' " + image
+        ).split()
+        # history lists the newest step first, steps creating no layer have no size
+        sizes = [int(size) for size in reversed(history) if int(size)]
+    except (subprocess.CalledProcessError, ValueError) as e:
+        debug("Unable to inspect layers of image", image, e)
+        return {}
+    if len(sizes) != len(layers):
+        sizes = [0] * len(layers)
+    return dict(zip(layers, sizes))
+
+
+def get_image_layers(images, workers=DEFAULT_WORKERS):
+    """Returns layers of all given images
+
+    :param images: list of images
+    :type images: [str]
+    :param workers: number of images inspected concurrently
+    :type workers: int, optional
+    :return: dictionary mapping image to its layer diff ids and sizes
+    :rtype: Dict
+    """
+    images = list(images)
+    if len(images) < 2:
+        # layers can only be shared between several images
+        return {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return dict(zip(images, executor.map(image_layers, images)))
+
+
+def plan_push_order(layers):
+    """Orders pushes of given images into waves such that no two
+    images in a wave upload the same layer. A layer shared by several
+    images is uploaded by the first wave containing one of them and
+    found in the registry by the images pushed in later waves. Images
+    sharing the most bytes with others go first
+
+    :param layers: dictionary mapping image to its layer
+        digests and sizes
+    :type layers: Dict
+    :return: waves of images
+    :rtype: [[str]]
+    """
+    users = {}
+    for image_layers in layers.values():
+        for digest in image_layers:
+            users[digest] = users.get(digest, 0) + 1
+
+    def shared_bytes(image):
+        return sum(
+            size for digest, size in layers[image].items() if users[digest] > 1
+        )
+
+    pending = sorted(layers, key=lambda image: (-shared_bytes(image), image))
+    uploaded = set()
+    waves = []
+    while pending:
+        wave = []
+        claimed = set()
+        deferred = []
+        for image in pending:
+            new_layers = set(layers[image]) - uploaded
+            if new_layers & claimed:
+                deferred.append(image)
+                continue
+            claimed |= new_layers
+            wave.append(image)
+        uploaded |= claimed
+        waves.append(wave)
+        pending = deferred
+    return waves
+
+
+def reused_layer_bytes(waves, layers, pushed):
+    """Returns the bytes of layers pushed by an image of an earlier
+    wave that images of later waves found in the registry instead of
+    uploading them alongside it. Sizes are the uncompressed sizes
+    known to the docker daemon, so this is an estimate
+
+    :param waves: waves images were pushed in
+    :type waves: [[str]]
+    :param layers: dictionary mapping image to its layer
+        digests and sizes
+    :type layers: Dict
+    :param pushed: images that were pushed successfully
+    :type pushed: set(str)
+    :rtype: int
+    """
+    uploaded = set()
+    reused = 0
+    for wave in waves:
+        for image in wave:
+            reused += sum(
+                size for digest, size in layers.get(image, {}).items()
+                if digest in uploaded
+            )
+        for image in wave:
+            if image in pushed:
+                uploaded.update(layers.get(image, {}))
+    return reused
+
+
+_repo_indexes = {}
+_repo_index_validators = {}
+_repo_indexes_lock = threading.Lock()
+
+
+def get_repo_index(repo):
+    """Returns index of given helm repository. The index is
+    downloaded once and shared by all charts until it is refreshed
+
+    :param repo: helm repository
+    :type repo: Repo
+    :return: repository index, empty if it could not be downloaded
+    :rtype: Dict
+    """
+    with _repo_indexes_lock:
+        if repo.name in _repo_indexes:
+            return _repo_indexes[repo.name]
+    return refresh_repo_index(repo)[0]
+
+
+def refresh_repo_index(repo):
+    """Refreshes the cached index of given helm repository with a
+    conditional request so that unchanged indexes are not downloaded
+
+    :param repo: helm repository
+    :type repo: Repo
+    :return: repository index, empty if it could not be downloaded,
+        and True if the index has changed
+    :rtype: (Dict, bool)
+    """
+    with _repo_indexes_lock:
+        validators = _repo_index_validators.get(repo.name, {})
+        try:
+            index, validators = repo.fetch_index(validators)
+        except (OSError, yaml.YAMLError) as e:
+            debug("Unable to fetch index of repository", repo.name, e)
+            # failures are not cached so that the next call tries again
+            return _repo_indexes.get(repo.name, {}), False
+        if index is None:
+            return _repo_indexes[repo.name], False
+        _repo_indexes[repo.name] = index
+        _repo_index_validators[repo.name] = validators
+        return index, True
+
+
+def matching_versions(index, chart_name, pattern):
+    """Returns versions of given chart in a repository index
+    that match given glob pattern e.g. 1.*
+
+    :param index: repository index
+    :type index: Dict
+    :param chart_name: name of the chart
+    :type chart_name: str
+    :param pattern: glob pattern
+    :type pattern: str
+    :rtype: [str]
+    """
+    entries = (index.get("entries") or {}).get(chart_name) or []
+    return [
+        str(entry.get("version")) for entry in entries
+        if fnmatch.fnmatchcase(str(entry.get("version")), pattern)
+    ]
+
+
+def expand_version_patterns(charts, repos, seen=()):
+    """Adds versions published in the source repository that match
+    the version pattern of each chart configuration
+
+    :param charts: charts section in configuration
+    :type charts: [Dict]
+    :param repos: list of helm repositories configured globally
+    :type repos: [Repo]
+    :param seen: combined names of chart versions that should
+        not be added, defaults to ()
+    :type seen: set(str), optional
+    :return: charts configuration with only the matching versions
+        that were not configured or seen before, and True if any
+        source repository index has changed
+    :rtype: ([Dict], bool)
+    """
+    repo_map = list_to_dict(repos, "name")
+    expanded = []
+    changed = False
+    for chart in charts:
+        pattern = chart.get(VERSION_PATTERN_KEY)
+        repo = repo_map.get(chart.get(REPO_KEY))
+        if not pattern or not repo or repo.is_oci():
+            continue
+        index, index_changed = refresh_repo_index(repo)
+        changed = changed or index_changed
+        configured = {str(v.get(VERION_KEY)) for v in chart.get(VERSIONS_KEY) or []}
+        versions = []
+        for version in matching_versions(index, chart.get(NAME_KEY), pattern):
+            combined_name = "{}/{}-{}".format(repo.name, chart.get(NAME_KEY), version)
+            if version in configured or combined_name in seen:
+                continue
+            versions.append({
+                VERION_KEY: version,
+                FETCH_DIR_KEY: "/tmp/{}/{}/{}".format(
+                    repo.name, chart.get(NAME_KEY), version
+                ),
+            })
+        if versions:
+            expanded.append(dict(chart, **{VERSIONS_KEY: versions}))
+    return expanded, changed
+
+
+def published_digest(repo, chart_name, version):
+    """Returns digest of given chart version as listed in the
+    index of given repository
+
+    :return: digest or None if the version is not published
+    :rtype: str
+    """
+    entries = get_repo_index(repo).get("entries") or {}
+    for entry in entries.get(chart_name) or []:
+        if str(entry.get("version")) == str(version):
+            return entry.get("digest")
+    return None
+
+
+class ImageRule:
+    """Rule describing where images are found in rendered documents
+
+    :param path: dotted key path pattern of the field containing the
+        image. `*` matches one key and `**` any number of keys, list
+        indices are not part of the path, defaults to "**.image"
+    :type path: str, optional
+    :param kinds: kinds of documents the rule applies to, all if empty
+    :type kinds: [str], optional
+    :param regex: regular expression string values must match. The
+        `image` named group or the whole match is used as image
+    :type regex: str, optional
+    :param fields: field names of maps splitting an image into
+        registry, repository, tag and digest
+    :type fields: Dict, optional
+    """
+
+    def __init__(self, path="**.image", kinds=None, regex=None, fields=None):
+        self.path = path
+        self.kinds = set(kinds or [])
+        self.regex = re.compile(regex) if regex else None
+        self.fields = dict(DEFAULT_IMAGE_FIELDS, **(fields or {}))
+        segments = path.split(".")
+        self.key = segments[-1] if segments[-1] not in ("*", "**") else None
+        self.any_path = path == "**"
+        pattern = ""
+        for i, segment in enumerate(segments):
+            last = i == len(segments) - 1
+            if segment == "**":
+                pattern += r".*" if last else r"(?:[^.]+\.)*"
+                continue
+            pattern += r"[^.]+" if segment == "*" else re.escape(segment)
+            if not last:
+                pattern += r"\."
+        self.path_regex = re.compile("^{}$".format(pattern))
+
+    def match_path(self, path):
+        return self.any_path or bool(self.path_regex.match(".".join(path)))
+
+    def images(self, value):
+        """Returns images in given field value matched by the rule"""
+        if isinstance(value, str):
+            if not self.regex:
+                return [value]
+            match = self.regex.search(value)
+            if not match:
+                return []
+            return [match.groupdict().get("image") or match.group(0)]
+        if isinstance(value, dict) and not self.regex:
+            image = compose_image(value, self.fields)
+            return [image] if image else []
+        return []
+
+    def __eq__(self, other):
+        return isinstance(other, self.__class__) and \
+            (self.path, self.kinds, self.regex, self.fields) == \
+            (other.path, other.kinds, other.regex, other.fields)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+
+DEFAULT_IMAGE_RULES = [
+    # image: repo:tag and image: {registry, repository, tag, digest}
+    ImageRule("**.image"),
+    # operators referencing images in environment variables
+    ImageRule("**.env.value", regex=QUALIFIED_IMAGE_REGEX),
+]
+
+
+class ImageExtractor:
+    """Finds images using a set of rules compiled once. All rules are
+    evaluated in a single traversal of each document"""
+
+    def __init__(self, rules=DEFAULT_IMAGE_RULES):
+        self.rules = list(rules)
+        self.kind_rules = {}
+
+    def rules_for(self, kind):
+        """Returns rules applicable to given kind indexed by the last
+        key of their path, rules matching any key are indexed by None"""
+        if kind not in self.kind_rules:
+            index = {}
+            for rule in self.rules:
+                if not rule.kinds or kind in rule.kinds:
+                    index.setdefault(rule.key, []).append(rule)
+            self.kind_rules[kind] = index
+        return self.kind_rules[kind]
+
+    def extract(self, document):
+        """Returns images in given parsed document
+
+        :param document: parsed yaml document
+        :type document: Any
+        :rtype: set(str)
+        """
+        images = set()
+        kind = document.get("kind") if isinstance(document, dict) else None
+        index = self.rules_for(kind)
+        wildcard_rules = index.get(None, [])
+        # iterative depth first traversal of (path, object) pairs
+        stack = [((), document)]
+        while stack:
+            path, obj = stack.pop()
+            if isinstance(obj, dict):
+                for key, value in obj.items():
+                    key_path = path + (str(key),)
+                    candidates = index.get(key)
+                    if wildcard_rules:
+                        candidates = (candidates or []) + wildcard_rules
+                    for rule in candidates or ():
+                        if rule.match_path(key_path):
+                            for image in rule.images(value):
+                                debug("Adding image", image)
+                                images.add(image)
+                    if isinstance(value, (dict, list)):
+                        stack.append((key_path, value))
+            elif isinstance(obj, list):
+                for value in obj:
+                    if isinstance(value, (dict, list)):
+                        stack.append((path, value))
+        return images
+
+    def parse(self, documents):
+        """Returns images in given yaml documents
+
+        :param documents: yaml documents
+        :type documents: str
+        :rtype: set(str)
+        """
+        images = set()
+        for document in yaml.load_all(documents, Loader=YAML_LOADER):
+            images.update(self.extract(document))
+        return images
+
+
+def compose_image(value, fields=DEFAULT_IMAGE_FIELDS):
+    """Composes image reference from a map splitting it into parts
+    e.g. {registry: docker.io, repository: bitnami/redis, tag: 6.0}
+
+    :return: image reference or None if the map has no repository
+    :rtype: str
+    """
+    repository = value.get(fields["repository"])
+    if not isinstance(repository, str) or not repository:
+        return None
+    image = repository
+    registry = value.get(fields["registry"])
+    if isinstance(registry, str) and registry:
+        image = "{}/{}".format(registry.rstrip("/"), image)
+    tag = value.get(fields["tag"])
+    if tag not in (None, ""):
+        image = "{}:{}".format(image, tag)
+    digest = value.get(fields["digest"])
+    if isinstance(digest, str) and digest:
+        image = "{}@{}".format(image, digest)
+    return image
+
+
+def get_image_rules(rules, parents=[]):
+    """Get ImageRule objects instantiated from given image rules
+    configuration. Configured rules are used along with the
+    default rules
+
+    :param rules: list of image rule configurations
+    :type rules: [Dict]
+    :param parents: list of parent keys in the configuration
+        to be used for constructing appropriate error messages
+        for configuration errors
+    :type parents: [str]
+    :return: list of ImageRule objects
+    :rtype: [ImageRule]
+    """
+    rule_objs = list(DEFAULT_IMAGE_RULES)
+    for i, rule in enumerate(rules):
+        path = rule.get(PATH_KEY, "**" if rule.get(REGEX_KEY) else None)
+        if not path:
+            error(get_error_type(PATH_KEY, path, rule), parents=parents, index=i)
+            continue
+        try:
+            rule_objs.append(ImageRule(
+                path=path,
+                kinds=rule.get(KINDS_KEY),
+                regex=rule.get(REGEX_KEY),
+                fields=rule.get(FIELDS_KEY),
+            ))
+        except re.error:
+            err = Errors.invalid_value(REGEX_KEY, rule.get(REGEX_KEY))
+            error(err, parents=parents, index=i)
+    return rule_objs
+
+
+IMAGE_EXTRACTOR = ImageExtractor()
+
+
+def image_size(image):
+    """Returns size in bytes of given local image. The size is only
+    looked up when events are streamed to avoid an extra docker call
+
+    :param image: image reference
+    :type image: str
+    :rtype: int
+    """
+    if not EVENTS.stream:
+        return 0
+    try:
+        return int(docker("image inspect --format {{.Size}} " + image))
+    except (subprocess.CalledProcessError, ValueError):
+        return 0
+
+
+def parse_images(documents):
+    """Get all images in given yaml
+    documents using the configured image rules
+
+    :param documents: yaml documents
+    :type documents: str
+    :return: list of images
+    :rtype: [str]
+    """
+    return IMAGE_EXTRACTOR.parse(documents)
+
+
+class ScriptCache:
+    """Successful script runs persisted across runs. A run is identified
+    by the script path, hash of the script content and the arguments"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path, "r") as f:
+                self.entries = json.load(f)
+        except (IOError, ValueError):
+            self.entries = {}
+
+    @staticmethod
+    def key(abspath, args):
+        with open(abspath, "rb") as f:
+            content_hash = hashlib.sha256(f.read()).hexdigest()
+        return sha256_digest(json.dumps([abspath, content_hash, list(args)]).encode())
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def add(self, key, script):
+        with self.lock:
+            self.entries[key] = {"script": script, "finished": time.time()}
+
+    def save(self):
+        with self.lock:
+            with open(self.path, "w") as f:
+                json.dump(self.entries, f, indent=4)
+
+
+def stdout_fileno():
+    """Returns file descriptor of current sys.stdout so that output of
+    child processes follows redirections of sys.stdout, None if
+    sys.stdout is not backed by a file"""
+    try:
+        return sys.stdout.fileno()
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def run_scripts(scripts, args=[], timeout=None, cache=None):
+    """Executes given scripts
+
+    :param init_scripts: path of scripts
+        to be executed
+    :type init_scripts: [str]
+    :param args: arguments passed to scripts that do not
+        specify their own arguments, defaults to []
+    :type args: [str], optional
+    :param timeout: seconds after which a script is killed,
+        defaults to None
+    :type timeout: float, optional
+    :param cache: script runs that need not be repeated, defaults to None
+    :type cache: ScriptCache, optional
+    :return: failures and durations in seconds of the scripts, cached
+        scripts are not run and are reported with duration 0
+    :rtype: (Dict, Dict)
+    """
+    failures = {}
+    durations = {}
+    for script in scripts:
+        # if the script has hardcoded arguments, those are used instead
+        # of the defaults
+        script_tokens = script.split()
+        script_path, user_args = script_tokens[0], script_tokens[1:]
+        if not os.path.isfile(script_path):
+            print(script_path, "not found!")
+            failures[script_path] = "File not found"
+            continue
+        abspath = os.path.abspath(script_path)
+        script_args = user_args or args
+        key = cache and ScriptCache.key(abspath, script_args)
+        if cache and key in cache:
+            print("Skipping:", abspath, *script_args, "as it succeeded before")
+            durations[script] = 0
+            EVENTS.emit("script", script, status="cached", args=script_args)
+            continue
+        print("Executing:", abspath, *script_args)
+        start = time.monotonic()
+        status = "ok"
+        try:
+            # scripts are killed along with their children like other commands
+            execute(
+                [abspath, *script_args], print_cmd=False, split=False,
+                timeout=timeout, stdout=stdout_fileno(), stderr=None,
+            )
+        except subprocess.CalledProcessError as exp:
+            failures[script] = str(exp)
+            status = "failed"
+        else:
+            if cache:
+                cache.add(key, script)
+        durations[script] = round(time.monotonic() - start, 3)
+        EVENTS.emit(
+            "script", script, status=status, duration=durations[script],
+            args=script_args,
+        )
+    return failures, durations
+
+
+def run_init_scripts(init_scripts):
+    """Executes given initialization scripts
+
+    :param init_scripts: path of scripts
+        to be executed
+    :type init_scripts: [str]
+    """
+    print("Executing initialization scripts")
+    run_scripts(init_scripts)
+    print("Finished executing initialization scripts")
+
+
+def error(error, parents=[], index=None):
+    """Constructs configuration related error messages
+
+    :param error: error messages
+    :type error: str
+    :param parents: list of parent keys of
+        the field that has error, defaults to []
+    :type parents: [str], optional
+    :param index: optional index in a list if the
+        error is in a list item, defaults to None
+    :type index: int, optional
+    """
+    msg = "Error: {}".format(error)
+    if parents:
+        # join parents - ["repos", "add"] -> "repos.add"
+        if isinstance(parents, list):
+            parents = ".".join(parents)
+        msg = "{} in section {}".format(msg, parents)
+    if isinstance(index, int):
+        msg = "{} at index {}".format(msg, index)
+    print(msg)
+
+
+def get_repo_username_password(repo, g_username, g_password):
+    """Returns username password configured for given helm repository
+
+    If username or password keys are specified in repo configuration,
+    return them else fallback to g_username, g_password
+
+    :param repo: Repository configuration
+    :type repo: Dict
+    :param g_username: fallback username
+    :type g_username: str
+    :param g_password: fallback password
+    :type g_password: str
+    :return: (username, password)
+    :rtype: (str, str)
+    """
+    if USERNAME_KEY not in repo:
+        username = g_username
+    else:
+        username = repo.get(USERNAME_KEY)
+    if PASSWORD_KEY not in repo:
+        password = g_password
+    else:
+        password = repo.get(PASSWORD_KEY)
+    return username, password
+
+
+def get_repo_objs(repos, g_username, g_password, parents=[]):
+    """Return Repo class instances instantiated from given
+    repos configuration
+
+    :param repos: List of helm repository configurations
+    :type repos: [Dict]
+    :param g_username: global username
+    :type g_username: str
+    :param g_password: global password
+    :type g_password: str
+    :param parents: list of parent keys in the configuration
+        to be used for constructing appropriate error messages
+        for configuration errors, defaults to []
+    :type parents: list, optional
+    :return: list of Repo objects
+    :rtype: [Repo]
+    """
+    repo_objs = []
+    for i, repo in enumerate(repos):
+        is_err = False
+        name = repo.get(NAME_KEY)
+        if not name:
+            err = get_error_type(NAME_KEY, name, repo)
+            error(err, parents=parents, index=i)
+            is_err = True
+        remote = repo.get(REMOTE_KEY)
+        if not remote:
+            err = get_error_type(REMOTE_KEY, remote, repo)
+            error(err, parents=parents, index=i)
+            is_err = True
+        if is_err:
+            continue
+        username, password = get_repo_username_password(repo, g_username, g_password)
+        default_type = HELM_REPO_TYPE
+        if remote.startswith(OCI_SCHEME):
+            default_type = OCI_REPO_TYPE
+        repo_type = repo.get(TYPE_KEY, default_type)
+        known_types = (HELM_REPO_TYPE, OCI_REPO_TYPE) + tuple(UPLOADERS)
+        if repo_type not in known_types:
+            error(Errors.invalid_value(TYPE_KEY, repo_type), parents=parents, index=i)
+            continue
+        repo_objs.append(
+            Repo(
+                name=name,
+                remote=remote,
+                username=username,
+                password=password,
+                repo_type=repo_type,
+            )
+        )
+    return repo_objs
+
+
+def get_repos(repos, parents):
+    """Configures helm repositories
+
+    :param repos: repos configuration
+    :type repos: Dict
+    :param parents: list of parent keys in the configuration
+        to be used for constructing appropriate error messages
+        for configuration errors
+    :type parents: [str]
+    """
+    g_username, g_password = repos[USERNAME_KEY], repos[PASSWORD_KEY]
+    parents.append(REPOS_ADD_KEY)
+    repos_to_add = repos.get(REPOS_ADD_KEY, [])
+    return get_repo_objs(repos_to_add, g_username, g_password, parents=parents)
+
+
+def get_charts(charts, global_fetch_policy):
+    """Get all Chart objects loaded from charts configuration
+
+    :param charts: charts section in configuration
+    :type charts: Dict
+    :param global_fetch_policy: global chart fetch policy
+        to be used if the chart local fetch policy
+        is not specified
+    :type global_fetch_policy: bool
+    :return: list of Charts
+    :rtype: [Chart]
+    """
+    return list(iter_charts(charts, global_fetch_policy))
+
+
+def iter_charts(charts, global_fetch_policy):
+    """Yields Chart objects of the charts configuration one
+    version at a time as they are consumed
+
+    :param charts: charts section in configuration
+    :type charts: Dict
+    :param global_fetch_policy: global chart fetch policy
+        to be used if the chart local fetch policy
+        is not specified
+    :type global_fetch_policy: bool
+    :rtype: Iterator[Chart]
+    """
+    for chart_i, chart in enumerate(charts):
+        chart_fetch_policy = chart.get(FETCH_KEY, global_fetch_policy)
+        chart_values = chart.get(VALUES_KEY, {})
+        chart_name = chart.get(NAME_KEY)
+        repo_name = chart.get(REPO_KEY)
+        chart_scripts = chart.get(SCRIPTS_KEY, [])
+        chart_push_targets = chart.get(PUSH_KEY, [])
+        chart_values_matrix = chart.get(VALUES_MATRIX_KEY, [])
+        if not chart_name:
+            err = get_error_type(NAME_KEY, chart_name, chart)
+            error(err, parents=[CHARTS_KEY], index=chart_i)
+            continue
+        if not repo_name:
+            err = get_error_type(REPO_KEY, repo_name, chart)
+            error(err, parents=[CHARTS_KEY], index=chart_i)
+            continue
+        # charts with a version pattern need not list any versions
+        for version_i, version in enumerate(chart.get(VERSIONS_KEY) or []):
+            version_fetch_policy = version.get(FETCH_KEY, chart_fetch_policy)
+            version_str = version.get(VERION_KEY)
+            if not version_str:
+                err = get_error_type(VERION_KEY, version_str, version)
+                error(err, parents=[CHARTS_KEY, VERSIONS_KEY], index=version_i)
+                continue
+            local_dir = version.get(FETCH_DIR_KEY) or "/tmp/{}/{}/{}".format(
+                repo_name, chart_name, version_i
+            )
+            version_values = version.get(VALUES_KEY, chart_values)
+            version_push_targets = version.get(PUSH_KEY, chart_push_targets)
+            version_values_matrix = version.get(
+                VALUES_MATRIX_KEY, chart_values_matrix
+            )
+            yield Chart(
+                repo_name=repo_name,
+                chart_name=chart_name,
+                version=version_str,
+                local_dir=local_dir,
+                fetch_policy=version_fetch_policy,
+                values=version_values,
+                push=version_push_targets,
+                scripts=chart_scripts,
+                values_matrix=version_values_matrix,
+            )
+
+
+def set_chart_sources(charts, repos):
+    """Associates charts with the OCI registries they are hosted in
+
+    :param charts: list of charts
+    :type charts: [Chart]
+    :param repos: list of helm repositories configured globally
+    :type repos: [Repo]
+    """
+    repo_map = list_to_dict(repos, "name")
+    for chart in charts:
+        repo = repo_map.get(chart.repo_name)
+        if repo and repo.is_oci():
+            chart.source_repo = repo
+
+
+def get_all_images(charts, workers=DEFAULT_WORKERS):
+    """Get all images from the charts
+
+    :param charts: List of Chart objects
+    :type charts: [Chart]
+    :param workers: maximum number of value sets of a chart
+        rendered concurrently, defaults to DEFAULT_WORKERS
+    :type workers: int, optional
+    :return: list of images
+    :rtype: [str]
+    """
+    return set().union(*get_chart_images(charts, workers=workers).values())
+
+
+def render_key(chart):
+    """Returns the key of the chart version and values it is
+    rendered with, charts with the same key have the same images"""
+    return (
+        chart.combined_name,
+        json.dumps(chart.values, sort_keys=True),
+        json.dumps(chart.values_matrix, sort_keys=True),
+    )
+
+
+def get_chart_images(charts, workers=DEFAULT_WORKERS, failures=None):
+    """Get images of each chart. Charts configured more than once
+    with the same values are rendered once
+
+    :param charts: List of Chart objects
+    :type charts: [Chart]
+    :param workers: maximum number of value sets of a chart
+        rendered concurrently, defaults to DEFAULT_WORKERS
+    :type workers: int, optional
+    :param failures: dictionary the error of each chart that could not
+        be fetched or rendered is added to. Defaults to None in which
+        case the first error is raised
+    :type failures: Dict, optional
+    :return: dictionary mapping render key of the charts to their images
+    :rtype: Dict
+    """
+    images = {}
+    for chart in charts:
+        key = render_key(chart)
+        if key in images or (failures is not None and chart.combined_name in failures):
+            continue
+        try:
+            with EVENTS.timed("chart_fetch", chart.combined_name):
+                chart.fetch()
+            images[key] = chart.images(workers=workers)
+        except subprocess.CalledProcessError as exp:
+            if failures is None:
+                raise
+            if DEBUG:
+                failures[chart.combined_name] = str(exp.stderr, "utf-8")
+            else:
+                failures[chart.combined_name] = "Unable to render chart. {}".format(
+                    DEBUG_HELP_MSG)
+    return images
+
+
+def get_error_type(key, value, obj):
+    if key not in obj:
+        return Errors.missing_required_key(key)
+    return Errors.invalid_value(key, value)
+
+
+def list_to_dict(lst, key):
+    """Convert list of objects to a dictionary mapping
+    given key in the object to object for faster queries
+
+    :param lst: list of objects. object must contain given key as attribute
+    :type lst: [Any]
+    :param key: Name of the key attribute in the object
+    :type key: str
+    :return: Dictionary mapping the key attribute from each object to the object
+    :rtype: Dict
+    """    
+    result = {}
+    for obj in lst:
+        result[getattr(obj, key)] = obj
+    return result
+
+
+def get_registries(registries, g_push, g_retain, parents=[]):
+    """Get Registry objects instantiated from given registries
+    configuration
+
+    :param registries: list of destination registry configurations
+    :type registries: [Dict]
+    :param g_push: global push policy
+    :type g_push: bool
+    :param g_retain: global retain policy
+    :type g_retain: bool
+    :param parents: list of parent keys in the configuration
+        to be used for constructing appropriate error messages
+        for configuration errors
+    :type parents: [str]
+    :return: list of Registry objects
+    :rtype: [Registry]
+    """
+    registry_objs = []
+    for i, registry in enumerate(registries):
+        registry_name = registry.get(NAME_KEY)
+        if not registry_name:
+            err = get_error_type(NAME_KEY, registry_name, registry)
+            error(err, parents=parents, index=i)
+            continue
+        push = registry.get(PUSH_KEY, g_push)
+        retain = registry.get(RETAIN_KEY, g_retain)
+        registry_objs.append(
+            Registry(
+                name=registry_name,
+                push=push,
+                retain=retain,
+            )
+        )
+    return registry_objs
+
+
+class ImageSelector:
+    """Tags of a repository to be mirrored without being
+    referenced by a chart"""
+
+    def __init__(self, repository, patterns):
+        self.repository = repository
+        self.patterns = patterns
+
+    def matches(self, tag):
+        return any(fnmatch.fnmatchcase(tag, pattern) for pattern in self.patterns)
+
+
+def get_image_selectors(selectors, parents=[]):
+    """Get ImageSelector objects instantiated from given
+    images configuration
+
+    :param selectors: list of repository and tag patterns
+    :type selectors: [Dict]
+    :param parents: list of parent keys in the configuration
+        to be used for constructing appropriate error messages
+        for configuration errors
+    :type parents: [str]
+    :return: list of ImageSelector objects
+    :rtype: [ImageSelector]
+    """
+    selector_objs = []
+    for i, selector in enumerate(selectors):
+        repository = selector.get(REPOSITORY_KEY)
+        if not repository or ":" in repository.split("/")[-1] or "@" in repository:
+            err = get_error_type(REPOSITORY_KEY, repository, selector)
+            error(err, parents=parents, index=i)
+            continue
+        tags = selector.get(TAGS_KEY)
+        if not tags or not isinstance(tags, list):
+            error(get_error_type(TAGS_KEY, tags, selector), parents=parents, index=i)
+            continue
+        selector_objs.append(ImageSelector(repository, [str(tag) for tag in tags]))
+    return selector_objs
+
+
+def select_images(selectors, registries, shard=None):
+    """Finds the tags matching given selectors that are missing from
+    the registries images are pushed to. Only the tag lists of the
+    source and target repositories are requested
+
+    :param selectors: list of ImageSelectors
+    :type selectors: [ImageSelector]
+    :param registries: target registries
+    :type registries: [Registry]
+    :param shard: (index, count) of the shard of the work
+        to be processed, defaults to None
+    :type shard: (int, int), optional
+    :return: dictionary mapping registry name to the selected images
+        missing from it, tag status and True if a tag list could not
+        be fetched
+    :rtype: (Dict, Dict, bool)
+    """
+    missing = {registry.name: set() for registry in registries}
+    status = {}
+    err = False
+    for selector in selectors:
+        try:
+            with EVENTS.timed("tag_list", selector.repository):
+                tags = list_tags(selector.repository)
+        except (OSError, ValueError) as e:
+            status[selector.repository] = {"Failed to list tags": str(e)}
+            err = True
+            continue
+        matched = {
+            tag for tag in tags if selector.matches(tag)
+            and in_shard(canonical_image("{}:{}".format(selector.repository, tag)), shard)
+        }
+        status[selector.repository] = {"Matched": sorted(matched)}
+        for registry in registries:
+            if not registry.push:
+                continue
+            target = registry.target_name(selector.repository)
+            try:
+                with EVENTS.timed("tag_list", target):
+                    to_push = matched - list_tags(target)
+            except (OSError, ValueError) as e:
+                status[selector.repository][registry.name] = {
+                    "Failed to list tags": str(e)
+                }
+                err = True
+                continue
+            status[selector.repository][registry.name] = sorted(to_push)
+            missing[registry.name] |= {
+                "{}:{}".format(selector.repository, tag) for tag in to_push
+            }
+    return missing, status, err
+
+
+def platform_manifest(client, repository, reference):
+    """Downloads given image manifest. For multi-arch images the
+    manifest of the platform of this host is returned as that is
+    the one docker pulls
+
+    :return: (media type, body, digest) or None if the
+        manifest does not exist
+    :rtype: (str, bytes, str)
+
+    :raises: OSError
+    """
+    manifest = client.get_manifest(repository, reference)
+    if not manifest or manifest[0] not in MANIFEST_LIST_MEDIA_TYPES:
+        return manifest
+    platforms = json.loads(manifest[1]).get("manifests", [])
+    arch = PLATFORM_ARCHITECTURES.get(os.uname().machine, os.uname().machine)
+    platform = next(
+        (m for m in platforms if m.get("platform", {}).get("architecture") == arch),
+        None,
+    )
+    return platform and client.get_manifest(repository, platform["digest"])
+
+
+def load_image(image, cancel=None):
+    """Pulls given image through the local blob store. Its blobs are
+    read from the store or downloaded into it and loaded into the
+    docker daemon as an image archive, so that other runs on the same
+    host do not download them again
+
+    :param image: image reference
+    :type image: str
+    :param cancel: event cancelling the load, defaults to None
+    :type cancel: threading.Event, optional
+
+    :raises: OSError, subprocess.CalledProcessError
+    """
+    host, repository, reference = parse_image_reference(image)
+    client = get_registry_client(host)
+    manifest = platform_manifest(client, repository, reference)
+    if not manifest:
+        raise OSError("manifest of image {} not found".format(image))
+    content = json.loads(manifest[1])
+    if "config" not in content:
+        raise OSError("unsupported manifest of image {}".format(image))
+    config = client.cached_blob(repository, content["config"]["digest"])
+    layers = [
+        client.cached_blob(repository, layer["digest"])
+        for layer in content.get("layers", [])
+    ]
+    # the archive is laid out like the output of docker save, which
+    # only names images by their full reference including the tag
+    archive_manifest = [{
+        "Config": os.path.basename(config) + ".json",
+        "RepoTags": ["{}/{}:{}".format(host, repository, reference)],
+        "Layers": [os.path.basename(layer) + ".tar" for layer in layers],
+    }]
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "image.tar")
+        with tarfile.open(path, "w") as tar:
+            tar.add(config, arcname=archive_manifest[0]["Config"])
+            for layer, name in zip(layers, archive_manifest[0]["Layers"]):
+                if name not in tar.getnames():
+                    tar.add(layer, arcname=name)
+            data = json.dumps(archive_manifest).encode()
+            info = tarfile.TarInfo("manifest.json")
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+        docker("load --input " + shlex.quote(path), cancel=cancel)
+
+
+def pull_images(images, workers=1, use_store=False):
+    """Pull given images. If use_store is True and the blob store is
+    configured, images referenced by tag are pulled through it and
+    images that can not be read through the registry API or loaded
+    are pulled by docker
+
+    :param images: list of images
+    :type images: [str]
+    :param workers: number of concurrent pulls, defaults to 1
+    :type workers: int, optional
+    :param use_store: pull images through the blob store, defaults
+        to False
+    :type use_store: bool, optional
+    :return: images that could not be pulled
+    :rtype: set(str)
+    """
+
+    def pull(image):
+        def attempt(cancel):
+            # archives can only name images by tag
+            if use_store and BLOB_STORE and "@" not in image:
+                try:
+                    return load_image(image, cancel=cancel)
+                except CommandTimeout:
+                    raise
+                except (
+                    OSError, ValueError, KeyError, subprocess.CalledProcessError
+                ) as e:
+                    debug("Unable to pull image", image, "through the blob store", e)
+            return docker("pull {}".format(image), cancel=cancel)
+
+        try:
+            with EVENTS.timed("image_pull", image) as event:
+                if PULL_HEDGER:
+                    PULL_HEDGER.run(attempt)
+                else:
+                    attempt(None)
+                event["bytes"] = image_size(image)
+        except subprocess.CalledProcessError:
+            print("Unable to pull image", image)
+            return image
+        return None
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return {image for image in executor.map(pull, images) if image}
+
+
+def push_images_to_registries(images, registries, present={}, layers={}, workers=1):
+    """Pushes all given images to given registries. Images are pushed
+    in waves such that each layer shared between images is uploaded
+    once before the images reusing it are pushed
+
+    :param images: list of images
+    :type images: [str]
+    :param registries: list of Regitries
+    :type registries: [Registry]
+    :param present: dictionary mapping registry name to images
+        that are already present in the registry and need not
+        be pushed again, defaults to {}
+    :type present: Dict, optional
+    :param layers: dictionary mapping image to its layer digests
+        and sizes, defaults to {}
+    :type layers: Dict, optional
+    :param workers: number of concurrent pushes, defaults to 1
+    :type workers: int, optional
+    :return: dictionary containing success and failures information
+        and boolean indicating if any failures have occurred
+    :rtype: Dict, bool
+    """
+    failures = {}
+    err = False
+    for registry in registries:
+        skipped = set(images) & present.get(registry.name, set())
+        to_push = set(images) - skipped
+        waves = plan_push_order({image: layers.get(image, {}) for image in to_push})
+        pushed, tf, pf, cf = registry.tag_and_push(to_push, waves, workers)
+        failures[registry.name] = {
+            "Already present": list(skipped),
+            "Pushed": list(pushed),
+            "Failed to tag": list(tf),
+            "Failed to push": list(pf),
+            "Failed to cleanup": list(cf),
+        }
+        # pushes run one at a time find shared layers regardless of order
+        saved = registry.push and workers > 1 and reused_layer_bytes(
+            waves, layers,
+            {image for image in to_push if registry.target_name(image) in pushed},
+        )
+        if saved:
+            failures[registry.name]["Uncompressed bytes saved by layer reuse"] = saved
+        err = err or bool(tf or pf or cf)
+    return failures, err
+
+
+def pull_chart(chart):
+    """Pulls the chart archive to be pushed to target repositories
+
+    :param chart: chart to be pulled
+    :type chart: Chart
+    :return: error message or None if the chart was pulled
+    :rtype: str
+    """
+    try:
+        with EVENTS.timed("chart_pull", chart.combined_name) as event:
+            chart.pull()
+            if os.path.isfile(chart.archive_path()):
+                event["bytes"] = os.path.getsize(chart.archive_path())
+    except subprocess.CalledProcessError as exp:
+        if DEBUG:
+            return str(exp.stderr, 'utf-8')
+        return "Unable to pull chart. {}".format(DEBUG_HELP_MSG)
+    return None
+
+
+def push_chart(chart, repo):
+    """Pushes chart to given repository unless the repository
+    already has the same chart version with the same digest
+
+    :param chart: chart to be pushed
+    :type chart: Chart
+    :param repo: target repository
+    :type repo: Repo
+    :return: status of the push and error message if any
+    :rtype: (str, str)
+    """
+    try:
+        with EVENTS.timed("chart_push", chart.combined_name, repo=repo.name) as event:
+            if repo.is_oci():
+                published = not push_oci_chart(chart, repo)
+            else:
+                digest = published_digest(repo, chart.chart_name, chart.version)
+                published = digest == chart.digest()
+                if not published:
+                    chart.push(repo)
+            if published:
+                event["status"] = "skipped"
+            elif os.path.isfile(chart.archive_path()):
+                event["bytes"] = os.path.getsize(chart.archive_path())
+    except subprocess.CalledProcessError as exp:
+        if DEBUG:
+            return None, str(exp.stderr, 'utf-8')
+        return None, "Unable to push chart. {}".format(DEBUG_HELP_MSG)
+    except (UploadError, OSError) as exp:
+        return None, "Unable to push chart. {}".format(exp)
+    if published:
+        print("Chart {} is already published to {} repository".format(
+            chart.combined_name, repo.name))
+        return "Already published", None
+    return "Pushed", None
+
+
+def needs_archive(chart, repo_map):
+    """Returns True if pushing given chart to its target repositories
+    needs the chart archive. Charts hosted in OCI registries are
+    copied registry to registry to other OCI registries
+
+    :param chart: chart to be pushed
+    :type chart: Chart
+    :param repo_map: dictionary mapping repository name to Repo
+    :type repo_map: Dict
+    :rtype: bool
+    """
+    if not chart.source_repo:
+        return True
+    return any(
+        name in repo_map and not repo_map[name].is_oci() for name in chart.push_targets
+    )
+
+
+def reconcile_charts(
+    charts, repos, workers=DEFAULT_WORKERS, script_timeout=None, script_cache=None
+):
+    """Runs chart scripts and pushes given charts to specified
+    target helm repositories
+
+    :param charts: list of charts
+    :type charts: [Chart]
+    :param repos: list of helm repositories configured globally
+    :type repos: [Repo]
+    :param workers: maximum number of charts whose scripts are run, or
+        that are pulled or pushed concurrently, defaults to DEFAULT_WORKERS
+    :type workers: int, optional
+    :param script_timeout: seconds after which a chart script is
+        killed, defaults to None
+    :type script_timeout: float, optional
+    :param script_cache: script runs that need not be repeated,
+        defaults to None
+    :type script_cache: ScriptCache, optional
+    """
+    status = {}
+    repo_map = list_to_dict(repos, "name")
+    err = False
+    charts = [chart for chart in charts if chart.scripts or chart.push_targets]
+    for chart in charts:
+        status[chart.combined_name] = {}
+    to_run = [chart for chart in charts if chart.scripts]
+    # Push chart to other repositories if configured
+    to_push = [chart for chart in charts if chart.push_targets]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # Run chart scripts, scripts of a chart are run in order
+        results = executor.map(
+            lambda chart: chart.run_scripts(script_timeout, script_cache), to_run
+        )
+        for chart, (failed, durations) in zip(to_run, results):
+            stat = status[chart.combined_name]
+            if failed:
+                err = True
+            stat["Failed scripts"] = failed
+            stat["Script durations"] = durations
+        if script_cache:
+            script_cache.save()
+
+        # Pull the charts, charts copied registry to registry are not needed
+        to_pull = [chart for chart in to_push if needs_archive(chart, repo_map)]
+        pull_errors = dict(zip(map(id, to_pull), executor.map(pull_chart, to_pull)))
+        pushes = {}
+        for chart in to_push:
+            stat = status[chart.combined_name]
+            if pull_errors.get(id(chart)):
+                stat["pull"] = pull_errors[id(chart)]
+                err = True
+                continue
+            if id(chart) in pull_errors:
+                stat["pull"] = "Pulled succesfully"
+            stat["Pushed"] = []
+            stat["Already published"] = []
+            stat["Failed to push"] = {}
+            # Push the chart to target repositories
+            for repo_name in chart.push_targets:
+                if repo_name not in repo_map:
+                    stat["Failed to push"][repo_name] = (
+                        "Repository is not configured under repos section. "
+                        "Please configure it and retry."
+                    )
+                    err = True
+                    continue
+                future = executor.submit(push_chart, chart, repo_map[repo_name])
+                pushes[future] = (chart, repo_name)
+        for future in as_completed(pushes):
+            chart, repo_name = pushes[future]
+            stat = status[chart.combined_name]
+            result, msg = future.result()
+            if msg:
+                err = True
+                stat["Failed to push"][repo_name] = msg
+            else:
+                stat[result].append(repo_name)
+    return status, err
+
+
+def configure_repos(repos, update=True):
+    """Configures given helm repositories
+
+    :param repos: list of Repos
+    :type repos: [Repo]
+    :param update: `helm repo update` is run if True,
+        defaults to True
+    :type update: bool, optional
+    """
+    status = {}
+    err = False
+    for repo in repos:
+        if repo.is_oci():
+            # OCI registries are accessed directly and need not be added,
+            # helm fetches charts from private ones once logged in
+            if repo.username and repo.password:
+                print("Logging in to OCI registry of repository", repo.name)
+                try:
+                    with EVENTS.timed("registry_login", repo.name):
+                        repo.login()
+                except subprocess.CalledProcessError:
+                    status[repo.name] = "Unable to log in to OCI registry. Please check logs."
+                    err = True
+            continue
+        print("Configuring helm repository", repo.name)
+        try:
+            with EVENTS.timed("repo_add", repo.name):
+                repo.add()
+        except subprocess.CalledProcessError as e:
+            status[repo.name] = f"Unable to add helm repository. Please check logs."
+            err = True        
+    if any(not repo.is_oci() for repo in repos) and update:
+        print("Updating helm repositories")
+        try:
+            helm("repo update")
+        except subprocess.CalledProcessError as e:
+            print("helm repo update failed")
+            err = True
+    return status, err
+
+
+def print_dict(failures):
+    """Prints failres if any
+
+    :param failures: Dictionary of failures
+        mapping failure type and failed items
+    :type failures: Dict
+    """
+    failures_copy = dict(failures)
+    for msg, items in failures.items():
+        if not items:
+            del failures_copy[msg]
+    print(json.dumps(failures_copy, indent=4, default=sorted))
+
+
+def print_report(report):
+    """Prints each non empty section of the status report
+
+    :param report: Dictionary mapping section title to section status
+    :type report: Dict
+    """
+    for section, status in report.items():
+        if status:
+            print("{:=^50}".format(" {} ".format(section)))
+            print_dict(status)
+
+
+def save_report(report, file):
+    """Saves status report as json to given file
+
+    :param report: status report
+    :type report: Dict
+    :param file: path of the report file
+    :type file: str
+    """
+    with open(file, "w") as f:
+        json.dump(report, f, indent=4, default=sorted)
+
+
+def merge_status(a, b):
+    """Merges two status entries. Dictionaries are merged key by
+    key, lists are combined without duplicates and counters such as
+    cache hits or bytes saved are added up
+
+    :return: merged status
+    :rtype: Any
+    """
+    if isinstance(a, dict) and isinstance(b, dict):
+        merged = dict(a)
+        for key, value in b.items():
+            merged[key] = merge_status(merged[key], value) if key in merged else value
+        if "Hit ratio" in merged and "Hits" in merged and "Misses" in merged:
+            # ratios are not additive, recompute from the merged counters
+            lookups = merged["Hits"] + merged["Misses"]
+            merged["Hit ratio"] = round(merged["Hits"] / lookups, 3) if lookups else 0
+        return merged
+    if isinstance(a, list) and isinstance(b, list):
+        return a + [item for item in b if item not in a]
+    if all(isinstance(value, (int, float)) and not isinstance(value, bool)
+           for value in (a, b)):
+        return a + b
+    return b if b else a
+
+
+def merge_reports(reports):
+    """Combines status reports of several shards into one report
+
+    :param reports: list of status reports
+    :type reports: [Dict]
+    :return: merged status report
+    :rtype: Dict
+    """
+    merged = {}
+    for report in reports:
+        merged = merge_status(merged, report)
+    return merged
+
+
+def parse_shard(value):
+    """Parses shard specification of the form i/N where
+    i is the 1-based index of the shard out of N shards
+
+    :param value: shard specification. e.g. 2/4
+    :type value: str
+    :return: (index, count)
+    :rtype: (int, int)
+
+    :raises: argparse.ArgumentTypeError
+    """
+    try:
+        index, count = (int(token) for token in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(Errors.invalid_value("shard", value))
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(Errors.invalid_value("shard", value))
+    return index, count
+
+
+def in_shard(key, shard):
+    """Deterministically decides if the work item identified by key
+    belongs to given shard
+
+    :param key: canonical identifier of the work item
+    :type key: str
+    :param shard: (index, count) or None if the run is not sharded
+    :type shard: (int, int)
+    :rtype: bool
+    """
+    if not shard:
+        return True
+    index, count = shard
+    bucket = int(hashlib.sha256(key.encode()).hexdigest(), 16) % count
+    return bucket == index - 1
+
+
+def canonical_image(image):
+    """Returns fully qualified form of given image reference
+    so that equivalent references hash to the same shard
+
+    :param image: image reference
+    :type image: str
+    :rtype: str
+    """
+    host, repository, reference = parse_image_reference(image)
+    separator = "@" if reference.startswith("sha256:") else ":"
+    return "{}/{}{}{}".format(host, repository, separator, reference)
+
+
+def setup(config, repos=None):
+    """Runs initialization scripts and configures helm repositories
+    and image rules of given configuration
+
+    :param config: loaded configuration
+    :type config: Dict
+    :param repos: repositories to be configured instead of
+        the ones in the configuration, defaults to None
+    :type repos: [Repo], optional
+    :return: configured repositories, their status and True if
+        any repository could not be configured
+    :rtype: ([Repo], Dict, bool)
+    """
+    global IMAGE_EXTRACTOR, TIMEOUTS, STALL_TIMEOUT, PULL_HEDGER, BLOB_STORE, TAG_CACHE
+    TIMEOUTS = get_timeouts(config.get(TIMEOUTS_KEY), parents=[TIMEOUTS_KEY])
+    STALL_TIMEOUT = config.get(STALL_TIMEOUT_KEY)
+    # blob and chart transfers over HTTP stall when no bytes move
+    HTTP_SESSION.timeout = STALL_TIMEOUT or HTTP_TIMEOUT
+    if config.get(HEDGE_PERCENTILE_KEY):
+        PULL_HEDGER = Hedger(config[HEDGE_PERCENTILE_KEY])
+    BLOB_STORE = get_blob_store(config.get(BLOB_CACHE_KEY), parents=[BLOB_CACHE_KEY])
+    TAG_CACHE = get_tag_cache(config.get(TAG_CACHE_KEY), parents=[TAG_CACHE_KEY])
+    # Run initialization scripts
+    init_scripts = config.get(INIT_SCRIPTS_KEY, [])
+    run_init_scripts(init_scripts)
+
+    # Configure repos
+    repos_config = config.get(REPOS_KEY, {})
+    repo_status = {}
+    err = False
+    if repos is None:
+        repos = []
+        if repos_config:
+            repos = get_repos(repos_config, parents=[REPOS_KEY])
+    if repos:
+        repo_status, err = configure_repos(repos)
+    IMAGE_EXTRACTOR = ImageExtractor(get_image_rules(
+        config.get(IMAGE_RULES_KEY, []), parents=[IMAGE_RULES_KEY]
+    ))
+    return repos, repo_status, err
+
+
+def mirror_images(targets, registries, skip_existing=True, workers=1, missing={}):
+    """Pulls images once and pushes them to the registries
+    they are to be mirrored to
+
+    :param targets: dictionary mapping registry name to
+        the images to be pushed to it
+    :type targets: Dict
+    :param registries: target registries
+    :type registries: [Registry]
+    :param skip_existing: skip images whose digest is already
+        present in the target registry, defaults to True
+    :type skip_existing: bool, optional
+    :param workers: number of concurrent pulls and pushes, defaults to 1
+    :type workers: int, optional
+    :param missing: dictionary mapping registry name to images known
+        to be missing from it which need not be checked, defaults to {}
+    :type missing: Dict, optional
+    :return: image status and True if any failures have occurred
+    :rtype: (Dict, bool)
+    """
+    images = set().union(*targets.values())
+    present = {}
+    if skip_existing:
+        present = find_present_images(images, registries, {
+            name: targets[name] - missing.get(name, set()) for name in targets
+        })
+    # images present in every registry they are pushed to need not be pulled
+    push_registries = [registry.name for registry in registries if registry.push]
+    already_present = set()
+    if present and push_registries:
+        already_present = images - set().union(*(
+            targets[name] - present[name] for name in push_registries
+        ))
+    # docker does not keep the compressed layers of loaded images and
+    # pushes them with new digests, which would never match the source
+    # digests existing images are detected by
+    failed_to_pull = pull_images(
+        images - already_present, workers=workers, use_store=not skip_existing
+    )
+    pulled_images = images - already_present - failed_to_pull
+    # shared layers are uploaded once before the images reusing them
+    layers = get_image_layers(pulled_images, workers=workers)
+    failures = {}
+    push_err = False
+    for registry in registries:
+        status, registry_err = push_images_to_registries(
+            pulled_images & targets[registry.name], [registry], present,
+            layers=layers, workers=workers,
+        )
+        # images present in every target registry were not pulled
+        status[registry.name]["Already present"] = list(
+            targets[registry.name] & present.get(registry.name, set())
+        )
+        failures.update(status)
+        push_err = push_err or registry_err
+        if TAG_CACHE:
+            for target in status[registry.name]["Pushed"]:
+                TAG_CACHE.add(target)
+    status = {
+        "All images": list(images),
+        "Already present": list(already_present),
+        "Failed to pull": list(failed_to_pull),
+        **failures,
+    }
+    if PULL_HEDGER:
+        status["Hedged pulls"] = PULL_HEDGER.hedged
+    return status, bool(failed_to_pull or push_err)
+
+
+def mirror(config, charts, repos, shard=None):
+    """Mirrors images referenced in given charts to the configured
+    registries and pushes the charts to their target repositories
+
+    :param config: loaded configuration
+    :type config: Dict
+    :param charts: charts to be mirrored
+    :type charts: [Chart]
+    :param repos: list of helm repositories configured globally
+    :type repos: [Repo]
+    :param shard: (index, count) of the shard of the work
+        to be processed, defaults to None
+    :type shard: (int, int), optional
+    :return: status report and True if any failures have occurred
+    :rtype: (Dict, bool)
+    """
+    err = False
+    report = {}
+    set_chart_sources(charts, repos)
+    workers = config.get(WORKERS_KEY, DEFAULT_WORKERS)
+    render_failures = {}
+    chart_images = {}
+    failed = set()
+
+    # Retag and push images
+    registry_config = config.get(REGISTRIES_KEY, [])
+    if registry_config:
+        print("Retagging and pushing images to destinations")
+        # every shard renders all charts but only mirrors its own images
+        chart_images = get_chart_images(charts, workers=workers, failures=render_failures)
+        images = {
+            image for image in set().union(*chart_images.values())
+            if in_shard(canonical_image(image), shard)
+        }
+        g_retain = config.get(RETAIN_KEY, False)
+        g_push = config.get(PUSH_KEY, True)
+        registries = get_registries(
+            registry_config, g_retain=g_retain, g_push=g_push, parents=[REGISTRIES_KEY]
+        )
+        targets = {registry.name: set(images) for registry in registries}
+        selected = {}
+        selectors = get_image_selectors(
+            config.get(IMAGES_KEY) or [], parents=[IMAGES_KEY]
+        )
+        if selectors:
+            selected, report["Tag Status"], err = select_images(
+                selectors, registries, shard
+            )
+            for name in selected:
+                targets[name] |= selected[name]
+        report["Image Status"], image_err = mirror_images(
+            targets, registries, config.get(SKIP_EXISTING_KEY, True), workers,
+            missing=selected,
+        )
+        err = err or image_err or bool(render_failures)
+        failed = failed_images(report["Image Status"], registries)
+
+    # push charts to target helm repositories, charts whose images
+    # could not be found are not pushed
+    charts = [
+        chart for chart in charts if in_shard(chart.combined_name, shard)
+        and chart.combined_name not in render_failures
+    ]
+    script_cache = None
+    if config.get(SCRIPT_CACHE_KEY):
+        script_cache = ScriptCache(config[SCRIPT_CACHE_KEY])
+    chart_push_status, chart_err = reconcile_charts(
+        charts, repos, workers=workers,
+        script_timeout=config.get(SCRIPT_TIMEOUT_KEY),
+        script_cache=script_cache,
+    )
+    for name, msg in render_failures.items():
+        chart_push_status[name] = {"render": msg}
+    for chart in charts:
+        chart_failed = sorted(chart_images.get(render_key(chart), set()) & failed)
+        if chart_failed:
+            chart_push_status.setdefault(chart.combined_name, {})
+            chart_push_status[chart.combined_name]["Failed images"] = chart_failed
+    report["Chart Status"] = chart_push_status
+    if BLOB_STORE:
+        report["Blob Cache Status"] = BLOB_STORE.summary()
+    if TAG_CACHE:
+        TAG_CACHE.save()
+        report["Tag Cache Status"] = TAG_CACHE.summary()
+    return report, err or chart_err
+
+
+def failed_images(image_status, registries):
+    """Returns the source images that could not be pulled,
+    tagged or pushed to any of the registries
+
+    :param image_status: image status reported by mirror_images
+    :type image_status: Dict
+    :param registries: target registries
+    :type registries: [Registry]
+    :rtype: set(str)
+    """
+    failed = set(image_status.get("Failed to pull", []))
+    for registry in registries:
+        status = image_status.get(registry.name, {})
+        failed.update(image for image, _ in status.get("Failed to tag", []))
+        push_failures = set(status.get("Failed to push", []))
+        failed.update(
+            image for image in image_status.get("All images", [])
+            if registry.target_name(image) in push_failures
+        )
+    return failed
+
+
+def chart_failed(status):
+    """Returns True if the chart version with given status in
+    the status report could not be mirrored completely
+
+    :param status: status of the chart version
+    :type status: Dict
+    :rtype: bool
+    """
+    return bool(
+        status.get("render") or status.get("Failed images")
+        or status.get("Failed scripts") or status.get("Failed to push")
+        # the chart could not be pulled
+        or ("pull" in status and "Pushed" not in status)
+    )
+
+
+def main(file, shard=None, report_file=None):
+    """Main function
+
+    :param file: configuration file path
+    :type file: str
+    :param shard: (index, count) of the shard of the work
+        to be processed by this invocation, defaults to None
+    :type shard: (int, int), optional
+    :param report_file: path of the file status report is
+        saved to as json, defaults to None
+    :type report_file: str, optional
+    """
+    # Parse configuration
+    config = load_config(file)
+    if not config:
+        return 1
+
+    repos, repo_status, err = setup(config)
+    if err:
+        print_report({"Helm repository Status": repo_status})
+        return 1
+    # fetch charts
+    charts_config = config.get(CHARTS_KEY) or []
+    if not charts_config and not config.get(IMAGES_KEY):
+        print("No charts specified in config")
+        return
+    global_fetch_policy = config.get(FETCH_KEY, True)
+    charts_config = charts_config + expand_version_patterns(charts_config, repos)[0]
+    charts = get_charts(charts_config, global_fetch_policy=global_fetch_policy)
+
+    report, err = mirror(config, charts, repos, shard)
+    chart_status = report.pop("Chart Status")
+    report["Helm repository Status"] = repo_status
+    report["Chart Status"] = chart_status
+    print_report(report)
+    if report_file:
+        save_report(report, report_file)
+    EVENTS.finish()
+    if err:
+        return 1
+    return 0
+
+
+def load_configs(paths):
+    """Loads given configuration files. Directories are expanded
+    to the yaml files they contain
+
+    :param paths: configuration file or directory paths
+    :type paths: [str]
+    :return: list of (path, loaded config), None if any
+        configuration could not be loaded
+    :rtype: [(str, Dict)]
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(
+                glob.glob(os.path.join(path, "*.yaml"))
+                + glob.glob(os.path.join(path, "*.yml"))
+            ))
+        else:
+            files.append(path)
+    configs = []
+    for file in files:
+        config = load_config(file)
+        if not config:
+            return None
+        configs.append((file, config))
+    return configs
+
+
+def merge_configs(configs):
+    """Merges settings of several configurations. Repositories are
+    combined by name, initialization scripts and image rules are
+    combined and other settings such as workers are taken from the
+    first configuration that specifies them
+
+    :param configs: list of (path, loaded config)
+    :type configs: [(str, Dict)]
+    :return: merged settings, combined repositories and True if
+        a repository is configured differently in two configurations
+    :rtype: (Dict, [Repo], bool)
+    """
+    merged = {}
+    repos = {}
+    settings = {}
+    err = False
+    for name, config in configs:
+        for key, value in config.items():
+            if key in (INIT_SCRIPTS_KEY, IMAGE_RULES_KEY):
+                items = merged.setdefault(key, [])
+                items.extend(item for item in value or [] if item not in items)
+            elif key not in (REPOS_KEY, CHARTS_KEY, REGISTRIES_KEY):
+                merged.setdefault(key, value)
+        if not config.get(REPOS_KEY):
+            continue
+        for repo in get_repos(config[REPOS_KEY], parents=[REPOS_KEY]):
+            repos.setdefault(repo.name, repo)
+            setting = (repo.remote, repo.username, repo.password, repo.repo_type)
+            if settings.setdefault(repo.name, setting) != setting:
+                error(
+                    "repository {} is configured differently in {}".format(
+                        repo.name, name),
+                    parents=[REPOS_KEY],
+                )
+                err = True
+    return merged, list(repos.values()), err
+
+
+def merge_registries(registries):
+    """Combines registries configured by several configurations by
+    name. Images are pushed and retained if any configuration asks to
+
+    :param registries: lists of registries
+    :type registries: [[Registry]]
+    :rtype: [Registry]
+    """
+    merged = {}
+    for registry in (registry for group in registries for registry in group):
+        if registry.name not in merged:
+            merged[registry.name] = Registry(registry.name, registry.push, registry.retain)
+            continue
+        merged[registry.name].push = merged[registry.name].push or registry.push
+        merged[registry.name].retain = merged[registry.name].retain or registry.retain
+    return list(merged.values())
+
+
+def merge_charts(charts):
+    """Combines chart versions configured more than once. A chart
+    version is pushed to all target repositories and its scripts
+    are run once
+
+    :param charts: List of Chart objects
+    :type charts: [Chart]
+    :rtype: [Chart]
+    """
+    merged = {}
+    for chart in charts:
+        if chart.combined_name not in merged:
+            merged[chart.combined_name] = copy.copy(chart)
+            merged[chart.combined_name].push_targets = list(chart.push_targets)
+            merged[chart.combined_name].scripts = list(chart.scripts)
+            continue
+        combined = merged[chart.combined_name]
+        combined.push_targets.extend(
+            t for t in chart.push_targets if t not in combined.push_targets
+        )
+        combined.scripts.extend(s for s in chart.scripts if s not in combined.scripts)
+    return list(merged.values())
+
+
+def separate_fetch_dirs(charts):
+    """Moves charts of different versions sharing the default fetch
+    directory of their position in the configuration e.g.
+    /tmp/stable/redis/0 to a directory of their version"""
+    owners = {}
+    for chart in charts:
+        owner = owners.setdefault(chart.local_dir, chart.combined_name)
+        if owner != chart.combined_name and chart.fetch_policy:
+            chart.local_dir = "/tmp/{}/{}/{}".format(
+                chart.repo_name, chart.chart_name, chart.version
+            )
+
+
+def filter_status(status, keep, keys):
+    """Returns a copy of given status with only the items
+    of given keys for which keep returns True"""
+    filtered = {}
+    for key, value in status.items():
+        if key in keys and isinstance(value, list):
+            value = [item for item in value if keep(item)]
+        elif key in keys and isinstance(value, dict):
+            value = {item: msg for item, msg in value.items() if keep(item)}
+        filtered[key] = value
+    return filtered
+
+
+def config_report(images, registries, charts, repo_names, image_status,
+                  chart_status, repo_status):
+    """Returns the part of a batch run status report that
+    concerns one of the configurations
+
+    :param images: images of the configuration
+    :type images: set(str)
+    :param registries: registries of the configuration
+    :type registries: [Registry]
+    :param charts: charts of the configuration
+    :type charts: [Chart]
+    :param repo_names: names of the repositories of the configuration
+    :type repo_names: set(str)
+    :rtype: Dict
+    """
+    report = {}
+    if registries:
+        push_registries = [r.name for r in registries if r.push]
+        present = set(images)
+        for name in push_registries:
+            present &= set(image_status[name]["Already present"])
+        report["Image Status"] = {
+            "All images": sorted(images),
+            "Already present": sorted(present) if push_registries else [],
+            "Failed to pull": sorted(set(image_status["Failed to pull"]) & images),
+        }
+        for registry in registries:
+            targets = {registry.target_name(image) for image in images}
+            report["Image Status"][registry.name] = filter_status(
+                image_status[registry.name],
+                lambda item: (item[0] if isinstance(item, tuple) else item)
+                in images | targets,
+                ("Already present", "Pushed", "Failed to tag", "Failed to push",
+                 "Failed to cleanup"),
+            )
+    report["Helm repository Status"] = {
+        name: msg for name, msg in repo_status.items() if name in repo_names
+    }
+    report["Chart Status"] = {}
+    for chart in charts:
+        if chart.combined_name in chart_status:
+            report["Chart Status"][chart.combined_name] = filter_status(
+                chart_status[chart.combined_name],
+                lambda repo_name: repo_name in chart.push_targets,
+                ("Pushed", "Already published", "Failed to push"),
+            )
+    return report
+
+
+def batch(paths, shard=None, report_file=None):
+    """Mirrors the charts and images of several configurations in one
+    run. Repositories are configured once, chart versions configured
+    in several configurations are rendered and pushed once and each
+    image is pulled once and pushed once to each target registry. The
+    status report is broken down per configuration
+
+    :param paths: configuration file or directory paths
+    :type paths: [str]
+    :param shard: (index, count) of the shard of the work
+        to be processed by this invocation, defaults to None
+    :type shard: (int, int), optional
+    :param report_file: path of the file status report is
+        saved to as json, defaults to None
+    :type report_file: str, optional
+    """
+    configs = load_configs(paths)
+    if not configs:
+        return 1
+    config, repos, err = merge_configs(configs)
+    if err:
+        return 1
+    repos, repo_status, err = setup(config, repos)
+    if err:
+        print_report({"Helm repository Status": repo_status})
+        return 1
+    workers = config.get(WORKERS_KEY, DEFAULT_WORKERS)
+
+    charts, registries, selectors, config_repos = {}, {}, {}, {}
+    for name, config_i in configs:
+        charts_config = config_i.get(CHARTS_KEY) or []
+        charts_config = charts_config + expand_version_patterns(charts_config, repos)[0]
+        charts[name] = get_charts(charts_config, config_i.get(FETCH_KEY, True))
+        registries[name] = get_registries(
+            config_i.get(REGISTRIES_KEY, []),
+            g_retain=config_i.get(RETAIN_KEY, False),
+            g_push=config_i.get(PUSH_KEY, True),
+            parents=[REGISTRIES_KEY],
+        )
+        selectors[name] = get_image_selectors(
+            config_i.get(IMAGES_KEY) or [], parents=[IMAGES_KEY]
+        )
+        repos_config = config_i.get(REPOS_KEY) or {}
+        config_repos[name] = {
+            repo.get(NAME_KEY) for repo in repos_config.get(REPOS_ADD_KEY) or []
+        }
+    all_charts = [chart for name in charts for chart in charts[name]]
+    separate_fetch_dirs(all_charts)
+    set_chart_sources(all_charts, repos)
+
+    # every shard renders all charts but only mirrors its own images,
+    # charts that can not be rendered only fail their configurations
+    render_failures = {}
+    chart_images = get_chart_images(all_charts, workers=workers, failures=render_failures)
+    images = {
+        name: {
+            image for chart in charts[name]
+            for image in chart_images.get(render_key(chart), set())
+            if in_shard(canonical_image(image), shard)
+        }
+        for name in charts
+    }
+    merged_registries = merge_registries(registries.values())
+    targets = {registry.name: set() for registry in merged_registries}
+    push_registries = {r.name for r in merged_registries if r.push}
+    configured = 0
+    for name in registries:
+        for registry in registries[name]:
+            # images of configurations that only retag them are not
+            # pushed along with those of configurations pushing them
+            if registry.push or registry.name not in push_registries:
+                targets[registry.name] |= images[name]
+                configured += len(images[name])
+    # only the tags missing from the target registries are pushed
+    selected = {registry.name: set() for registry in merged_registries}
+    tag_status = {}
+    tag_err = False
+    for name in selectors:
+        if not selectors[name]:
+            continue
+        missing, status, err = select_images(selectors[name], registries[name], shard)
+        tag_status[name] = status
+        tag_err = tag_err or err
+        for registry_name, missing_images in missing.items():
+            images[name] |= missing_images
+            selected[registry_name] |= missing_images
+            targets[registry_name] |= missing_images
+            configured += len(missing_images)
+
+    image_status = {}
+    image_err = False
+    if merged_registries:
+        print("Retagging and pushing images to destinations")
+        image_status, image_err = mirror_images(
+            targets, merged_registries, config.get(SKIP_EXISTING_KEY, True), workers,
+            missing=selected,
+        )
+
+    merged_charts = merge_charts([
+        chart for chart in all_charts if in_shard(chart.combined_name, shard)
+        and chart.combined_name not in render_failures
+    ])
+    script_cache = None
+    if config.get(SCRIPT_CACHE_KEY):
+        script_cache = ScriptCache(config[SCRIPT_CACHE_KEY])
+    chart_status, chart_err = reconcile_charts(
+        merged_charts, repos, workers=workers,
+        script_timeout=config.get(SCRIPT_TIMEOUT_KEY),
+        script_cache=script_cache,
+    )
+    for name, msg in render_failures.items():
+        chart_status[name] = {"render": msg}
+    failed = failed_images(image_status, merged_registries) if image_status else set()
+    for chart in merged_charts:
+        chart_failed = sorted(chart_images.get(render_key(chart), set()) & failed)
+        if chart_failed:
+            chart_status.setdefault(chart.combined_name, {})
+            chart_status[chart.combined_name]["Failed images"] = chart_failed
+
+    report = {"Batch Summary": {
+        "Configurations": [name for name, _ in configs],
+        "Chart versions": {
+            "Configured": len(all_charts),
+            "Rendered": len(chart_images),
+            "Reconciled": len(merged_charts),
+        },
+        "Image pushes": {
+            "Configured": configured,
+            "Scheduled": sum(len(names) for names in targets.values()),
+        },
+    }}
+    if BLOB_STORE:
+        report["Batch Summary"]["Blob Cache Status"] = BLOB_STORE.summary()
+    if TAG_CACHE:
+        TAG_CACHE.save()
+        report["Batch Summary"]["Tag Cache Status"] = TAG_CACHE.summary()
+    for name, _ in configs:
+        report[name] = config_report(
+            images[name], registries[name], charts[name], config_repos[name],
+            image_status, chart_status, repo_status,
+        )
+        if tag_status.get(name):
+            report[name]["Tag Status"] = tag_status[name]
+    print_report({"Batch Summary": report["Batch Summary"]})
+    for name, _ in configs:
+        print("{:#^50}".format(" {} ".format(name)))
+        print_report(report[name])
+    if report_file:
+        save_report(report, report_file)
+    EVENTS.finish()
+    if image_err or chart_err or tag_err or render_failures:
+        return 1
+    return 0
+
+
+class Watcher:
+    """Mirrors chart versions matching the version patterns of
+    the charts as they are published to the source repositories"""
+
+    def __init__(self, config, repos, interval, shard=None):
+        self.config = config
+        self.repos = repos
+        self.interval = interval
+        self.shard = shard
+        self.seen = set()
+        # combined name of failed versions -> (attempts, time of next attempt)
+        self.retries = {}
+        self.backlog = 0
+        self.polls = 0
+        self.failed_polls = 0
+        self.started = time.time()
+        self.last_poll = None
+
+    def poll(self):
+        """Mirrors chart versions published since the last poll
+
+        :return: status report of the mirrored charts
+        :rtype: Dict
+        """
+        charts_config = self.config.get(CHARTS_KEY) or []
+        now = time.time()
+        # failed versions are retried once their backoff has passed
+        waiting = {name for name, (_, due) in self.retries.items() if due > now}
+        new, changed = expand_version_patterns(
+            charts_config, self.repos, self.seen | waiting
+        )
+        charts = get_charts(new, self.config.get(FETCH_KEY, True))
+        self.backlog = len(charts)
+        report = {}
+        if charts:
+            print("Found {} new chart versions".format(len(charts)))
+            if changed:
+                # helm resolves chart versions from its own repository cache
+                helm("repo update")
+            # target indexes change with every push e.g. of a retried
+            # version whose chart was pushed while its images failed
+            targets = {target for chart in charts for target in chart.push_targets}
+            for repo in self.repos:
+                if repo.name in targets:
+                    refresh_repo_index(repo)
+            report, err = mirror(self.config, charts, self.repos, self.shard)
+            print_report(report)
+            if err:
+                self.failed_polls += 1
+            chart_status = report.get("Chart Status", {})
+            for chart in charts:
+                name = chart.combined_name
+                if err and chart_failed(chart_status.get(name, {})):
+                    attempts = self.retries.get(name, (0, 0))[0] + 1
+                    delay = min(self.interval * 2 ** (attempts - 1), MAX_RETRY_BACKOFF)
+                    self.retries[name] = (attempts, time.time() + delay)
+                else:
+                    self.retries.pop(name, None)
+                    self.seen.add(name)
+        self.backlog = 0
+        self.polls += 1
+        self.last_poll = time.time()
+        return report
+
+    def run(self, stop):
+        """Polls the source repositories until stop is set
+
+        :param stop: event stopping the watcher
+        :type stop: threading.Event
+        """
+        while not stop.is_set():
+            try:
+                self.poll()
+            except Exception as e:
+                print("Poll failed:", e)
+                self.failed_polls += 1
+            stop.wait(self.interval)
+
+    def healthy(self):
+        """Returns False if the watcher has not completed a poll
+        within three intervals, allowing a minute for the mirroring
+
+        :rtype: bool
+        """
+        last = self.started if self.last_poll is None else self.last_poll
+        return time.time() - last < 3 * self.interval + 60
+
+    def metrics(self):
+        """Returns metrics in prometheus text format
+
+        :rtype: str
+        """
+        summary = EVENTS.summary()
+        lines = [
+            "# TYPE helm_image_mirror_operations_total counter",
+            "# TYPE helm_image_mirror_bytes_total counter",
+        ]
+        for op, stats in sorted(summary["operations"].items()):
+            for status, count in sorted(stats.items()):
+                if status in ("duration", "bytes"):
+                    continue
+                lines.append(
+                    'helm_image_mirror_operations_total{{operation="{}",status="{}"}} {}'
+                    .format(op, status, count)
+                )
+            lines.append('helm_image_mirror_bytes_total{{operation="{}"}} {}'.format(
+                op, stats["bytes"]))
+        lines += [
+            "helm_image_mirror_backlog {}".format(self.backlog),
+            "helm_image_mirror_polls_total {}".format(self.polls),
+            "helm_image_mirror_failed_polls_total {}".format(self.failed_polls),
+            "helm_image_mirror_last_poll_timestamp_seconds {}".format(
+                self.last_poll or 0),
+            "helm_image_mirror_images_per_minute {}".format(
+                summary["images_per_min"]),
+            "helm_image_mirror_megabytes_per_second {}".format(summary["mb_per_s"]),
+        ]
+        return "\n".join(lines) + "\n"
+
+
+def serve_metrics(watcher, port, host="127.0.0.1"):
+    """Serves /healthz and /metrics endpoints of given watcher
+    in a background thread
+
+    :param watcher: watcher to report on
+    :type watcher: Watcher
+    :param port: port to listen on, 0 picks a free port
+    :type port: int
+    :return: the running server
+    :rtype: ThreadingHTTPServer
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            if self.path == "/healthz":
+                status = 200 if watcher.healthy() else 503
+                body = b"ok\n" if status == 200 else b"stalled\n"
+            elif self.path == "/metrics":
+                status, body = 200, watcher.metrics().encode()
+            else:
+                status, body = 404, b""
+            self.send_response(status)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def watch(file, interval, metrics_port=None, shard=None, stop=None):
+    """Runs as a daemon mirroring new chart versions as they are
+    published. Caches of repository indexes, subchart images, registry
+    tokens and blob locations are kept warm between polls
+
+    :param file: configuration file path
+    :type file: str
+    :param interval: seconds between polls
+    :type interval: float
+    :param metrics_port: port of the health and metrics endpoint,
+        defaults to None
+    :type metrics_port: int, optional
+    :param stop: event stopping the daemon, defaults to None
+    :type stop: threading.Event, optional
+    """
+    config = load_config(file)
+    if not config:
+        return 1
+    repos, repo_status, err = setup(config)
+    if err:
+        print_report({"Helm repository Status": repo_status})
+        return 1
+    charts_config = config.get(CHARTS_KEY) or []
+    charts = get_charts(
+        [chart for chart in charts_config if chart.get(VERSIONS_KEY)],
+        config.get(FETCH_KEY, True),
+    )
+    # explicitly configured versions are mirrored once at startup
+    if charts:
+        report, _ = mirror(config, charts, repos, shard)
+        print_report(report)
+    watcher = Watcher(config, repos, interval, shard)
+    server = serve_metrics(watcher, metrics_port) if metrics_port is not None else None
+    stop = stop or threading.Event()
+    print("Watching for new chart versions every {} seconds".format(interval))
+    try:
+        watcher.run(stop)
+    finally:
+        if server:
+            server.shutdown()
+            server.server_close()
+        EVENTS.finish()
+    return 0
+
+
+class BlobReader:
+    """Reads size bytes from offset of a file through its own file
+    handle so that blobs of a tarball can be read concurrently"""
+
+    def __init__(self, path, offset, size):
+        self.f = open(path, "rb")
+        self.f.seek(offset)
+        self.remaining = size
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.f.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.f.close()
+
+
+class Bundle:
+    """Charts and images stored in an OCI image layout for transfer into
+    disconnected environments. Bundles are written as directories and
+    read from directories or uncompressed tarballs of them"""
+
+    def __init__(self, path):
+        self.path = path
+        self.members = None
+        self.since = set()
+        self.manifests = []
+        self.lock = threading.Lock()
+        self.blob_locks = {}
+        self.stats = {
+            "Blobs written": 0,
+            "Blobs present": 0,
+            "Blobs in prior bundle": 0,
+            "Bytes written": 0,
+        }
+        if os.path.isfile(path):
+            with tarfile.open(path, "r:") as tar:
+                self.members = {
+                    os.path.normpath(member.name): member
+                    for member in tar.getmembers() if member.isfile()
+                }
+        if self.exists("index.json"):
+            with contextlib.closing(self.open("index.json")) as f:
+                self.manifests = json.loads(f.read()).get("manifests", [])
+
+    def exists(self, name):
+        if self.members is not None:
+            return name in self.members
+        return os.path.isfile(os.path.join(self.path, name))
+
+    def open(self, name):
+        """Opens given file of the bundle for reading
+
+        :raises: OSError
+        """
+        if self.members is None:
+            return open(os.path.join(self.path, name), "rb")
+        if name not in self.members:
+            raise OSError("{} not found in {}".format(name, self.path))
+        member = self.members[name]
+        return BlobReader(self.path, member.offset_data, member.size)
+
+    @staticmethod
+    def blob_name(digest):
+        return os.path.join("blobs", *digest.split(":", 1))
+
+    def has_blob(self, digest):
+        return self.exists(self.blob_name(digest))
+
+    def open_blob(self, digest):
+        return self.open(self.blob_name(digest))
+
+    def read_blob(self, digest):
+        with contextlib.closing(self.open_blob(digest)) as f:
+            return f.read()
+
+    def blob_digests(self):
+        """Returns digests of all blobs in the bundle
+
+        :rtype: set(str)
+        """
+        if self.members is not None:
+            names = self.members
+        else:
+            names = [
+                os.path.relpath(os.path.join(root, name), self.path)
+                for root, _, files in os.walk(os.path.join(self.path, "blobs"))
+                for name in files
+            ]
+        return {
+            ":".join(name.split(os.sep)[1:]) for name in names
+            if name.startswith("blobs" + os.sep) and not name.endswith(".tmp")
+        }
+
+    def add_blob(self, digest, write, required=False):
+        """Writes a blob unless the bundle or the prior bundle it is
+        based on already has it. Blobs are written to a temporary file
+        first so that an interrupted export can be resumed
+
+        :param digest: blob digest
+        :type digest: str
+        :param write: function writing the blob content to given file
+        :type write: callable
+        :param required: write the blob even if the prior bundle
+            has it, defaults to False
+        :type required: bool, optional
+        :return: True if the blob was written
+        :rtype: bool
+
+        :raises: OSError
+        """
+        if not required and digest in self.since:
+            self.count("Blobs in prior bundle")
+            return False
+        with self.lock:
+            lock = self.blob_locks.setdefault(digest, threading.Lock())
+        path = os.path.join(self.path, self.blob_name(digest))
+        with lock:
+            if os.path.isfile(path):
+                self.count("Blobs present")
+                return False
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = "{}.{}.tmp".format(path, uuid.uuid4().hex)
+            try:
+                with open(tmp, "wb") as f:
+                    write(f)
+                written = file_digest(tmp)
+                if written != digest:
+                    raise OSError("digest of {} is {}".format(digest, written))
+                size = os.path.getsize(tmp)
+                os.replace(tmp, path)
+            finally:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+        self.count("Blobs written")
+        self.count("Bytes written", size)
+        return True
+
+    def add_bytes(self, data, required=False):
+        digest = sha256_digest(data)
+        self.add_blob(digest, lambda f: f.write(data), required)
+        return digest
 
+    def add_manifest(self, descriptor):
+        with self.lock:
+            self.manifests.append(descriptor)
 
-def get_charts(charts, global_fetch_policy):
-    """Get all Chart objects loaded from charts configuration
+    def count(self, stat, value=1):
+        with self.lock:
+            self.stats[stat] += value
 
-    :param charts: charts section in configuration
-    :type charts: Dict
-    :param global_fetch_policy: global chart fetch policy
-        to be used if the chart local fetch policy
-        is not specified
-    :type global_fetch_policy: bool
-    :return: list of Charts
-    :rtype: [Chart]
-    """
-    chart_objs = []
-    for chart_i, chart in enumerate(charts):
-        chart_fetch_policy = chart.get(FETCH_KEY, global_fetch_policy)
-        chart_values = chart.get(VALUES_KEY, {})
-        chart_name = chart.get(NAME_KEY)
-        repo_name = chart.get(REPO_KEY)
-        chart_scripts = chart.get(SCRIPTS_KEY, [])
-        chart_push_targets = chart.get(PUSH_KEY, [])
-        if not chart_name:
-            err = get_error_type(NAME_KEY, chart_name, chart)
-            error(err, parents=[CHARTS_KEY], index=chart_i)
-            continue
-        if not repo_name:
-            err = get_error_type(REPO_KEY, repo_name, chart)
-            error(err, parents=[CHARTS_KEY], index=chart_i)
-            continue
-        for version_i, version in enumerate(chart[VERSIONS_KEY]):
-            version_fetch_policy = version.get(FETCH_KEY, chart_fetch_policy)
-            version_str = version.get(VERION_KEY)
-            if not version_str:
-                err = get_error_type(VERION_KEY, version_str, version)
-                error(err, parents=[CHARTS_KEY, VERSIONS_KEY], index=version_i)
-                continue
-            local_dir = version.get(FETCH_DIR_KEY) or "/tmp/{}/{}/{}".format(
-                repo_name, chart_name, version_i
-            )
-            version_values = version.get(VALUES_KEY, chart_values)
-            version_push_targets = version.get(PUSH_KEY, chart_push_targets)
-            chart_objs.append(
-                Chart(
-                    repo_name=repo_name,
-                    chart_name=chart_name,
-                    version=version_str,
-                    local_dir=local_dir,
-                    fetch_policy=version_fetch_policy,
-                    values=version_values,
-                    push=version_push_targets,
-                    scripts=chart_scripts,
-                )
-            )
-    return chart_objs
+    def save(self):
+        """Writes the index of the bundle"""
+        for name, content in (
+            ("oci-layout", {"imageLayoutVersion": "1.0.0"}),
+            ("index.json", {
+                "schemaVersion": 2,
+                "mediaType": OCI_INDEX_MEDIA_TYPE,
+                "manifests": sorted(
+                    self.manifests,
+                    key=lambda m: m["annotations"][OCI_REF_NAME_ANNOTATION],
+                ),
+            }),
+        ):
+            tmp = os.path.join(self.path, name + ".tmp")
+            with open(tmp, "w") as f:
+                json.dump(content, f, indent=2)
+            os.replace(tmp, os.path.join(self.path, name))
 
+    def write_tar(self, path):
+        """Writes the bundle to an uncompressed tarball. Layers are
+        already compressed so compressing the tarball would only slow
+        it down
 
-def get_all_images(charts):
-    """Get all images from the charts
+        :param path: tarball path
+        :type path: str
+        """
+        with tarfile.open(path, "w") as tar:
+            for name in ("oci-layout", "index.json"):
+                tar.add(os.path.join(self.path, name), arcname=name)
+            for digest in sorted(self.blob_digests()):
+                name = self.blob_name(digest)
+                tar.add(os.path.join(self.path, name), arcname=name)
 
-    :param charts: List of Chart objects
-    :type charts: [Chart]
-    :return: list of images
-    :rtype: [str]
+    def entries(self, kind):
+        return [
+            m for m in self.manifests
+            if m.get("annotations", {}).get(BUNDLE_KIND_ANNOTATION) == kind
+        ]
+
+
+def file_digest(path):
+    """Returns sha256 digest of given file
+
+    :rtype: str
     """
-    images = set()
-    for chart in charts:
-        chart.fetch()
-        images.update(chart.images())
-    return images
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(chunk)
+    return "sha256:" + sha256.hexdigest()
 
 
-def get_error_type(key, value, obj):
-    if key not in obj:
-        return Errors.missing_required_key(key)
-    return Errors.invalid_value(key, value)
+def copy_file(path, f):
+    with open(path, "rb") as src:
+        shutil.copyfileobj(src, f, 1 << 20)
 
 
-def list_to_dict(lst, key):
-    """Convert list of objects to a dictionary mapping
-    given key in the object to object for faster queries
+def export_manifest(client, repository, reference, bundle):
+    """Writes given manifest along with its blobs from the
+    registry to the bundle. Blobs are streamed to disk
 
-    :param lst: list of objects. object must contain given key as attribute
-    :type lst: [Any]
-    :param key: Name of the key attribute in the object
-    :type key: str
-    :return: Dictionary mapping the key attribute from each object to the object
+    :param client: source registry client
+    :type client: RegistryClient
+    :param bundle: bundle being exported
+    :type bundle: Bundle
+    :return: descriptor of the manifest
     :rtype: Dict
-    """    
-    result = {}
-    for obj in lst:
-        result[getattr(obj, key)] = obj
-    return result
 
+    :raises: OSError
+    """
+    manifest = client.get_manifest(repository, reference)
+    if not manifest:
+        raise OSError("manifest {}:{} not found".format(repository, reference))
+    media_type, body, digest = manifest
+    content = json.loads(body)
+    for child in content.get("manifests", []):
+        export_manifest(client, repository, child["digest"], bundle)
+    blobs = [content["config"]] if "config" in content else []
+    for blob in blobs + content.get("layers", []):
+        bundle.add_blob(
+            blob["digest"],
+            lambda f, blob=blob: client.download_blob(repository, blob["digest"], f),
+        )
+    # manifests are always written so that the bundle can be imported
+    bundle.add_blob(digest, lambda f: f.write(body), required=True)
+    return {"mediaType": media_type, "digest": digest, "size": len(body)}
 
-def get_registries(registries, g_push, g_retain, parents=[]):
-    """Get Registry objects instantiated from given registries
-    configuration
 
-    :param registries: list of destination registry configurations
-    :type registries: [Dict]
-    :param g_push: global push policy
-    :type g_push: bool
-    :param g_retain: global retain policy
-    :type g_retain: bool
-    :param parents: list of parent keys in the configuration
-        to be used for constructing appropriate error messages
-        for configuration errors
-    :type parents: [str]
-    :return: list of Registry objects
-    :rtype: [Registry]
+def export_image(image, bundle):
+    """Writes given image from its source registry to the bundle
+
+    :raises: OSError
     """
-    registry_objs = []
-    for i, registry in enumerate(registries):
-        registry_name = registry.get(NAME_KEY)
-        if not registry_name:
-            err = get_error_type(NAME_KEY, registry_name, registry)
-            error(err, parents=parents, index=i)
-            continue
-        push = registry.get(PUSH_KEY, g_push)
-        retain = registry.get(RETAIN_KEY, g_retain)
-        registry_objs.append(
-            Registry(
-                name=registry_name,
-                push=push,
-                retain=retain,
-            )
+    host, repository, reference = parse_image_reference(image)
+    with EVENTS.timed("image_export", image):
+        descriptor = export_manifest(
+            get_registry_client(host), repository, reference, bundle
         )
-    return registry_objs
+    descriptor["annotations"] = {
+        OCI_REF_NAME_ANNOTATION: image,
+        BUNDLE_KIND_ANNOTATION: "image",
+    }
+    bundle.add_manifest(descriptor)
 
 
-def pull_images(images):
-    """Pull given images
+def export_chart(chart, bundle):
+    """Pulls given chart and writes it to the bundle as a helm OCI artifact
 
-    :param images: list of images
-    :type images: [str]
-    :return: images that could not be pulled
-    :rtype: set(str)
+    :raises: OSError, UploadError
     """
-    failed_images = set()
-    for image in images:
-        try:
-            docker("pull {}".format(image))
-        except subprocess.CalledProcessError:
-            print("Unable to pull image", image)
-            failed_images.add(image)
-    return failed_images
+    msg = pull_chart(chart)
+    if msg:
+        raise OSError(msg)
+    with EVENTS.timed("chart_export", chart.combined_name):
+        config, layers, manifest = chart_artifact(chart)
+        # charts are small and needed to push them, they are always written
+        bundle.add_bytes(config, required=True)
+        for path, descriptor in layers:
+            bundle.add_blob(
+                descriptor["digest"],
+                lambda f, path=path: copy_file(path, f),
+                required=True,
+            )
+        bundle.add_bytes(manifest, required=True)
+    bundle.add_manifest({
+        "mediaType": OCI_MANIFEST_MEDIA_TYPE,
+        "digest": sha256_digest(manifest),
+        "size": len(manifest),
+        "annotations": {
+            OCI_REF_NAME_ANNOTATION: chart.combined_name,
+            BUNDLE_KIND_ANNOTATION: "chart",
+            BUNDLE_REPO_ANNOTATION: chart.repo_name,
+            BUNDLE_CHART_ANNOTATION: chart.chart_name,
+            BUNDLE_VERSION_ANNOTATION: str(chart.version),
+        },
+    })
 
 
-def push_images_to_registries(images, registries):
-    """Pushes all given images to given registries
+def export_bundle(charts, images, bundle, since=None, workers=DEFAULT_WORKERS):
+    """Exports given charts and images to the bundle
 
-    :param images: list of images
+    :param charts: charts to be exported
+    :type charts: [Chart]
+    :param images: images to be exported
     :type images: [str]
-    :param registries: list of Regitries
-    :type registries: [Registry]
-    :return: dictionary containing success and failures information
-        and boolean indicating if any failures have occurred
-    :rtype: Dict, bool
+    :param bundle: bundle to export to
+    :type bundle: Bundle
+    :param since: prior bundle, image blobs it contains are not
+        exported again, defaults to None
+    :type since: Bundle, optional
+    :param workers: number of charts and images exported concurrently
+    :type workers: int, optional
+    :return: status report and True if any failures have occurred
+    :rtype: (Dict, bool)
     """
-    failures = {}
-    for registry in registries:
-        pushed, tf, pf, cf = registry.tag_and_push(images)
-        failures[registry.name] = {
-            "Pushed": list(pushed),
-            "Failed to tag": list(tf),
-            "Failed to push": list(pf),
-            "Failed to cleanup": list(cf),
+    os.makedirs(bundle.path, exist_ok=True)
+    bundle.since = since.blob_digests() if since else set()
+    bundle.manifests = []
+    report = {
+        "Image Status": {"Exported": [], "Failed to export": {}},
+        "Chart Status": {"Exported": [], "Failed to export": {}},
+    }
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(export_image, image, bundle): ("Image Status", image)
+            for image in images
         }
-    return failures, tf or pf or cf
+        futures.update({
+            executor.submit(export_chart, chart, bundle):
+                ("Chart Status", chart.combined_name)
+            for chart in charts
+        })
+        for future in as_completed(futures):
+            section, name = futures[future]
+            try:
+                future.result()
+            except (OSError, UploadError, ValueError) as e:
+                report[section]["Failed to export"][name] = str(e)
+            else:
+                report[section]["Exported"].append(name)
+    bundle.save()
+    report["Bundle Status"] = dict(bundle.stats)
+    if BLOB_STORE:
+        report["Blob Cache Status"] = BLOB_STORE.summary()
+    err = bool(
+        report["Image Status"]["Failed to export"]
+        or report["Chart Status"]["Failed to export"]
+    )
+    return report, err
 
 
-def reconcile_charts(charts, repos):
-    """Pushes given charts to specified target helm repositories
+def import_manifest(bundle, descriptor, client, repository, tag):
+    """Pushes given manifest along with its blobs from the bundle
+    to the registry. Blobs missing from an incremental bundle must
+    already exist in the registry
 
-    :param charts: list of charts
-    :type charts: [Chart]
-    :param repos: list of helm repositories configured globally
-    :type repos: [Repo]
+    :param bundle: bundle being imported
+    :type bundle: Bundle
+    :param descriptor: descriptor of the manifest
+    :type descriptor: Dict
+    :param client: target registry client
+    :type client: RegistryClient
+    :return: True if the manifest was pushed, False if it already
+        existed in the target with the same digest
+    :rtype: bool
+
+    :raises: UploadError, OSError
     """
-    status = {}
-    repo_map = list_to_dict(repos, "name")
-    err = False
-    for chart in charts:
-        if not (chart.scripts or chart.push_targets):
-            continue
+    digest = descriptor["digest"]
+    if client.manifest_digest(repository, tag) == digest:
+        return False
+    body = bundle.read_blob(digest)
+    content = json.loads(body)
+    for child in content.get("manifests", []):
+        import_manifest(bundle, child, client, repository, child["digest"])
+    blobs = [content["config"]] if "config" in content else []
+    for blob in blobs + content.get("layers", []):
+        ensure_blob(
+            client, repository, blob["digest"],
+            lambda blob=blob: bundle.open_blob(blob["digest"]), blob["size"],
+        )
+    client.put_manifest(repository, tag, descriptor["mediaType"], body)
+    return True
 
-        status[chart.combined_name] = {}
-        stat = status[chart.combined_name]
-        # Run chart scripts
-        if chart.scripts:
-            failed = chart.run_scripts()
-            if failed:
-                err = True
-            stat["Failed scripts"] = failed
-        
-        # Push chart to other repositories if configured
-        if not chart.push_targets:
-            continue
-        # Pull the chart
-        try:
-            chart.pull()
-        except subprocess.CalledProcessError as exp:
-            if DEBUG:
-                msg = str(exp.stderr, 'utf-8')
-            else:
-                msg = "Unable to pull chart. {}".format(DEBUG_HELP_MSG)
-            stat["pull"] = msg
-            err = True
-            continue
-        else:
-            stat["pull"] = "Pulled succesfully"
-        
-        # Push the chart to target repositories
-        for repo_name in chart.push_targets:
-            stat["push"] = {}
-            if repo_name not in repo_map:
-                stat["push"][repo_name] = (
-                    "Repository is not configured under repos section. "
-                    "Please configure it and retry."
-                )
+
+def import_images(bundle, registries, workers=DEFAULT_WORKERS):
+    """Pushes images in the bundle to given registries
+
+    :param bundle: bundle being imported
+    :type bundle: Bundle
+    :param registries: target registries
+    :type registries: [Registry]
+    :return: dictionary containing success and failures information
+        and boolean indicating if any failures have occurred
+    :rtype: Dict, bool
+    """
+    status = {}
+    pushes = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for registry in registries:
+            if not registry.push:
                 continue
+            status[registry.name] = {
+                "Already present": [], "Pushed": [], "Failed to push": {}
+            }
+            for entry in bundle.entries("image"):
+                target = registry.target_name(entry["annotations"][OCI_REF_NAME_ANNOTATION])
+                host, repository, tag = parse_image_reference(target)
+                future = executor.submit(
+                    import_manifest, bundle, entry,
+                    get_registry_client(host), repository, tag,
+                )
+                pushes[future] = (registry.name, target)
+        for future in as_completed(pushes):
+            name, target = pushes[future]
             try:
-                chart.push(repo_map[repo_name])
-            except subprocess.CalledProcessError as exp:
-                err = True
-                if DEBUG:
-                    msg = str(exp.stderr, 'utf-8')
-                else:
-                    msg = "Unable to push chart. {}".format(DEBUG_HELP_MSG)
-                stat["push"][repo_name] = msg
-            else:
-                stat["push"][repo_name] = "Pushed successfully"
+                pushed = future.result()
+            except (OSError, UploadError, ValueError) as e:
+                status[name]["Failed to push"][target] = str(e)
+                continue
+            status[name]["Pushed" if pushed else "Already present"].append(target)
+    err = any(stat["Failed to push"] for stat in status.values())
     return status, err
-    
 
-def configure_repos(repos, update=True):
-    """Configures given helm repositories
 
-    :param repos: list of Repos
+def import_charts(bundle, repos, push_targets):
+    """Pushes charts in the bundle to their target repositories
+
+    :param bundle: bundle being imported
+    :type bundle: Bundle
+    :param repos: list of helm repositories configured globally
     :type repos: [Repo]
-    :param update: `helm repo update` is run if True,
-        defaults to True
-    :type update: bool, optional
+    :param push_targets: dictionary mapping combined name of chart
+        versions and (repo, chart name) to target repositories
+    :type push_targets: Dict
+    :return: push status of each chart and True if any failures
+        have occurred
+    :rtype: (Dict, bool)
     """
     status = {}
     err = False
-    for repo in repos:
-        print("Configuring helm repository", repo.name)
-        try:
-            repo.add()
-        except subprocess.CalledProcessError as e:
-            status[repo.name] = f"Unable to add helm repository. Please check logs."
-            err = True        
-    if repos and update:
-        print("Updating helm repositories")
-        try:
-            helm("repo update")
-        except subprocess.CalledProcessError as e:
-            print("helm repo update failed")
-            err = True
+    repo_map = list_to_dict(repos, "name")
+    for entry in bundle.entries("chart"):
+        annotations = entry["annotations"]
+        combined_name = annotations[OCI_REF_NAME_ANNOTATION]
+        repo_name = annotations[BUNDLE_REPO_ANNOTATION]
+        chart_name = annotations[BUNDLE_CHART_ANNOTATION]
+        targets = push_targets.get(
+            combined_name, push_targets.get((repo_name, chart_name), [])
+        )
+        stat = status[combined_name] = {
+            "Pushed": [], "Already published": [], "Failed to push": {}
+        }
+        with tempfile.TemporaryDirectory() as local_dir:
+            chart = Chart(
+                repo_name, chart_name, annotations[BUNDLE_VERSION_ANNOTATION],
+                local_dir, False, push=targets,
+            )
+            manifest = json.loads(bundle.read_blob(entry["digest"]))
+            for layer in manifest["layers"]:
+                path = chart.archive_path()
+                if layer["mediaType"] == HELM_PROV_MEDIA_TYPE:
+                    path += ".prov"
+                with open(path, "wb") as f, contextlib.closing(
+                    bundle.open_blob(layer["digest"])
+                ) as blob:
+                    shutil.copyfileobj(blob, f)
+            for repo_name in targets:
+                if repo_name not in repo_map:
+                    stat["Failed to push"][repo_name] = (
+                        "Repository is not configured under repos section. "
+                        "Please configure it and retry."
+                    )
+                    err = True
+                    continue
+                result, msg = push_chart(chart, repo_map[repo_name])
+                if msg:
+                    err = True
+                    stat["Failed to push"][repo_name] = msg
+                else:
+                    stat[result].append(repo_name)
     return status, err
 
 
-def print_dict(failures):
-    """Prints failres if any
+def get_push_targets(charts_config, global_fetch_policy=True):
+    """Returns target repositories of the configured charts
 
-    :param failures: Dictionary of failures
-        mapping failure type and failed items
-    :type failures: Dict
+    :param charts_config: charts section in configuration
+    :type charts_config: [Dict]
+    :return: dictionary mapping combined name of configured chart
+        versions and (repo, chart name) to target repositories
+    :rtype: Dict
     """
-    failures_copy = dict(failures)
-    for msg, items in failures.items():
-        if not items:
-            del failures_copy[msg]
-    print(json.dumps(failures_copy, indent=4))
+    push_targets = {
+        (chart.get(REPO_KEY), chart.get(NAME_KEY)): chart.get(PUSH_KEY, [])
+        for chart in charts_config
+    }
+    for chart in iter_charts(charts_config, global_fetch_policy):
+        push_targets[chart.combined_name] = chart.push_targets
+    return push_targets
 
 
+def merge_reports_main(argv):
+    """Entry point of merge-reports command which combines the
+    status reports saved by the shards of a run
 
-def main(file):
-    """Main function
+    :param argv: command line arguments
+    :type argv: [str]
+    """
+    parser = argparse.ArgumentParser(prog="helm_image_mirror.py merge-reports")
+    parser.add_argument("reports", nargs="+", help="status report file paths")
+    parser.add_argument("-o", "--output", help="merged report file path")
+    args = parser.parse_args(argv)
+    reports = []
+    for file in args.reports:
+        try:
+            with open(file, "r") as f:
+                reports.append(json.load(f))
+        except (IOError, ValueError) as e:
+            print(e)
+            return 1
+    merged = merge_reports(reports)
+    print_report(merged)
+    if args.output:
+        save_report(merged, args.output)
+    return 0
 
-    :param file: configuration file path
-    :type file: str
+
+def export_main(argv):
+    """Entry point of export command which writes the configured
+    charts and the images they reference to a bundle
+
+    :param argv: command line arguments
+    :type argv: [str]
     """
-    err = False
-    # Parse configuration
-    config = load_config(file)
+    parser = argparse.ArgumentParser(prog="helm_image_mirror.py export")
+    parser.add_argument("-c", "--config", required=True, help="configuration file path")
+    parser.add_argument("-o", "--output", required=True, help="bundle directory path")
+    parser.add_argument("--tar", help="also write the bundle to given tarball")
+    parser.add_argument(
+        "--since", help="prior bundle, image blobs it contains are not exported"
+    )
+    parser.add_argument("--report", help="save status report as json to given path")
+    args = parser.parse_args(argv)
+    config = load_config(args.config)
     if not config:
         return 1
+    repos, repo_status, err = setup(config)
+    if err:
+        print_report({"Helm repository Status": repo_status})
+        return 1
+    charts_config = config.get(CHARTS_KEY) or []
+    charts_config = charts_config + expand_version_patterns(charts_config, repos)[0]
+    charts = get_charts(charts_config, global_fetch_policy=config.get(FETCH_KEY, True))
+    set_chart_sources(charts, repos)
+    workers = config.get(WORKERS_KEY, DEFAULT_WORKERS)
+    # charts that can not be rendered are reported, the others exported
+    render_failures = {}
+    images = set().union(*get_chart_images(
+        charts, workers=workers, failures=render_failures
+    ).values())
+    charts = [chart for chart in charts if chart.combined_name not in render_failures]
+    since = Bundle(args.since) if args.since else None
+    bundle = Bundle(args.output)
+    print("Exporting {} charts and {} images to {}".format(
+        len(charts), len(images), args.output))
+    report, err = export_bundle(charts, images, bundle, since=since, workers=workers)
+    report["Chart Status"]["Failed to export"].update(render_failures)
+    err = err or bool(render_failures)
+    if args.tar:
+        bundle.write_tar(args.tar)
+    print_report(report)
+    if args.report:
+        save_report(report, args.report)
+    EVENTS.finish()
+    return 1 if err else 0
 
-    # Run initialization scripts
-    init_scripts = config.get(INIT_SCRIPTS_KEY, [])
-    run_init_scripts(init_scripts)
 
-    # Configure repos
-    repos_config = config.get(REPOS_KEY, {})
-    repos = {}
-    if repos_config: 
-        repos = get_repos(repos_config, parents=[REPOS_KEY])
-        repo_status, err = configure_repos(repos)
+def import_main(argv):
+    """Entry point of import command which pushes the charts and
+    images of a bundle to the configured repositories and registries
+
+    :param argv: command line arguments
+    :type argv: [str]
+    """
+    parser = argparse.ArgumentParser(prog="helm_image_mirror.py import")
+    parser.add_argument("-c", "--config", required=True, help="configuration file path")
+    parser.add_argument("bundle", help="bundle directory or tarball path")
+    parser.add_argument("--report", help="save status report as json to given path")
+    args = parser.parse_args(argv)
+    config = load_config(args.config)
+    if not config:
+        return 1
+    repos, repo_status, err = setup(config)
     if err:
-        if repo_status:
-            print("{:=^50}".format(" Helm repository Status "))
-            print_dict(repo_status)
+        print_report({"Helm repository Status": repo_status})
         return 1
-    # fetch charts
-    charts = config.get(CHARTS_KEY)
-    if not charts:
-        print("No charts specified in config")
-        return
-    global_fetch_policy = config.get(FETCH_KEY, True)
-    charts = get_charts(charts, global_fetch_policy=global_fetch_policy)
-
-    # Retag and push images
-    registry_config = config.get(REGISTRIES_KEY, [])
-    if registry_config:
-        print("Retagging and pushing images to destinations")
-        images = get_all_images(charts)
-        g_retain = config.get(RETAIN_KEY, False)
-        g_push = config.get(PUSH_KEY, True)
+    bundle = Bundle(args.bundle)
+    if not bundle.exists("index.json"):
+        print("{} is not a bundle".format(args.bundle))
+        return 1
+    workers = config.get(WORKERS_KEY, DEFAULT_WORKERS)
+    report = {}
+    image_err = False
+    if config.get(REGISTRIES_KEY):
         registries = get_registries(
-            registry_config, g_retain=g_retain, g_push=g_push, parents=[REGISTRIES_KEY]
-        )
-        failed_to_pull = pull_images(images)
-        if failed_to_pull:
-            err = True
-        pulled_images = images - failed_to_pull
-        failures, err = push_images_to_registries(pulled_images, registries)
-        # Report status
-        print("{:=^50}".format(" Image Status "))
-    
-        print_dict(
-            {
-                "All images": list(images),
-                "Failed to pull": failed_to_pull,
-                **failures,
-            }
+            config[REGISTRIES_KEY], g_retain=config.get(RETAIN_KEY, False),
+            g_push=config.get(PUSH_KEY, True), parents=[REGISTRIES_KEY],
         )
+        report["Image Status"], image_err = import_images(bundle, registries, workers)
+    push_targets = get_push_targets(
+        config.get(CHARTS_KEY) or [], config.get(FETCH_KEY, True)
+    )
+    report["Helm repository Status"] = repo_status
+    report["Chart Status"], chart_err = import_charts(bundle, repos, push_targets)
+    print_report(report)
+    if args.report:
+        save_report(report, args.report)
+    EVENTS.finish()
+    return 1 if image_err or chart_err else 0
 
-    # push charts to target helm repositories
-    chart_push_status, err = reconcile_charts(charts, repos)
-    if repo_status:
-        print("{:=^50}".format(" Helm repository Status "))
-        print_dict(repo_status)
-    if chart_push_status:
-        print("{:=^50}".format(" Chart Status "))
-        print_dict(chart_push_status)
-    if registry_config or chart_push_status:
-        print("{:=^50}".format(" Status "))
-    if err:
-        return 1
-    return 0
+
+COMMANDS = {
+    "merge-reports": merge_reports_main,
+    "export": export_main,
+    "import": import_main,
+}
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        sys.exit(COMMANDS[sys.argv[1]](sys.argv[2:]))
     parser = argparse.ArgumentParser()
-    parser.add_argument("-c", "--config", required=True, help="configuration file path")
+    parser.add_argument(
+        "-c", "--config", required=True, action="append",
+        help="configuration file path. repeat it or give a directory of "
+        "configurations to mirror them in one deduplicated batch",
+    )
     parser.add_argument("-d", "--debug", action="store_true", help="print debug logs")
+    parser.add_argument(
+        "--shard", type=parse_shard,
+        help="process only shard i of N (1-based) of the work. e.g. 2/4",
+    )
+    parser.add_argument("--report", help="save status report as json to given path")
+    parser.add_argument(
+        "--watch", type=float, metavar="SECONDS",
+        help="keep running and mirror new chart versions matching "
+        "version_pattern, polling the repositories every SECONDS",
+    )
+    parser.add_argument(
+        "--metrics-port", type=int,
+        help="serve /healthz and /metrics on localhost in watch mode",
+    )
+    parser.add_argument(
+        "--events", choices=["ndjson"],
+        help="stream one json line per completed operation",
+    )
+    parser.add_argument(
+        "--events-file",
+        help="file events are written to. defaults to stdout in which "
+        "case the regular output is written to stderr",
+    )
     args = parser.parse_args()
+    single = len(args.config) == 1 and not os.path.isdir(args.config[0])
+    if args.watch and not single:
+        parser.error("--watch accepts a single configuration file")
     if args.debug:
         DEBUG = True
-    sys.exit(main(args.config))
+    stop = threading.Event()
+
+    def terminate(signum, frame):
+        if stop.is_set():
+            # a second signal exits without waiting for running work
+            os._exit(128 + signum)
+        stop.set()
+        # a watcher finishes its poll, a run is cancelled right away
+        if not args.watch:
+            threading.Thread(target=cancel_commands, daemon=True).start()
+
+    def interrupt(signum, frame):
+        if stop.is_set():
+            os._exit(128 + signum)
+        stop.set()
+        # commands run in their own sessions and do not receive the
+        # interrupt of the terminal. They are killed from another thread
+        # as the interrupted one may hold the lock of the running commands
+        threading.Thread(target=cancel_commands).start()
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, terminate)
+    signal.signal(signal.SIGINT, interrupt)
+    output = contextlib.nullcontext()
+    if args.events and args.events_file:
+        EVENTS.stream = open(args.events_file, "a")
+    elif args.events:
+        EVENTS.stream = sys.stdout
+        output = contextlib.redirect_stdout(sys.stderr)
+    with output:
+        if args.watch:
+            code = watch(
+                args.config[0], args.watch, metrics_port=args.metrics_port,
+                shard=args.shard, stop=stop,
+            )
+        elif single:
+            code = main(args.config[0], shard=args.shard, report_file=args.report)
+        else:
+            code = batch(args.config, shard=args.shard, report_file=args.report)
+    sys.exit(code)
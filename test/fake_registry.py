@@ -0,0 +1,159 @@
+#!/usr/bin/python3
+
+"""
+In-memory stand-in for a docker / OCI registry HTTP API v2 server used by tests
+"""
+
+import hashlib
+import json
+import threading
+import urllib.parse
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+MANIFEST_MEDIA_TYPE = "application/vnd.docker.distribution.manifest.v2+json"
+
+
+def digest_of(data):
+    return "sha256:" + hashlib.sha256(data).hexdigest()
+
+
+class FakeRegistry:
+    """Serves manifests and blobs stored in memory on a random local port"""
+
+    def __init__(self):
+        # (repository, reference) -> (media type, body)
+        self.manifests = {}
+        # (repository, digest) -> body
+        self.blobs = {}
+        # upload id -> repository
+        self.uploads = {}
+        self.requests = []
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_HEAD(self):
+                registry.handle(self)
+
+            def do_GET(self):
+                registry.handle(self)
+
+            def do_POST(self):
+                registry.handle(self)
+
+            def do_PUT(self):
+                registry.handle(self)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.host = "127.0.0.1:{}".format(self.server.server_port)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def add_manifest(self, repository, tag, body, media_type=MANIFEST_MEDIA_TYPE):
+        body = body if isinstance(body, bytes) else json.dumps(body).encode()
+        digest = digest_of(body)
+        self.manifests[(repository, tag)] = (media_type, body)
+        self.manifests[(repository, digest)] = (media_type, body)
+        return digest
+
+    def add_blob(self, repository, data):
+        digest = digest_of(data)
+        self.blobs[(repository, digest)] = data
+        return digest
+
+    def blob_uploads(self):
+        """Returns requests that uploaded blob content"""
+        return [
+            request for request in self.requests
+            if request[0] == "PUT" and "/blobs/uploads/" in request[1]
+        ]
+
+    def respond(self, handler, status, headers={}, body=b"", send_body=True):
+        handler.send_response(status)
+        for key, value in headers.items():
+            handler.send_header(key, value)
+        handler.send_header("Content-Length", str(len(body)))
+        handler.end_headers()
+        if send_body:
+            handler.wfile.write(body)
+
+    def handle(self, handler):
+        self.requests.append((handler.command, handler.path))
+        url = urllib.parse.urlsplit(handler.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        path = url.path
+        length = int(handler.headers.get("Content-Length") or 0)
+        data = handler.rfile.read(length) if length else b""
+        send_body = handler.command != "HEAD"
+        if path == "/v2/":
+            return self.respond(handler, 200)
+        path = path[len("/v2/"):]
+        if "/blobs/uploads/" in path:
+            repository, _, upload_id = path.partition("/blobs/uploads/")
+            if handler.command == "POST":
+                source = (query.get("from"), query.get("mount"))
+                if source in self.blobs:
+                    self.blobs[(repository, source[1])] = self.blobs[source]
+                    return self.respond(handler, 201)
+                upload_id = uuid.uuid4().hex
+                self.uploads[upload_id] = repository
+                location = "/v2/{}/blobs/uploads/{}".format(repository, upload_id)
+                return self.respond(handler, 202, {"Location": location})
+            if self.uploads.pop(upload_id, None) != repository:
+                return self.respond(handler, 404)
+            if digest_of(data) != query.get("digest"):
+                return self.respond(handler, 400)
+            self.blobs[(repository, query["digest"])] = data
+            return self.respond(handler, 201)
+        if "/blobs/" in path:
+            repository, _, digest = path.rpartition("/blobs/")
+            if (repository, digest) not in self.blobs:
+                return self.respond(handler, 404)
+            body = self.blobs[(repository, digest)]
+            headers = {"Docker-Content-Digest": digest}
+            return self.respond(handler, 200, headers, body, send_body)
+        if path.endswith("/tags/list"):
+            return self.list_tags(handler, path[:-len("/tags/list")], query)
+        repository, _, reference = path.rpartition("/manifests/")
+        if handler.command == "PUT":
+            media_type = handler.headers.get("Content-Type")
+            digest = self.add_manifest(repository, reference, data, media_type)
+            return self.respond(handler, 201, {"Docker-Content-Digest": digest})
+        if (repository, reference) not in self.manifests:
+            return self.respond(handler, 404, send_body=send_body)
+        media_type, body = self.manifests[(repository, reference)]
+        headers = {"Content-Type": media_type, "Docker-Content-Digest": digest_of(body)}
+        return self.respond(handler, 200, headers, body, send_body)
+
+    def list_tags(self, handler, repository, query):
+        tags = sorted(
+            reference for repo, reference in self.manifests
+            if repo == repository and not reference.startswith("sha256:")
+        )
+        if not tags:
+            return self.respond(handler, 404)
+        tags = [tag for tag in tags if tag > query.get("last", "")]
+        headers = {}
+        page_size = int(query.get("n") or len(tags))
+        if len(tags) > page_size:
+            tags = tags[:page_size]
+            headers["Link"] = '</v2/{}/tags/list?{}>; rel="next"'.format(
+                repository, urllib.parse.urlencode({"n": page_size, "last": tags[-1]})
+            )
+        body = json.dumps({"name": repository, "tags": tags}).encode()
+        headers["ETag"] = '"{}"'.format(digest_of(body))
+        if handler.headers.get("If-None-Match") == headers["ETag"]:
+            return self.respond(handler, 304, headers)
+        return self.respond(handler, 200, headers, body)
@@ -0,0 +1,244 @@
+#!/usr/bin/python3
+
+import json
+import os
+import re
+import subprocess
+import sys
+
+import pytest
+import yaml
+
+base_path = re.search("^(.*)/test/", os.path.abspath(__file__))
+sys.path.append(os.path.join(base_path.group(1), "src"))
+
+import helm_image_mirror
+from helm_image_mirror import (
+    Chart,
+    Registry,
+    batch,
+    load_configs,
+    merge_charts,
+    merge_configs,
+    merge_registries,
+)
+
+
+IMAGES = {
+    "redis": {"redis:6.0", "busybox:1.32"},
+    "nginx": {"nginx:1.19", "busybox:1.32"},
+}
+
+
+def write_config(path, charts, registries, repos=("stable",)):
+    config = {
+        "repos": {
+            "username": None,
+            "password": None,
+            "add": [{"name": name, "remote": "https://{}.example.com".format(name)}
+                    for name in repos],
+        },
+        "charts": charts,
+        "registries": registries,
+    }
+    path.write_text(yaml.safe_dump(config))
+    return str(path)
+
+
+def test_load_configs(tmp_path):
+    (tmp_path / "b.yml").write_text("workers: 2\n")
+    (tmp_path / "a.yaml").write_text("workers: 1\n")
+    (tmp_path / "notes.txt").write_text("not a configuration")
+    extra = tmp_path / "extra.yaml"
+    configs = load_configs([str(tmp_path)])
+    assert [os.path.basename(path) for path, _ in configs] == ["a.yaml", "b.yml"]
+    assert load_configs([str(tmp_path), str(extra)]) is None
+
+
+def test_merge_configs():
+    repos = {"username": None, "password": None,
+             "add": [{"name": "stable", "remote": "https://stable.example.com"}]}
+    configs = [
+        ("a.yaml", {"repos": repos, "workers": 2, "init_scripts": ["login.sh"]}),
+        ("b.yaml", {"repos": repos, "workers": 8,
+                    "init_scripts": ["login.sh", "setup.sh"]}),
+    ]
+    merged, merged_repos, err = merge_configs(configs)
+    assert not err
+    assert merged == {"workers": 2, "init_scripts": ["login.sh", "setup.sh"]}
+    assert [repo.name for repo in merged_repos] == ["stable"]
+
+    other = {"username": None, "password": None,
+             "add": [{"name": "stable", "remote": "https://other.example.com"}]}
+    _, _, err = merge_configs(configs + [("c.yaml", {"repos": other})])
+    assert err
+
+
+def test_merge_registries_and_charts():
+    registries = merge_registries([
+        [Registry("gcr.io", False, False)],
+        [Registry("gcr.io", True, False), Registry("quay.io", True, True)],
+    ])
+    assert [(r.name, r.push, r.retain) for r in registries] == [
+        ("gcr.io", True, False), ("quay.io", True, True)
+    ]
+    first = Chart("stable", "redis", "1.0.0", "/tmp/a", True, push=["a"], scripts=["x.sh"])
+    second = Chart("stable", "redis", "1.0.0", "/tmp/b", True, push=["a", "b"])
+    charts = merge_charts([first, second])
+    assert len(charts) == 1
+    assert charts[0].push_targets == ["a", "b"]
+    assert charts[0].scripts == ["x.sh"]
+    # the configured charts are not modified
+    assert first.push_targets == ["a"]
+
+
+@pytest.fixture
+def pipeline(monkeypatch):
+    calls = {"rendered": [], "pulled": [], "pushed": {}, "reconciled": []}
+
+    def images(self, workers=1):
+        calls["rendered"].append(self.combined_name)
+        return set(IMAGES[self.chart_name])
+
+    def pull_images(images, workers=1, use_store=False):
+        calls["pulled"].extend(images)
+        return set()
+
+    def tag_and_push(self, images, waves=None, workers=1):
+        calls["pushed"].setdefault(self.name, []).extend(images)
+        return [self.target_name(image) for image in images], [], [], []
+
+    def reconcile_charts(charts, repos, **kwargs):
+        calls["reconciled"].extend(charts)
+        return {chart.combined_name: {
+            "Pushed": list(chart.push_targets), "Already published": [],
+            "Failed to push": {},
+        } for chart in charts}, False
+
+    monkeypatch.setattr(Chart, "fetch", lambda self: None)
+    monkeypatch.setattr(Chart, "images", images)
+    monkeypatch.setattr(Registry, "tag_and_push", tag_and_push)
+    monkeypatch.setattr(helm_image_mirror, "pull_images", pull_images)
+    monkeypatch.setattr(helm_image_mirror, "find_present_images",
+                        lambda images, registries, targets=None: {})
+    monkeypatch.setattr(helm_image_mirror, "get_image_layers",
+                        lambda images, workers=1: {})
+    monkeypatch.setattr(helm_image_mirror, "reconcile_charts", reconcile_charts)
+    monkeypatch.setattr(helm_image_mirror, "helm", lambda *args, **kwargs: b"")
+    return calls
+
+
+def test_batch_deduplicates_work(tmp_path, pipeline):
+    redis = {"name": "redis", "repo": "stable", "versions": [{"version": "1.0.0"}]}
+    nginx = {"name": "nginx", "repo": "stable", "versions": [{"version": "2.0.0"}]}
+    team_a = write_config(
+        tmp_path / "a.yaml", [dict(redis, push=["a"]), nginx], [{"name": "gcr.io"}]
+    )
+    team_b = write_config(
+        tmp_path / "b.yaml", [dict(redis, push=["b"])],
+        [{"name": "gcr.io"}, {"name": "quay.io"}], repos=("stable", "b"),
+    )
+    report_file = tmp_path / "report.json"
+    assert batch([team_a, team_b], report_file=str(report_file)) == 0
+
+    # redis is rendered once and busybox is pulled and pushed once
+    assert sorted(pipeline["rendered"]) == ["stable/nginx-2.0.0", "stable/redis-1.0.0"]
+    assert sorted(pipeline["pulled"]) == ["busybox:1.32", "nginx:1.19", "redis:6.0"]
+    assert sorted(pipeline["pushed"]["gcr.io"]) == [
+        "busybox:1.32", "nginx:1.19", "redis:6.0"
+    ]
+    assert sorted(pipeline["pushed"]["quay.io"]) == ["busybox:1.32", "redis:6.0"]
+    assert [chart.push_targets for chart in pipeline["reconciled"]] == [["a", "b"], []]
+
+    with open(report_file) as f:
+        report = json.load(f)
+    summary = report["Batch Summary"]
+    assert summary["Chart versions"] == {"Configured": 3, "Rendered": 2, "Reconciled": 2}
+    assert summary["Image pushes"] == {"Configured": 7, "Scheduled": 5}
+    # each configuration only sees its own images, registries and targets
+    b_status = report[team_b]
+    assert sorted(b_status["Image Status"]["All images"]) == ["busybox:1.32", "redis:6.0"]
+    assert sorted(b_status["Image Status"]["gcr.io"]["Pushed"]) == [
+        "gcr.io/busybox:1.32", "gcr.io/redis:6.0"
+    ]
+    assert b_status["Chart Status"]["stable/redis-1.0.0"]["Pushed"] == ["b"]
+    a_status = report[team_a]
+    assert "quay.io" not in a_status["Image Status"]
+    assert a_status["Chart Status"]["stable/redis-1.0.0"]["Pushed"] == ["a"]
+
+
+def test_batch_separates_default_fetch_dirs(tmp_path, pipeline):
+    team_a = write_config(tmp_path / "a.yaml", [
+        {"name": "redis", "repo": "stable", "versions": [{"version": "1.0.0"}]}
+    ], [])
+    team_b = write_config(tmp_path / "b.yaml", [
+        {"name": "redis", "repo": "stable", "versions": [{"version": "2.0.0"}]}
+    ], [])
+    assert batch([team_a, team_b]) == 0
+    assert sorted(chart.local_dir for chart in pipeline["reconciled"]) == [
+        "/tmp/stable/redis/0", "/tmp/stable/redis/2.0.0"
+    ]
+
+
+def test_batch_mirrors_selected_tags(tmp_path, pipeline, monkeypatch):
+    tags = {
+        "ghcr.io/org/tool": {"v1.0", "v1.1", "v2.0"},
+        "gcr.io/tool": {"v1.0"},
+        "quay.io/tool": set(),
+    }
+    monkeypatch.setattr(helm_image_mirror, "list_tags", lambda image: tags[image])
+    selector = {"repository": "ghcr.io/org/tool", "tags": ["v1.*"]}
+    team_a = write_config(tmp_path / "a.yaml", [], [{"name": "gcr.io"}])
+    team_b = write_config(
+        tmp_path / "b.yaml", [], [{"name": "gcr.io"}, {"name": "quay.io"}]
+    )
+    for path in (team_a, team_b):
+        with open(path, "a") as f:
+            f.write(yaml.safe_dump({"images": [selector]}))
+    report_file = tmp_path / "report.json"
+    assert batch([team_a, team_b], report_file=str(report_file)) == 0
+    # only the tags missing from each registry are pulled and pushed
+    assert sorted(pipeline["pulled"]) == ["ghcr.io/org/tool:v1.0", "ghcr.io/org/tool:v1.1"]
+    assert pipeline["pushed"]["gcr.io"] == ["ghcr.io/org/tool:v1.1"]
+    assert sorted(pipeline["pushed"]["quay.io"]) == [
+        "ghcr.io/org/tool:v1.0", "ghcr.io/org/tool:v1.1"
+    ]
+    with open(report_file) as f:
+        report = json.load(f)
+    assert report[team_b]["Tag Status"]["ghcr.io/org/tool"] == {
+        "Matched": ["v1.0", "v1.1"], "gcr.io": ["v1.1"], "quay.io": ["v1.0", "v1.1"],
+    }
+
+
+def test_batch_isolates_render_failures(tmp_path, pipeline, monkeypatch):
+    images = Chart.images
+
+    def render(self, workers=1):
+        if self.chart_name == "broken":
+            raise subprocess.CalledProcessError(1, "helm template")
+        return images(self, workers)
+
+    monkeypatch.setattr(Chart, "images", render)
+    monkeypatch.setattr(helm_image_mirror, "pull_images",
+                        lambda images, workers=1, use_store=False: {"nginx:1.19"})
+    team_a = write_config(tmp_path / "a.yaml", [
+        {"name": "redis", "repo": "stable", "versions": [{"version": "1.0.0"}]},
+        {"name": "nginx", "repo": "stable", "versions": [{"version": "2.0.0"}]},
+    ], [{"name": "gcr.io"}])
+    team_b = write_config(tmp_path / "b.yaml", [
+        {"name": "broken", "repo": "stable", "versions": [{"version": "1.0.0"}]}
+    ], [{"name": "gcr.io"}])
+    report_file = tmp_path / "report.json"
+    assert batch([team_a, team_b], report_file=str(report_file)) == 1
+    # the charts of other configurations are mirrored
+    assert sorted(chart.combined_name for chart in pipeline["reconciled"]) == [
+        "stable/nginx-2.0.0", "stable/redis-1.0.0"
+    ]
+    with open(report_file) as f:
+        report = json.load(f)
+    assert "render" in report[team_b]["Chart Status"]["stable/broken-1.0.0"]
+    assert "stable/broken-1.0.0" not in report[team_a]["Chart Status"]
+    assert report[team_a]["Chart Status"]["stable/nginx-2.0.0"]["Failed images"] == [
+        "nginx:1.19"
+    ]
+    assert "Failed images" not in report[team_a]["Chart Status"]["stable/redis-1.0.0"]
@@ -0,0 +1,202 @@
+#!/usr/bin/python3
+
+import json
+import os
+import re
+import shlex
+import subprocess
+import sys
+import tarfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+base_path = re.search("^(.*)/test/", os.path.abspath(__file__))
+sys.path.append(os.path.join(base_path.group(1), "src"))
+
+import helm_image_mirror
+from fake_registry import FakeRegistry
+from helm_image_mirror import (
+    BlobStore,
+    get_blob_store,
+    parse_size,
+    pull_images,
+    sha256_digest,
+)
+
+
+@pytest.fixture(autouse=True)
+def reset_caches(monkeypatch):
+    monkeypatch.setattr(helm_image_mirror, "_registry_clients", {})
+    monkeypatch.setattr(helm_image_mirror, "BLOB_STORE", None)
+
+
+def writer(data, calls=None):
+    def download(f):
+        if calls is not None:
+            calls.append(data)
+        f.write(data)
+    return download
+
+
+def test_fetch_hit_and_miss(tmp_path):
+    store = BlobStore(str(tmp_path))
+    data = b"layer" * 100
+    calls = []
+    path = store.fetch(sha256_digest(data), writer(data, calls))
+    assert open(path, "rb").read() == data
+    assert store.fetch(sha256_digest(data), writer(data, calls)) == path
+    assert len(calls) == 1
+    summary = store.summary()
+    assert summary["Hits"] == 1
+    assert summary["Misses"] == 1
+    assert summary["Bytes served"] == len(data)
+    assert summary["Bytes stored"] == len(data)
+    assert summary["Hit ratio"] == 0.5
+    # blobs stored by another run are found
+    assert BlobStore(str(tmp_path)).fetch(sha256_digest(data), writer(data, calls)) == path
+    assert len(calls) == 1
+
+
+def test_digest_mismatch_is_not_stored(tmp_path):
+    store = BlobStore(str(tmp_path))
+    with pytest.raises(OSError):
+        store.fetch(sha256_digest(b"expected"), writer(b"corrupted"))
+    assert store.scan_size() == 0
+    assert not [name for name in os.listdir(tmp_path / "sha256") if name.endswith(".tmp")]
+
+
+def test_concurrent_fetch_downloads_once(tmp_path):
+    store = BlobStore(str(tmp_path))
+    data = b"shared base layer"
+    calls = []
+
+    def slow_download(f):
+        calls.append(1)
+        time.sleep(0.2)
+        f.write(data)
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        paths = set(executor.map(
+            lambda _: store.fetch(sha256_digest(data), slow_download), range(4)
+        ))
+    assert len(paths) == 1
+    assert len(calls) == 1
+    assert store.summary()["Hits"] == 3
+
+
+def test_lru_eviction(tmp_path):
+    store = BlobStore(str(tmp_path), max_size=250)
+    blobs = [bytes([i]) * 100 for i in range(3)]
+    paths = []
+    for i, data in enumerate(blobs):
+        paths.append(store.fetch(sha256_digest(data), writer(data)))
+        os.utime(paths[-1], (1000 + i, 1000 + i))
+    # the oldest blob was evicted to make room for the third one
+    assert not os.path.exists(paths[0])
+    assert os.path.exists(paths[1]) and os.path.exists(paths[2])
+    # using a blob makes it the most recently used
+    store.fetch(sha256_digest(blobs[1]), writer(blobs[1]))
+    data = bytes([3]) * 100
+    store.fetch(sha256_digest(data), writer(data))
+    assert os.path.exists(paths[1])
+    assert not os.path.exists(paths[2])
+    assert store.summary()["Evicted"] == 2
+    assert store.scan_size() <= 250
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [(1024, 1024), ("512", 512), ("10K", 10240), ("1.5G", 1.5 * (1 << 30)), ("20GiB", 20 << 30)],
+)
+def test_parse_size(value, expected):
+    assert parse_size(value) == int(expected)
+
+
+def test_get_blob_store(tmp_path):
+    assert get_blob_store(None) is None
+    assert get_blob_store({"max_size": "1G"}) is None
+    assert get_blob_store({"path": str(tmp_path), "max_size": "lots"}) is None
+    store = get_blob_store({"path": str(tmp_path), "max_size": "1M"})
+    assert store.max_size == 1 << 20
+
+
+def test_registry_blobs_served_from_store(tmp_path, monkeypatch):
+    monkeypatch.setattr(helm_image_mirror, "BLOB_STORE", BlobStore(str(tmp_path)))
+    with FakeRegistry() as registry:
+        data = b"config blob"
+        digest = registry.add_blob("redis", data)
+        client = helm_image_mirror.get_registry_client(registry.host)
+        assert client.get_blob("redis", digest) == data
+        with open(tmp_path / "copy", "wb") as f:
+            client.download_blob("redis", digest, f)
+        assert (tmp_path / "copy").read_bytes() == data
+        gets = [r for r in registry.requests if r[0] == "GET" and "/blobs/" in r[1]]
+        assert len(gets) == 1
+
+
+def test_pull_images_through_store(tmp_path, monkeypatch):
+    store = BlobStore(str(tmp_path / "store"))
+    monkeypatch.setattr(helm_image_mirror, "BLOB_STORE", store)
+    loaded = []
+
+    def docker(command, cancel=None):
+        if command.startswith("load"):
+            with tarfile.open(shlex.split(command)[-1]) as tar:
+                manifest = json.load(tar.extractfile("manifest.json"))[0]
+                if "broken" in manifest["RepoTags"][0]:
+                    raise subprocess.CalledProcessError(1, command)
+                loaded.append((manifest, {
+                    name: tar.extractfile(name).read()
+                    for name in [manifest["Config"]] + manifest["Layers"]
+                }))
+        else:
+            loaded.append(command)
+        return b""
+
+    monkeypatch.setattr(helm_image_mirror, "docker", docker)
+    with FakeRegistry() as registry:
+        config, layer = b'{"rootfs": {}}', b"layer content"
+        image_manifest = {
+            "config": {"digest": registry.add_blob("redis", config)},
+            "layers": [{"digest": registry.add_blob("redis", layer)}],
+        }
+        platform = registry.add_manifest("redis", "amd", image_manifest)
+        registry.add_manifest("redis", "6.0", {"manifests": [
+            {"digest": "sha256:other", "platform": {"architecture": "s390x"}},
+            {"digest": platform, "platform": {"architecture": "amd64"}},
+        ]}, media_type=helm_image_mirror.MANIFEST_LIST_MEDIA_TYPES[0])
+        monkeypatch.setattr(os, "uname", lambda: type("uname", (), {"machine": "x86_64"}))
+        image = "{}/redis:6.0".format(registry.host)
+        assert pull_images([image, image + "-missing"], use_store=True) == set()
+        manifest, files = loaded[0]
+        assert manifest["RepoTags"] == [image]
+        assert files[manifest["Config"]] == config
+        assert files[manifest["Layers"][0]] == layer
+        # images that can not be read through the registry API are pulled by docker
+        assert loaded[1] == "pull {}-missing".format(image)
+
+        # the blobs of later pulls are read from the store
+        assert pull_images([image], use_store=True) == set()
+        gets = [r for r in registry.requests if r[0] == "GET" and "/blobs/" in r[1]]
+        assert len(gets) == 2
+        assert store.summary()["Hits"] == 2
+
+        # untagged images are loaded with their full reference
+        for repository in ("redis", "broken"):
+            for blob in (config, layer):
+                registry.add_blob(repository, blob)
+            registry.add_manifest(repository, "latest", image_manifest)
+        del loaded[:]
+        untagged = "{}/redis".format(registry.host)
+        broken = "{}/broken".format(registry.host)
+        assert pull_images([untagged, broken], use_store=True) == set()
+        assert loaded[0][0]["RepoTags"] == [untagged + ":latest"]
+        # images docker fails to load are pulled by docker
+        assert loaded[1] == "pull " + broken
+
+        # existing images are only detected by digest if docker pulls them
+        del loaded[:]
+        assert pull_images([image]) == set()
+        assert loaded == ["pull " + image]
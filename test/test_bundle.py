@@ -0,0 +1,199 @@
+#!/usr/bin/python3
+
+import io
+import json
+import os
+import re
+import subprocess
+import sys
+import tarfile
+
+import pytest
+
+base_path = re.search("^(.*)/test/", os.path.abspath(__file__))
+sys.path.append(os.path.join(base_path.group(1), "src"))
+
+import helm_image_mirror
+from fake_registry import FakeRegistry
+from helm_image_mirror import (
+    Bundle,
+    Chart,
+    Registry,
+    Repo,
+    export_bundle,
+    get_push_targets,
+    import_charts,
+    import_images,
+)
+
+
+@pytest.fixture(autouse=True)
+def reset_caches(monkeypatch):
+    monkeypatch.setattr(helm_image_mirror, "_known_blobs", {})
+    monkeypatch.setattr(helm_image_mirror, "_registry_clients", {})
+
+
+def add_image(registry, repository, tag, layers):
+    config = registry.add_blob(repository, json.dumps({"tag": tag}).encode())
+    descriptors = []
+    for layer in layers:
+        digest = registry.add_blob(repository, layer)
+        descriptors.append({"digest": digest, "size": len(layer)})
+    return registry.add_manifest(repository, tag, {
+        "config": {"digest": config, "size": len(json.dumps({"tag": tag}))},
+        "layers": descriptors,
+    })
+
+
+def base_digest(data):
+    return helm_image_mirror.sha256_digest(data)
+
+
+def make_chart(tmp_path, name="redis", version="1.0.0"):
+    archive = tmp_path / "{}-{}.tgz".format(name, version)
+    chart_yaml = "apiVersion: v2\nname: {}\nversion: {}\n".format(name, version)
+    with tarfile.open(archive, "w:gz") as tar:
+        info = tarfile.TarInfo("{}/Chart.yaml".format(name))
+        info.size = len(chart_yaml)
+        tar.addfile(info, io.BytesIO(chart_yaml.encode()))
+    return Chart("stable", name, version, str(tmp_path), False, push=["oci"])
+
+
+def test_export_deduplicates_and_resumes(tmp_path):
+    base = b"base layer" * 1000
+    with FakeRegistry() as source:
+        add_image(source, "redis", "6.0", [base, b"redis"])
+        add_image(source, "nginx", "1.19", [base, b"nginx"])
+        images = ["{}/redis:6.0".format(source.host), "{}/nginx:1.19".format(source.host)]
+        bundle = Bundle(str(tmp_path / "bundle"))
+        report, err = export_bundle([], images, bundle, workers=2)
+        assert not err
+        assert sorted(report["Image Status"]["Exported"]) == sorted(images)
+        # 2 configs, 3 distinct layers and 2 manifests
+        assert report["Bundle Status"]["Blobs written"] == 7
+        assert report["Bundle Status"]["Blobs present"] == 1
+        base_gets = [
+            request for request in source.requests
+            if request[0] == "GET" and request[1].endswith(base_digest(base))
+        ]
+        assert len(base_gets) == 1
+
+        with open(tmp_path / "bundle" / "oci-layout") as f:
+            assert json.load(f) == {"imageLayoutVersion": "1.0.0"}
+        index = Bundle(str(tmp_path / "bundle")).entries("image")
+        assert [
+            entry["annotations"]["org.opencontainers.image.ref.name"] for entry in index
+        ] == sorted(images)
+
+        # an interrupted export is resumed without downloading blobs again
+        report, err = export_bundle([], images, Bundle(str(tmp_path / "bundle")))
+        assert report["Bundle Status"]["Blobs written"] == 0
+
+
+def test_incremental_export_and_import(tmp_path):
+    base = b"base layer" * 1000
+    with FakeRegistry() as source, FakeRegistry() as target:
+        add_image(source, "redis", "6.0", [base, b"redis"])
+        add_image(source, "redis", "6.2", [base, b"redis 6.2"])
+        old = ["{}/redis:6.0".format(source.host)]
+        new = ["{}/redis:6.2".format(source.host)]
+        first = Bundle(str(tmp_path / "first"))
+        export_bundle([], old, first)
+        first.write_tar(str(tmp_path / "first.tar"))
+
+        second = Bundle(str(tmp_path / "second"))
+        report, err = export_bundle([], new, second, since=Bundle(str(tmp_path / "first.tar")))
+        assert not err
+        assert report["Bundle Status"]["Blobs in prior bundle"] == 1
+        assert not second.has_blob(base_digest(base))
+
+        registries = [Registry("mirror.local", True, False)]
+        # keep the repository path of the source images
+        registries[0].target_name = lambda image: image.replace(source.host, target.host)
+        status, err = import_images(Bundle(str(tmp_path / "first.tar")), registries)
+        assert not err
+        assert status["mirror.local"]["Pushed"] == ["{}/redis:6.0".format(target.host)]
+        assert ("redis", "6.0") in target.manifests
+
+        # blobs missing from the incremental bundle are found in the registry
+        status, err = import_images(second, registries)
+        assert not err
+        assert ("redis", "6.2") in target.manifests
+        status, err = import_images(second, registries)
+        assert status["mirror.local"]["Already present"] == [
+            "{}/redis:6.2".format(target.host)
+        ]
+
+
+def test_import_missing_blob_fails(tmp_path):
+    with FakeRegistry() as source, FakeRegistry() as target:
+        add_image(source, "redis", "6.0", [b"base", b"redis"])
+        add_image(source, "redis", "6.2", [b"base", b"redis 6.2"])
+        first = Bundle(str(tmp_path / "first"))
+        export_bundle([], ["{}/redis:6.0".format(source.host)], first)
+        second = Bundle(str(tmp_path / "second"))
+        export_bundle([], ["{}/redis:6.2".format(source.host)], second, since=first)
+        registry = Registry(target.host, True, False)
+        status, err = import_images(second, [registry])
+        assert err
+        assert list(status[target.host]["Failed to push"]) == [
+            "{}/redis:6.2".format(target.host)
+        ]
+
+
+def test_export_import_chart(tmp_path, monkeypatch):
+    monkeypatch.setattr(Chart, "pull", lambda self: None)
+    chart = make_chart(tmp_path)
+    bundle = Bundle(str(tmp_path / "bundle"))
+    report, err = export_bundle([chart], [], bundle)
+    assert not err
+    assert report["Chart Status"]["Exported"] == ["stable/redis-1.0.0"]
+    bundle.write_tar(str(tmp_path / "bundle.tar"))
+
+    with FakeRegistry() as target:
+        repos = [Repo("oci", "oci://{}/charts".format(target.host), None, None, "oci")]
+        push_targets = get_push_targets([
+            {"name": "redis", "repo": "stable", "push": ["oci"],
+             "versions": [{"version": "0.9.0", "push": ["other"]}]},
+        ])
+        status, err = import_charts(Bundle(str(tmp_path / "bundle.tar")), repos, push_targets)
+        assert not err
+        assert status == {
+            "stable/redis-1.0.0": {
+                "Pushed": ["oci"], "Already published": [], "Failed to push": {}
+            }
+        }
+        assert ("charts/redis", "1.0.0") in target.manifests
+        status, err = import_charts(Bundle(str(tmp_path / "bundle")), repos, push_targets)
+        assert status["stable/redis-1.0.0"]["Already published"] == ["oci"]
+
+
+def test_export_reports_render_failures(tmp_path, monkeypatch):
+    def images(self, workers=1):
+        if self.chart_name == "broken":
+            raise subprocess.CalledProcessError(1, "helm template")
+        return {"redis:6.0"}
+
+    exported = []
+
+    def export_bundle(charts, images, bundle, since=None, workers=1):
+        exported.append(([chart.combined_name for chart in charts], images))
+        return {"Chart Status": {"Exported": [], "Failed to export": {}}}, False
+
+    monkeypatch.setattr(helm_image_mirror, "setup", lambda config: ([], {}, False))
+    monkeypatch.setattr(Chart, "fetch", lambda self: None)
+    monkeypatch.setattr(Chart, "images", images)
+    monkeypatch.setattr(helm_image_mirror, "export_bundle", export_bundle)
+    config = tmp_path / "config.yaml"
+    config.write_text(json.dumps({"charts": [
+        {"name": name, "repo": "stable", "versions": [{"version": "1.0.0"}]}
+        for name in ("redis", "broken")
+    ]}))
+    report = tmp_path / "report.json"
+    assert helm_image_mirror.export_main([
+        "-c", str(config), "-o", str(tmp_path / "bundle"), "--report", str(report),
+    ]) == 1
+    assert exported == [(["stable/redis-1.0.0"], {"redis:6.0"})]
+    with open(report) as f:
+        failures = json.load(f)["Chart Status"]["Failed to export"]
+    assert list(failures) == ["stable/broken-1.0.0"]
@@ -0,0 +1,167 @@
+#!/usr/bin/python3
+
+import os
+import re
+import socket
+import sys
+import threading
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+base_path = re.search("^(.*)/test/", os.path.abspath(__file__))
+sys.path.append(os.path.join(base_path.group(1), "src"))
+
+from helm_image_mirror import Chart, Repo, UploadError, get_repo_objs, idempotent
+
+
+class FakeChartMuseum:
+    """Records chart uploads and the client connections they arrived on"""
+
+    def __init__(self, status=201):
+        self.uploads = []
+        self.connections = set()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def upload(self):
+                fake.connections.add(self.client_address)
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                fake.uploads.append((
+                    self.command, self.path, self.headers.get("Content-Type"),
+                    self.headers.get("Authorization"), body,
+                ))
+                self.send_response(status)
+                self.send_header("Content-Length", "2")
+                self.end_headers()
+                self.wfile.write(b"{}")
+
+            do_POST = upload
+            do_PUT = upload
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:{}".format(self.server.server_port)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def chartmuseum():
+    server = FakeChartMuseum()
+    yield server
+    server.close()
+
+
+def make_charts(tmp_path, count):
+    charts = []
+    for i in range(count):
+        version = "1.0.{}".format(i)
+        (tmp_path / "redis-{}.tgz".format(version)).write_bytes(version.encode())
+        charts.append(Chart("stable", "redis", version, str(tmp_path), True))
+    return charts
+
+
+def test_chartmuseum_upload_reuses_connections(tmp_path, chartmuseum):
+    repo = Repo("cm", chartmuseum.url, "user", "pass", "chartmuseum")
+    charts = make_charts(tmp_path, 20)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        list(executor.map(lambda chart: chart.push(repo), charts))
+    assert len(chartmuseum.uploads) == 20
+    assert len(chartmuseum.connections) <= 4
+    method, path, content_type, auth, _ = chartmuseum.uploads[0]
+    assert (method, path, content_type) == (
+        "POST", "/api/charts", "application/octet-stream"
+    )
+    assert auth == "Basic dXNlcjpwYXNz"
+    assert sorted(upload[4] for upload in chartmuseum.uploads) == sorted(
+        chart.version.encode() for chart in charts
+    )
+
+
+@pytest.mark.parametrize(
+    "repo_type,remote_path,method,path",
+    [
+        ("chartmuseum", "/org/repo", "POST", "/api/org/repo/charts"),
+        ("harbor", "/chartrepo/library", "POST", "/api/chartrepo/library/charts"),
+        ("nexus", "/repository/helm", "PUT", "/repository/helm/redis-1.0.0.tgz"),
+    ],
+)
+def test_upload_variants(tmp_path, chartmuseum, repo_type, remote_path, method, path):
+    repo = Repo("target", chartmuseum.url + remote_path, None, None, repo_type)
+    make_charts(tmp_path, 1)[0].push(repo)
+    upload = chartmuseum.uploads[0]
+    assert upload[:2] == (method, path)
+    assert upload[3] is None
+    if repo_type == "harbor":
+        assert upload[2].startswith("multipart/form-data; boundary=")
+        assert b'name="chart"; filename="redis-1.0.0.tgz"' in upload[4]
+    else:
+        assert upload[4] == b"1.0.0"
+
+
+def test_upload_conflict(tmp_path):
+    server = FakeChartMuseum(status=409)
+    try:
+        repo = Repo("cm", server.url, None, None, "chartmuseum")
+        with pytest.raises(UploadError):
+            make_charts(tmp_path, 1)[0].push(repo)
+    finally:
+        server.close()
+
+
+def test_upload_not_repeated_after_connection_loss(tmp_path):
+    # accepts the upload and drops the connection without a response
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen()
+    requests = []
+
+    def serve():
+        while True:
+            try:
+                conn, _ = server.accept()
+            except OSError:
+                return
+            requests.append(conn.recv(65536))
+            conn.close()
+
+    threading.Thread(target=serve, daemon=True).start()
+    try:
+        url = "http://127.0.0.1:{}".format(server.getsockname()[1])
+        repo = Repo("cm", url, None, None, "chartmuseum")
+        with pytest.raises(UploadError):
+            make_charts(tmp_path, 1)[0].push(repo)
+        assert len(requests) == 1
+    finally:
+        server.close()
+
+
+def test_idempotent():
+    def parts(url):
+        return urllib.parse.urlsplit(url)
+
+    assert idempotent("GET", parts("http://cm/index.yaml"))
+    assert idempotent("PUT", parts("http://r/v2/a/blobs/uploads/1?digest=sha256:1"))
+    assert idempotent("PUT", parts("http://r/v2/a/manifests/1.0"))
+    assert not idempotent("PUT", parts("http://nexus/repository/helm/a-1.0.tgz"))
+    assert not idempotent("POST", parts("http://cm/api/charts"))
+
+
+def test_invalid_repo_type():
+    repos = [
+        {"name": "cm", "remote": "https://cm", "type": "chartmuseum"},
+        {"name": "bad", "remote": "https://bad", "type": "ftp"},
+    ]
+    assert get_repo_objs(repos, None, None) == [
+        Repo("cm", "https://cm", None, None, "chartmuseum")
+    ]
@@ -1,5 +1,6 @@
 #!/usr/bin/python3
 
+import hashlib
 import os
 import re
 import sys
@@ -10,7 +11,8 @@ import yaml
 base_path = re.search("^(.*)/test/", os.path.abspath(__file__))
 sys.path.append(os.path.join(base_path.group(1), "src"))
 
-from helm_image_mirror import Chart, get_charts
+import helm_image_mirror
+from helm_image_mirror import Chart, Repo, get_charts, reconcile_charts
 
 config = """
 charts:
@@ -38,6 +40,8 @@ charts:
       version: 3.0.0
       push:
         - target3
+      values_matrix:
+        - set: metrics.enabled=true
   # chart specific false
   - fetch: false
     repo: prod
@@ -74,7 +78,8 @@ def test_get_charts(global_fetch_policy):
         Chart("stable", "redis", "1.0.0", "tc1", True, 
           {"set": "abc.xyz=2", "set_str": "qwe.rty=false"}, ['target1', 'target2']),
         Chart("stable", "redis", "2.0.0", "tc2", False, group1_values, ['target1', 'target2']),
-        Chart("stable", "redis", "3.0.0", "tc3", True, group1_values, ['target3']),
+        Chart("stable", "redis", "3.0.0", "tc3", True, group1_values, ['target3'],
+          values_matrix=[{"set": "metrics.enabled=true"}]),
         Chart("prod", "mongo", "4.0.0", "tc4", True),
         Chart("prod", "mongo", "5.0.0", "tc5", False),
         Chart("prod", "mongo", "6.0.0", "/tmp/prod/mongo/2", False),
@@ -105,4 +110,63 @@ def test_get_charts(global_fetch_policy):
     ],
 )
 def test_get_add_cmd(chart, expected):
-    assert chart.get_template_cmd() == expected
\ No newline at end of file
+    assert chart.get_template_cmd() == expected
+
+
+def test_reconcile_charts_skips_published_versions(tmp_path, monkeypatch):
+    archive = b"chart archive"
+    (tmp_path / "redis-1.0.0.tgz").write_bytes(archive)
+    digest = hashlib.sha256(archive).hexdigest()
+    monkeypatch.setattr(helm_image_mirror, "_repo_indexes", {
+        "published": {"entries": {"redis": [{"version": "1.0.0", "digest": digest}]}},
+        "stale": {"entries": {"redis": [{"version": "1.0.0", "digest": "other"}]}},
+        "empty": {},
+    })
+    pushed = []
+    monkeypatch.setattr(Chart, "pull", lambda self: None)
+    monkeypatch.setattr(Chart, "push", lambda self, repo: pushed.append(repo.name))
+    repos = [
+        Repo("published", "https://a", None, None),
+        Repo("stale", "https://b", None, None),
+        Repo("empty", "https://c", None, None),
+    ]
+    chart = Chart(
+        "stable", "redis", "1.0.0", str(tmp_path), True,
+        push=["published", "stale", "empty", "missing"],
+    )
+    status, err = reconcile_charts([chart], repos, workers=2)
+    stat = status["stable/redis-1.0.0"]
+    assert err
+    assert sorted(pushed) == ["empty", "stale"]
+    assert sorted(stat["Pushed"]) == ["empty", "stale"]
+    assert stat["Already published"] == ["published"]
+    assert list(stat["Failed to push"]) == ["missing"]
+
+
+def test_value_sets():
+    chart = Chart(
+        "stable", "redis", "1.0.0", "tc1", True,
+        {"set": "a=1", "set_string": "b=x"},
+        values_matrix=[{"set": "metrics.enabled=true"}, {"set_string": "c=y"}],
+    )
+    assert chart.value_sets() == [
+        {"set": "a=1", "set_string": "b=x"},
+        {"set": "a=1,metrics.enabled=true", "set_string": "b=x"},
+        {"set": "a=1", "set_string": "b=x,c=y"},
+    ]
+
+
+def test_images_unions_values_matrix(tmp_path, monkeypatch):
+    rendered = {
+        None: "image: redis:6.0",
+        "metrics.enabled=true": "image: redis:6.0\n---\nimage: exporter:1.0",
+        "sidecar.enabled=true": "image: redis:6.0\n---\nimage: sidecar:2.0",
+    }
+    monkeypatch.setattr(
+        Chart, "template", lambda self, values=None: rendered[(values or {}).get("set")]
+    )
+    chart = Chart(
+        "stable", "redis", "1.0.0", str(tmp_path), True,
+        values_matrix=[{"set": "metrics.enabled=true"}, {"set": "sidecar.enabled=true"}],
+    )
+    assert chart.images(workers=2) == {"redis:6.0", "exporter:1.0", "sidecar:2.0"}
@@ -0,0 +1,89 @@
+#!/usr/bin/python3
+
+import copy
+import os
+import re
+import sys
+
+import yaml
+
+base_path = re.search("^(.*)/test/", os.path.abspath(__file__))
+sys.path.append(os.path.join(base_path.group(1), "src"))
+
+from helm_image_mirror import Chart, get_charts, iter_charts, load_config
+
+
+def write(path, config):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(yaml.safe_dump(config))
+    return str(path)
+
+
+def test_load_config_includes(tmp_path):
+    write(tmp_path / "charts" / "b.yaml", {
+        "charts": [{"name": "nginx", "repo": "stable"}],
+        "repos": {"add": [{"name": "other", "remote": "https://other.example.com"}]},
+    })
+    write(tmp_path / "charts" / "a.yaml", {
+        "charts": [{"name": "redis", "repo": "stable"}],
+        "include": "../registries.yaml",
+        "workers": 16,
+    })
+    write(tmp_path / "registries.yaml", {"registries": [{"name": "gcr.io"}]})
+    path = write(tmp_path / "config.yaml", {
+        "include": ["charts/*.yaml"],
+        "workers": 2,
+        "repos": {"username": None, "password": None,
+                  "add": [{"name": "stable", "remote": "https://stable.example.com"}]},
+        "charts": [{"name": "etcd", "repo": "stable"}],
+    })
+    config = load_config(path)
+    assert [chart["name"] for chart in config["charts"]] == ["etcd", "redis", "nginx"]
+    assert config["registries"] == [{"name": "gcr.io"}]
+    assert [repo["name"] for repo in config["repos"]["add"]] == ["stable", "other"]
+    assert config["repos"]["username"] is None
+    # settings of the including file take precedence
+    assert config["workers"] == 2
+    assert "include" not in config
+
+
+def test_load_config_include_errors(tmp_path):
+    path = write(tmp_path / "config.yaml", {"include": ["missing.yaml"]})
+    assert load_config(path) is None
+    # patterns matching no files are allowed
+    write(tmp_path / "config.yaml", {"include": ["charts/*.yaml"], "workers": 1})
+    assert load_config(path) == {"workers": 1}
+    write(tmp_path / "a.yaml", {"include": ["config.yaml"]})
+    write(tmp_path / "config.yaml", {"include": ["a.yaml"]})
+    assert load_config(path) is None
+
+
+def test_iter_charts_is_lazy():
+    charts_config = [
+        {"name": "redis", "repo": "stable", "push": ["a"], "values": {"set": "x=1"},
+         "versions": [{"version": str(i)} for i in range(10000)]},
+    ]
+    charts = iter_charts(charts_config, True)
+    first = next(charts)
+    assert first.combined_name == "stable/redis-0"
+    # versions share the settings of the chart
+    second = next(charts)
+    assert second.push_targets is first.push_targets
+    assert second.values is first.values
+    assert not hasattr(first, "__dict__")
+
+
+def test_chart_defaults_and_equality():
+    chart = Chart("stable", "redis", "1.0.0", "/tmp/redis", True)
+    other = Chart("stable", "redis", "1.0.0", "/tmp/redis", True)
+    chart.push_targets.append("a")
+    # defaults are not shared between instances
+    assert other.push_targets == []
+    assert chart != other
+    other.push_targets.append("a")
+    assert chart == other
+    copied = copy.copy(chart)
+    assert copied == chart and copied is not chart
+    assert get_charts([{"name": "redis", "repo": "stable",
+                        "versions": [{"version": "1.0.0", "local_dir": "/tmp/redis"}]}],
+                      True) == [Chart("stable", "redis", "1.0.0", "/tmp/redis", True)]
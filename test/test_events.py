@@ -0,0 +1,82 @@
+#!/usr/bin/python3
+
+import io
+import json
+import os
+import re
+import sys
+import pytest
+
+base_path = re.search("^(.*)/test/", os.path.abspath(__file__))
+sys.path.append(os.path.join(base_path.group(1), "src"))
+
+import helm_image_mirror
+from helm_image_mirror import EventLog, run_scripts
+
+
+def read_events(stream):
+    return [json.loads(line) for line in stream.getvalue().splitlines()]
+
+
+def test_emit_streams_and_aggregates():
+    stream = io.StringIO()
+    events = EventLog(stream)
+    events.emit("image_pull", "redis:6.0", duration=1.5, bytes=1000)
+    events.emit("image_pull", "etcd:v3", status="failed", duration=0.5)
+    events.emit("image_push", "gcr.io/redis:6.0", duration=2, bytes=1000)
+    lines = read_events(stream)
+    assert [(e["event"], e["target"], e["status"]) for e in lines] == [
+        ("image_pull", "redis:6.0", "ok"),
+        ("image_pull", "etcd:v3", "failed"),
+        ("image_push", "gcr.io/redis:6.0", "ok"),
+    ]
+    summary = events.summary()
+    assert summary["operations"]["image_pull"] == {
+        "ok": 1, "failed": 1, "duration": 2.0, "bytes": 1000
+    }
+    assert summary["images_per_min"] > 0
+    assert summary["mb_per_s"] > 0
+
+
+def test_timed_records_failures():
+    stream = io.StringIO()
+    events = EventLog(stream)
+    with events.timed("chart_push", "stable/redis-1.0.0", repo="cm") as event:
+        event["bytes"] = 10
+    with pytest.raises(ValueError):
+        with events.timed("chart_push", "stable/redis-2.0.0", repo="cm"):
+            raise ValueError("password=secret")
+    ok, failed = read_events(stream)
+    assert (ok["status"], ok["bytes"], ok["repo"]) == ("ok", 10, "cm")
+    assert (failed["status"], failed["error"]) == ("failed", "ValueError")
+    assert "secret" not in stream.getvalue()
+
+
+def test_finish_emits_summary(capsys):
+    stream = io.StringIO()
+    events = EventLog(stream)
+    events.emit("repo_add", "stable")
+    events.finish()
+    summary = read_events(stream)[-1]
+    assert summary["event"] == "summary"
+    assert summary["operations"]["repo_add"]["ok"] == 1
+    assert capsys.readouterr().out.startswith("Throughput: ")
+
+
+def test_disabled_stream_still_aggregates():
+    events = EventLog()
+    events.emit("chart_fetch", "stable/redis-1.0.0")
+    assert events.summary()["operations"]["chart_fetch"]["ok"] == 1
+
+
+def test_script_events(tmp_path, monkeypatch):
+    stream = io.StringIO()
+    monkeypatch.setattr(helm_image_mirror, "EVENTS", EventLog(stream))
+    script = tmp_path / "hook.sh"
+    script.write_text("#!/bin/sh\nexit 1\n")
+    script.chmod(0o755)
+    run_scripts([str(script)], ["a"])
+    event = read_events(stream)[0]
+    assert (event["event"], event["status"], event["args"]) == (
+        "script", "failed", ["a"]
+    )
@@ -0,0 +1,188 @@
+#!/usr/bin/python3
+
+import io
+import os
+import re
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+base_path = re.search("^(.*)/test/", os.path.abspath(__file__))
+sys.path.append(os.path.join(base_path.group(1), "src"))
+
+import helm_image_mirror
+from helm_image_mirror import CommandTimeout, Hedger, HTTPSession, execute, get_timeouts
+
+
+@pytest.fixture(autouse=True)
+def limits(monkeypatch):
+    monkeypatch.setattr(helm_image_mirror, "TIMEOUTS", {})
+    monkeypatch.setattr(helm_image_mirror, "STALL_TIMEOUT", None)
+    monkeypatch.setattr(helm_image_mirror, "CANCELLED", threading.Event())
+
+
+def pid_alive(pid):
+    try:
+        with open("/proc/{}/stat".format(pid)) as f:
+            # killed children may linger as zombies until they are reaped
+            return f.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except FileNotFoundError:
+        return False
+
+
+def exits(pid, timeout=5):
+    """Returns True once given process has exited, signals are
+    delivered to the children of a killed command asynchronously"""
+    deadline = time.monotonic() + timeout
+    while pid_alive(pid) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    return not pid_alive(pid)
+
+
+def test_execute_output_and_failure():
+    assert execute("echo hello") == b"hello\n"
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        execute("sh -c 'echo oops >&2; exit 3'")
+    assert e.value.returncode == 3
+    assert e.value.stderr == b"oops\n"
+    assert not isinstance(e.value, CommandTimeout)
+    assert execute("cat", input=b"s3cret") == b"s3cret"
+
+
+def test_timeout_kills_process_group(tmp_path, monkeypatch):
+    monkeypatch.setattr(helm_image_mirror, "TIMEOUTS", {"default": 1})
+    pid_file = tmp_path / "pid"
+    command = "sh -c 'sleep 60 & echo $! > {}; wait'".format(pid_file)
+    with pytest.raises(CommandTimeout) as e:
+        execute(command, operation="helm_pull")
+    assert "timed out after 1 seconds" in str(e.value)
+    # the child of the command is killed as well
+    assert exits(int(pid_file.read_text()))
+
+
+def test_operation_timeout_overrides_default(monkeypatch):
+    monkeypatch.setattr(
+        helm_image_mirror, "TIMEOUTS", {"default": 1, "docker_pull": 30}
+    )
+    assert execute("sh -c 'sleep 1.5; echo done'", operation="docker_pull") == b"done\n"
+
+
+def test_stall_detection(monkeypatch):
+    monkeypatch.setattr(helm_image_mirror, "STALL_TIMEOUT", 1.5)
+    progressing = "sh -c 'for i in 1 2 3; do echo $i; sleep 0.8; done'"
+    assert execute(progressing, operation="docker_pull") == b"1\n2\n3\n"
+    # stall detection only applies to transfers reporting progress
+    assert execute("sleep 2", operation="helm_pull") == b""
+    with pytest.raises(CommandTimeout) as e:
+        execute("sh -c 'echo start; sleep 60'", operation="docker_push")
+    assert "stalled" in str(e.value)
+    assert e.value.output == b"start\n"
+
+
+def test_cancel():
+    cancel = threading.Event()
+    threading.Timer(0.2, cancel.set).start()
+    with pytest.raises(CommandTimeout) as e:
+        execute("sleep 60", cancel=cancel)
+    assert "cancelled" in str(e.value)
+    helm_image_mirror.CANCELLED.set()
+    with pytest.raises(CommandTimeout):
+        execute("echo never")
+
+
+def test_interrupt_kills_process_group(tmp_path):
+    class Interrupt:
+        def is_set(self):
+            raise KeyboardInterrupt
+
+    pid_file = tmp_path / "pid"
+    command = "sh -c 'sleep 60 & echo $! > {}; wait'".format(pid_file)
+    with pytest.raises(KeyboardInterrupt):
+        execute(command, cancel=Interrupt())
+    assert exits(int(pid_file.read_text()))
+
+
+def test_get_timeouts():
+    assert get_timeouts(
+        {"default": 60, "docker_pull": 1.5, "helm_pull": 0, "docker_push": "x"}
+    ) == {"default": 60, "docker_pull": 1.5}
+    assert get_timeouts(None) == {}
+
+
+def test_hedger_delay():
+    hedger = Hedger(90, min_samples=3)
+    hedger.durations = [1, 2]
+    assert hedger.delay() is None
+    hedger.durations = list(range(1, 11))
+    assert hedger.delay() == 10
+    hedger.percentile = 50
+    assert hedger.delay() == 6
+
+
+def test_hedger_first_success_wins():
+    hedger = Hedger(50, min_samples=1)
+    hedger.durations = [0.1]
+    attempts = []
+
+    def attempt(cancel):
+        attempts.append(cancel)
+        if len(attempts) == 1:
+            # the slow first attempt is cancelled once the hedge succeeds
+            assert cancel.wait(5)
+            raise CommandTimeout(-15, "docker pull", reason="was cancelled")
+        return "hedged"
+
+    started = time.monotonic()
+    assert hedger.run(attempt) == "hedged"
+    assert time.monotonic() - started < 5
+    assert len(attempts) == 2
+    assert hedger.hedged == 1
+
+
+def test_hedger_raises_if_all_attempts_fail():
+    hedger = Hedger(50, min_samples=1)
+    hedger.durations = [0.01]
+
+    def attempt(cancel):
+        time.sleep(0.05)
+        raise subprocess.CalledProcessError(1, "docker pull")
+
+    with pytest.raises(subprocess.CalledProcessError):
+        hedger.run(attempt)
+    assert hedger.durations == [0.01]
+
+
+def test_http_stall_is_measured_in_bytes():
+    # sends the body in chunks, stopping after the given number of chunks
+    def serve(server, chunks):
+        conn, _ = server.accept()
+        conn.recv(65536)
+        conn.sendall(b"HTTP/1.1 200 OK\r\nContent-Length: 10\r\n\r\n")
+        for _ in range(chunks):
+            time.sleep(0.2)
+            conn.sendall(b"x")
+        time.sleep(2)
+        conn.close()
+
+    for chunks, stalls in ((10, False), (3, True)):
+        server = socket.socket()
+        server.bind(("127.0.0.1", 0))
+        server.listen()
+        threading.Thread(target=serve, args=(server, chunks), daemon=True).start()
+        session = HTTPSession(timeout=0.5)
+        url = "http://127.0.0.1:{}/blob".format(server.getsockname()[1])
+        try:
+            if stalls:
+                with pytest.raises(OSError):
+                    session.request("GET", url, sink=io.BytesIO())
+            else:
+                # the transfer takes longer than the timeout as a whole
+                sink = io.BytesIO()
+                assert session.request("GET", url, sink=sink)[0] == 200
+                assert sink.getvalue() == b"x" * 10
+        finally:
+            server.close()
@@ -0,0 +1,136 @@
+#!/usr/bin/python3
+
+import os
+import re
+import sys
+import pytest
+
+import yaml
+
+base_path = re.search("^(.*)/test/", os.path.abspath(__file__))
+sys.path.append(os.path.join(base_path.group(1), "src"))
+
+from helm_image_mirror import (
+    DEFAULT_IMAGE_RULES,
+    ImageExtractor,
+    ImageRule,
+    compose_image,
+    get_image_rules,
+    parse_images,
+)
+
+MANIFESTS_DIR = os.path.join(base_path.group(1), "test", "data", "manifests")
+
+rules_config = r"""
+image_rules:
+  - kinds: [DatabaseCluster]
+    path: spec.engineImage
+  - kinds: [DatabaseCluster]
+    path: spec.sidecars.proxyImage
+  - kinds: [DatabaseCluster]
+    path: spec.*.container
+    fields:
+      repository: repo
+      tag: version
+  - kinds: [ConfigMap]
+    path: data.*
+    regex: ^registry\.example\.com/\S+$
+  - kinds: [ConfigMap]
+  - regex: "["
+"""
+
+
+def read_manifest(name):
+    with open(os.path.join(MANIFESTS_DIR, name), "r") as f:
+        return f.read()
+
+
+@pytest.mark.parametrize(
+    "manifest,expected",
+    [
+        (
+            "operator-deployment.yaml",
+            {
+                "docker.io/bitnami/kubectl:1.25.4",
+                "quay.io/example/operator:v0.9.1",
+                "registry.example.com/db/postgres:14.5",
+                "quay.io/example/backup@sha256:"
+                "0f1e2d3c4b5a69788796a5b4c3d2e1f00f1e2d3c4b5a69788796a5b4c3d2e1f0",
+                "gcr.io/kubebuilder/kube-rbac-proxy:v0.13.1",
+            },
+        ),
+        (
+            "cronjob.yaml",
+            {"busybox:1.36", "docker.io/bitnami/postgresql:15.1.0-debian-11-r0"},
+        ),
+        (
+            "victoriametrics-vmcluster.yaml",
+            {
+                "victoriametrics/vmstorage:v1.87.1-cluster",
+                "victoriametrics/vmselect:v1.87.1-cluster",
+                "quay.io/victoriametrics/vminsert:v1.87.1-cluster",
+                "curlimages/curl:7.87.0",
+            },
+        ),
+        (
+            "prometheus.yaml",
+            {
+                "quay.io/prometheus/prometheus:v2.42.0",
+                "quay.io/prometheus-operator/prometheus-config-reloader:v0.63.0",
+                "quay.io/oauth2-proxy/oauth2-proxy:v7.4.0",
+                "quay.io/thanos/thanos:v0.30.2",
+                "quay.io/prometheus/alertmanager:v0.25.0",
+            },
+        ),
+        ("custom-resources.yaml", set()),
+    ],
+)
+def test_default_rules(manifest, expected):
+    assert parse_images(read_manifest(manifest)) == expected
+
+
+def test_configured_rules():
+    rules = get_image_rules(yaml.safe_load(rules_config)["image_rules"])
+    # invalid rules are reported and ignored
+    assert len(rules) == len(DEFAULT_IMAGE_RULES) + 4
+    extractor = ImageExtractor(rules)
+    assert extractor.parse(read_manifest("custom-resources.yaml")) == {
+        "registry.example.com/db/engine:3.2.1",
+        "registry.example.com/db/proxy:1.4.0",
+        "registry.example.com/db/exporter:0.11.1",
+        "registry.example.com/db/backup:2.0.0",
+    }
+    # rules limited to other kinds do not apply
+    assert extractor.parse(read_manifest("cronjob.yaml")) == parse_images(
+        read_manifest("cronjob.yaml")
+    )
+
+
+@pytest.mark.parametrize(
+    "path,key_path,expected",
+    [
+        ("**.image", "image", True),
+        ("**.image", "spec.template.spec.containers.image", True),
+        ("**.image", "spec.imagePullPolicy", False),
+        ("spec.*.image", "spec.vmstorage.image", True),
+        ("spec.*.image", "spec.a.b.image", False),
+        ("spec.**", "spec.a.b", True),
+        ("**", "anything.at.all", True),
+    ],
+)
+def test_rule_path(path, key_path, expected):
+    assert ImageRule(path).match_path(tuple(key_path.split("."))) == expected
+
+
+@pytest.mark.parametrize(
+    "value,expected",
+    [
+        ({"repository": "redis", "tag": 6}, "redis:6"),
+        ({"registry": "docker.io/", "repository": "bitnami/redis"}, "docker.io/bitnami/redis"),
+        ({"repository": "redis", "tag": "", "digest": "sha256:ab"}, "redis@sha256:ab"),
+        ({"tag": "6.0"}, None),
+        ({"repository": {"name": "x"}}, None),
+    ],
+)
+def test_compose_image(value, expected):
+    assert compose_image(value) == expected
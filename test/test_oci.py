@@ -0,0 +1,129 @@
+#!/usr/bin/python3
+
+import io
+import json
+import os
+import re
+import sys
+import tarfile
+
+import pytest
+
+base_path = re.search("^(.*)/test/", os.path.abspath(__file__))
+sys.path.append(os.path.join(base_path.group(1), "src"))
+
+import helm_image_mirror
+from fake_registry import FakeRegistry
+from helm_image_mirror import (
+    HELM_CHART_MEDIA_TYPE,
+    HELM_PROV_MEDIA_TYPE,
+    Chart,
+    Repo,
+    configure_repos,
+    get_repo_objs,
+    push_chart,
+    push_oci_chart,
+    reconcile_charts,
+)
+
+
+@pytest.fixture(autouse=True)
+def reset_caches(monkeypatch):
+    monkeypatch.setattr(helm_image_mirror, "_known_blobs", {})
+    monkeypatch.setattr(helm_image_mirror, "_registry_clients", {})
+
+
+def make_chart(tmp_path, name="redis", version="1.0.0", prov=False):
+    archive = tmp_path / "{}-{}.tgz".format(name, version)
+    chart_yaml = "apiVersion: v2\nname: {}\nversion: {}\n".format(name, version)
+    with tarfile.open(archive, "w:gz") as tar:
+        info = tarfile.TarInfo("{}/Chart.yaml".format(name))
+        info.size = len(chart_yaml)
+        tar.addfile(info, io.BytesIO(chart_yaml.encode()))
+    if prov:
+        (tmp_path / "{}-{}.tgz.prov".format(name, version)).write_text("signature")
+    return Chart("stable", name, version, str(tmp_path), True)
+
+
+def test_oci_repo_type():
+    repos = [{"name": "oci", "remote": "oci://ghcr.io/org/charts"}]
+    assert get_repo_objs(repos, None, None) == [
+        Repo("oci", "oci://ghcr.io/org/charts", None, None, "oci")
+    ]
+
+
+def test_push_archive_mounts_shared_blobs(tmp_path):
+    chart = make_chart(tmp_path, prov=True)
+    with FakeRegistry() as registry:
+        team_a = Repo("a", "oci://{}/team-a".format(registry.host), None, None, "oci")
+        team_b = Repo("b", "oci://{}/team-b".format(registry.host), None, None, "oci")
+        assert push_oci_chart(chart, team_a)
+        # config, chart and provenance
+        assert len(registry.blob_uploads()) == 3
+        assert push_chart(chart, team_b) == ("Pushed", None)
+        # nothing is uploaded twice, blobs are mounted from team-a
+        assert len(registry.blob_uploads()) == 3
+        mounts = [r for r in registry.requests if "mount=" in r[1]]
+        assert len(mounts) == 3
+        assert push_chart(chart, team_b) == ("Already published", None)
+
+        media_type, body = registry.manifests[("team-b/redis", "1.0.0")]
+        manifest = json.loads(body)
+        assert [layer["mediaType"] for layer in manifest["layers"]] == [
+            HELM_CHART_MEDIA_TYPE, HELM_PROV_MEDIA_TYPE
+        ]
+        config = registry.blobs[("team-b/redis", manifest["config"]["digest"])]
+        assert json.loads(config)["name"] == "redis"
+
+
+def test_copy_between_registries(tmp_path):
+    chart = make_chart(tmp_path, version="1.0.0+build")
+    with FakeRegistry() as source, FakeRegistry() as target:
+        source_repo = Repo("src", "oci://{}/charts".format(source.host), None, None, "oci")
+        target_repo = Repo("dst", "oci://{}".format(target.host), None, None, "oci")
+        assert push_oci_chart(chart, source_repo)
+
+        copied = Chart("src", "redis", "1.0.0+build", str(tmp_path / "unused"), True)
+        copied.source_repo = source_repo
+        assert push_chart(copied, target_repo) == ("Pushed", None)
+        assert target.manifests[("redis", "1.0.0_build")] == \
+            source.manifests[("charts/redis", "1.0.0_build")]
+        assert push_chart(copied, target_repo) == ("Already published", None)
+        assert len(target.blob_uploads()) == 2
+
+
+def test_login_to_private_oci_sources(monkeypatch):
+    commands = []
+    monkeypatch.setattr(
+        helm_image_mirror, "helm",
+        lambda command, input=None, **kwargs: commands.append((command, input)),
+    )
+    repos = [
+        Repo("private", "oci://ghcr.io/org/charts", "bot", "s3cret", "oci"),
+        Repo("public", "oci://ghcr.io/other", None, None, "oci"),
+    ]
+    status, err = configure_repos(repos)
+    assert not err
+    # the password is not part of the command line
+    assert commands == [
+        ("registry login ghcr.io --username bot --password-stdin", b"s3cret")
+    ]
+
+
+def test_registry_to_registry_copy_is_not_pulled(tmp_path, monkeypatch):
+    chart = make_chart(tmp_path)
+    with FakeRegistry() as source, FakeRegistry() as target:
+        source_repo = Repo("src", "oci://{}/charts".format(source.host), None, None, "oci")
+        target_repo = Repo("dst", "oci://{}".format(target.host), None, None, "oci")
+        assert push_oci_chart(chart, source_repo)
+
+        def pull(self):
+            raise AssertionError("chart archive is not needed")
+
+        monkeypatch.setattr(Chart, "pull", pull)
+        copied = Chart("src", "redis", "1.0.0", str(tmp_path / "unused"), True, push=["dst"])
+        copied.source_repo = source_repo
+        status, err = reconcile_charts([copied], [source_repo, target_repo])
+        assert not err
+        assert status["src/redis-1.0.0"]["Pushed"] == ["dst"]
+        assert "pull" not in status["src/redis-1.0.0"]
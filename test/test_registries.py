@@ -1,7 +1,9 @@
 #!/usr/bin/python3
 
+import json
 import os
 import re
+import subprocess
 import sys
 import pytest
 
@@ -10,7 +12,20 @@ import yaml
 base_path = re.search("^(.*)/test/", os.path.abspath(__file__))
 sys.path.append(os.path.join(base_path.group(1), "src"))
 
-from helm_image_mirror import Registry, get_registries
+from fake_registry import FakeRegistry
+import helm_image_mirror
+from helm_image_mirror import (
+    Registry,
+    docker_credentials,
+    find_present_images,
+    get_image_layers,
+    get_registries,
+    mirror_images,
+    parse_image_reference,
+    plan_push_order,
+    push_images_to_registries,
+    reused_layer_bytes,
+)
 
 
 config = """
@@ -45,4 +60,226 @@ def test_get_registries(g_push, g_retain):
         Registry("gcr.io", g_push, True),
         Registry("ecr.aws", g_push, g_retain),
     ]
-    assert charts == expected
\ No newline at end of file
+    assert charts == expected
+
+
+@pytest.mark.parametrize(
+    "image,expected",
+    [
+        ("redis", ("docker.io", "library/redis", "latest")),
+        ("redis:6.0", ("docker.io", "library/redis", "6.0")),
+        ("bitnami/redis:6.0", ("docker.io", "bitnami/redis", "6.0")),
+        ("docker.io/redis:6.0", ("docker.io", "library/redis", "6.0")),
+        ("quay.io/coreos/etcd:v3", ("quay.io", "coreos/etcd", "v3")),
+        ("localhost:5000/etcd", ("localhost:5000", "etcd", "latest")),
+        ("gcr.io/a/b@sha256:abc", ("gcr.io", "a/b", "sha256:abc")),
+    ],
+)
+def test_parse_image_reference(image, expected):
+    assert parse_image_reference(image) == expected
+
+
+@pytest.mark.parametrize(
+    "registry,image,expected",
+    [
+        ("hub.docker.com", "quay.io/coreos/etcd:v3", "etcd:v3"),
+        ("gcr.io/mirror", "quay.io/coreos/etcd:v3", "gcr.io/mirror/etcd:v3"),
+        ("gcr.io", "redis", "gcr.io/redis"),
+    ],
+)
+def test_target_name(registry, image, expected):
+    assert Registry(registry, True, False).target_name(image) == expected
+
+
+def test_find_present_images():
+    with FakeRegistry() as source, FakeRegistry() as target:
+        source.add_manifest("src/redis", "6.0", {"layers": ["r"]})
+        source.add_manifest("src/etcd", "v3", {"layers": ["e"]})
+        source.add_manifest("src/nginx", "1.19", {"layers": ["n"]})
+        target.add_manifest("redis", "6.0", {"layers": ["r"]})
+        # same tag but different content must not be treated as present
+        target.add_manifest("etcd", "v3", {"layers": ["old"]})
+        images = {
+            "{}/src/redis:6.0".format(source.host),
+            "{}/src/etcd:v3".format(source.host),
+            "{}/src/nginx:1.19".format(source.host),
+        }
+        registries = [
+            Registry(target.host, True, False),
+            Registry("unreachable.invalid", False, False),
+        ]
+        present = find_present_images(images, registries)
+        assert present == {
+            target.host: {"{}/src/redis:6.0".format(source.host)},
+            "unreachable.invalid": set(),
+        }
+        assert ("HEAD", "/v2/redis/manifests/6.0") in target.requests
+
+
+@pytest.mark.parametrize(
+    "layers, expected_waves, expected_reused",
+    [
+        ({}, [], 0),
+        ({"a": {"x": 1}, "b": {"y": 1}}, [["a", "b"]], 0),
+        # the base layer is uploaded once before the images reusing it
+        (
+            {"a": {"base": 100, "a": 5}, "b": {"base": 100, "b": 50},
+             "c": {"base": 100, "c": 1}},
+            [["a"], ["b", "c"]],
+            200,
+        ),
+        # images sharing different layers with each other
+        (
+            {"a": {"l1": 10, "l2": 10}, "b": {"l1": 10, "l3": 10},
+             "c": {"l3": 10}, "d": {"l4": 1}},
+            [["b", "d"], ["a", "c"]],
+            20,
+        ),
+    ],
+)
+def test_plan_push_order(layers, expected_waves, expected_reused):
+    waves = plan_push_order(layers)
+    assert waves == expected_waves
+    assert reused_layer_bytes(waves, layers, set(layers)) == expected_reused
+    uploaded = set()
+    for wave in waves:
+        wave_layers = [set(layers[image]) - uploaded for image in wave]
+        # no layer is uploaded by two images of the same wave
+        assert sum(map(len, wave_layers)) == len(set().union(*wave_layers))
+        uploaded.update(*wave_layers)
+
+
+def test_get_image_layers(monkeypatch):
+    images = {
+        "redis:6.0": (["sha256:base", "sha256:redis"], "10\n0\n100\n"),
+        "nginx:1.19": (["sha256:base"], "0\n100\n"),
+        # a layer without size can not be matched to the history
+        "etcd:v3": (["sha256:base", "sha256:empty"], "0\n100\n"),
+    }
+    commands = []
+
+    def docker(command, *args, **kwargs):
+        commands.append(command)
+        image = command.split()[-1]
+        if image not in images:
+            raise subprocess.CalledProcessError(1, command)
+        layers, history = images[image]
+        return json.dumps(layers) if command.startswith("image") else history
+
+    monkeypatch.setattr(helm_image_mirror, "docker", docker)
+    layers = get_image_layers(["redis:6.0", "nginx:1.19", "etcd:v3", "missing:1"], workers=2)
+    assert layers == {
+        "redis:6.0": {"sha256:base": 100, "sha256:redis": 10},
+        "nginx:1.19": {"sha256:base": 100},
+        "etcd:v3": {"sha256:base": 0, "sha256:empty": 0},
+        "missing:1": {},
+    }
+    assert plan_push_order(
+        {image: layers[image] for image in ("redis:6.0", "nginx:1.19", "missing:1")}
+    ) == [["nginx:1.19", "missing:1"], ["redis:6.0"]]
+    # layers are read from the docker daemon rather than the registry
+    assert all(c.startswith(("image inspect", "history")) for c in commands)
+
+
+def test_tag_and_push_waves(monkeypatch):
+    pushed = []
+
+    def docker(command, *args, **kwargs):
+        if command.startswith("push"):
+            pushed.append(command.split()[1])
+        return ""
+
+    monkeypatch.setattr(helm_image_mirror, "docker", docker)
+    registry = Registry("mirror.io", True, True)
+    succeeded, tf, pf, cf = registry.tag_and_push(
+        {"a:1", "b:1", "c:1"}, [["b:1"], ["a:1", "c:1"]], workers=2
+    )
+    assert pushed[0] == "mirror.io/b:1"
+    assert sorted(pushed[1:]) == ["mirror.io/a:1", "mirror.io/c:1"]
+    assert succeeded == {"mirror.io/a:1", "mirror.io/b:1", "mirror.io/c:1"}
+    assert not (tf or pf or cf)
+
+
+def test_push_reports_reused_layers(monkeypatch):
+    failing = set()
+
+    def docker(command, *args, **kwargs):
+        if command.startswith("push") and command.split()[1] in failing:
+            raise subprocess.CalledProcessError(1, command)
+        return ""
+
+    monkeypatch.setattr(helm_image_mirror, "docker", docker)
+    layers = {"a:1": {"base": 100, "a": 5}, "b:1": {"base": 100}, "c:1": {"c": 1}}
+    registry = Registry("mirror.io", True, True)
+    key = "Uncompressed bytes saved by layer reuse"
+    status, _ = push_images_to_registries(set(layers), [registry], layers=layers, workers=2)
+    assert status["mirror.io"][key] == 100
+    # pushes run one at a time reuse layers in any order
+    status, _ = push_images_to_registries(set(layers), [registry], layers=layers)
+    assert key not in status["mirror.io"]
+    # layers of failed pushes were not uploaded for later waves
+    failing.add("mirror.io/a:1")
+    status, _ = push_images_to_registries(set(layers), [registry], layers=layers, workers=2)
+    assert key not in status["mirror.io"]
+
+
+def test_mirror_images_reports_present_images(monkeypatch):
+    present = {"gcr.io": {"redis:6.0", "etcd:v3"}, "quay.io": {"redis:6.0"}}
+    monkeypatch.setattr(
+        helm_image_mirror, "find_present_images",
+        lambda images, registries, targets=None: present,
+    )
+    pulled = []
+    monkeypatch.setattr(
+        helm_image_mirror, "pull_images",
+        lambda images, workers=1, use_store=False: pulled.extend(images) or set(),
+    )
+    monkeypatch.setattr(helm_image_mirror, "get_image_layers", lambda images, workers=1: {})
+    monkeypatch.setattr(
+        Registry, "tag_and_push",
+        lambda self, images, waves=None, workers=1: (
+            [self.target_name(image) for image in images], [], [], []
+        ),
+    )
+    images = {"redis:6.0", "etcd:v3"}
+    registries = [Registry("gcr.io", True, False), Registry("quay.io", True, False)]
+    status, err = mirror_images({"gcr.io": images, "quay.io": images}, registries)
+    assert not err
+    # redis is present everywhere and is not pulled
+    assert pulled == ["etcd:v3"]
+    assert status["Already present"] == ["redis:6.0"]
+    assert sorted(status["gcr.io"]["Already present"]) == ["etcd:v3", "redis:6.0"]
+    assert status["quay.io"]["Already present"] == ["redis:6.0"]
+    assert status["quay.io"]["Pushed"] == ["quay.io/etcd:v3"]
+
+
+def test_docker_credentials_from_helpers(tmp_path, monkeypatch):
+    helper = tmp_path / "bin" / "docker-credential-fake"
+    helper.parent.mkdir()
+    # the helper reads the server from stdin like the real ones
+    helper.write_text(
+        "#!/bin/sh\n"
+        "read server\n"
+        'echo "$1 $server" >> {}\n'
+        'case "$server" in\n'
+        '  ghcr.io) echo \'{{"ServerURL": "ghcr.io", "Username": "bot", "Secret": "s3cret"}}\' ;;\n'
+        '  https://index.docker.io/v1/) echo \'{{"Username": "hub", "Secret": "token"}}\' ;;\n'
+        '  *) echo "credentials not found in native keychain"; exit 1 ;;\n'
+        "esac\n".format(tmp_path / "calls")
+    )
+    helper.chmod(0o755)
+    monkeypatch.setenv("PATH", "{}:{}".format(helper.parent, os.environ["PATH"]))
+    config = tmp_path / "config.json"
+    monkeypatch.setattr(helm_image_mirror, "DOCKER_CONFIG_PATH", str(config))
+    config.write_text(json.dumps({
+        "auths": {"quay.io": {"auth": "dXNlcjpwYXNz"}, "ghcr.io": {}},
+        "credHelpers": {"ghcr.io": "fake", "gcr.io": "missing"},
+        "credsStore": "fake",
+    }))
+    assert docker_credentials("ghcr.io") == ("bot", "s3cret")
+    assert docker_credentials("quay.io") == ("user", "pass")
+    # credsStore is used for registries without their own helper or auth
+    assert docker_credentials("docker.io") == ("hub", "token")
+    assert docker_credentials("gcr.io") == (None, None)
+    assert docker_credentials("example.com") == (None, None)
+    assert (tmp_path / "calls").read_text().split("\n")[0] == "get ghcr.io"
@@ -0,0 +1,86 @@
+#!/usr/bin/python3
+
+import os
+import re
+import sys
+
+base_path = re.search("^(.*)/test/", os.path.abspath(__file__))
+sys.path.append(os.path.join(base_path.group(1), "src"))
+
+from helm_image_mirror import Chart, ScriptCache, reconcile_charts, run_scripts
+from test_execute import exits
+
+
+def make_script(path, body):
+    path.write_text("#!/bin/sh\n" + body + "\n")
+    path.chmod(0o755)
+    return str(path)
+
+
+def test_run_scripts_cache(tmp_path):
+    log = tmp_path / "log"
+    script = make_script(tmp_path / "hook.sh", 'echo "$@" >> {}'.format(log))
+    cache = ScriptCache(str(tmp_path / "cache.json"))
+    failures, durations = run_scripts([script], ["a"], cache=cache)
+    assert failures == {}
+    assert list(durations) == [script]
+    cache.save()
+
+    cache = ScriptCache(str(tmp_path / "cache.json"))
+    run_scripts([script], ["a"], cache=cache)
+    run_scripts([script], ["b"], cache=cache)
+    assert log.read_text().split() == ["a", "b"]
+
+    # modified scripts are run again
+    make_script(tmp_path / "hook.sh", 'echo "changed $@" >> {}'.format(log))
+    run_scripts([script], ["a"], cache=cache)
+    assert log.read_text().split() == ["a", "b", "changed", "a"]
+
+
+def test_run_scripts_failures_are_not_cached(tmp_path):
+    log = tmp_path / "log"
+    script = make_script(tmp_path / "fail.sh", "echo x >> {}; exit 1".format(log))
+    cache = ScriptCache(str(tmp_path / "cache.json"))
+    for _ in range(2):
+        failures, _ = run_scripts([script], cache=cache)
+        assert script in failures
+    assert log.read_text().split() == ["x", "x"]
+
+
+def test_run_scripts_timeout(tmp_path):
+    script = make_script(tmp_path / "slow.sh", "sleep 5")
+    failures, durations = run_scripts([script], timeout=0.2)
+    assert "timed out" in failures[script]
+    assert durations[script] < 5
+
+
+def test_run_scripts_timeout_kills_children(tmp_path):
+    pid_file = tmp_path / "pid"
+    script = make_script(
+        tmp_path / "slow.sh", "sleep 60 & echo $! > {}; wait".format(pid_file)
+    )
+    failures, _ = run_scripts([script], timeout=0.5)
+    assert "timed out" in failures[script]
+    assert exits(int(pid_file.read_text()))
+
+
+def test_run_scripts_default_args(tmp_path):
+    log = tmp_path / "log"
+    with_args = make_script(tmp_path / "a.sh", 'echo "$@" >> {}'.format(log))
+    without_args = make_script(tmp_path / "b.sh", 'echo "$@" >> {}'.format(log))
+    run_scripts([with_args + " custom", without_args], ["default"])
+    assert log.read_text().split() == ["custom", "default"]
+
+
+def test_reconcile_charts_reports_script_durations(tmp_path):
+    script = make_script(tmp_path / "hook.sh", "exit 0")
+    charts = [
+        Chart("stable", "redis", str(i), str(tmp_path), True, scripts=[script])
+        for i in range(4)
+    ]
+    status, err = reconcile_charts(charts, [], workers=2)
+    assert not err
+    assert set(status) == {"stable/redis-{}".format(i) for i in range(4)}
+    for stat in status.values():
+        assert stat["Failed scripts"] == {}
+        assert list(stat["Script durations"]) == [script]
@@ -0,0 +1,110 @@
+#!/usr/bin/python3
+
+import argparse
+import os
+import re
+import sys
+import pytest
+
+base_path = re.search("^(.*)/test/", os.path.abspath(__file__))
+sys.path.append(os.path.join(base_path.group(1), "src"))
+
+from helm_image_mirror import canonical_image, in_shard, merge_reports, parse_shard
+
+
+@pytest.mark.parametrize("value,expected", [("1/1", (1, 1)), ("2/4", (2, 4))])
+def test_parse_shard(value, expected):
+    assert parse_shard(value) == expected
+
+
+@pytest.mark.parametrize("value", ["0/4", "5/4", "1", "a/b", "1/2/3"])
+def test_parse_shard_invalid(value):
+    with pytest.raises(argparse.ArgumentTypeError):
+        parse_shard(value)
+
+
+def test_shards_are_disjoint_and_complete():
+    keys = ["docker.io/library/redis:{}".format(i) for i in range(200)]
+    count = 4
+    shards = [
+        {key for key in keys if in_shard(key, (index, count))}
+        for index in range(1, count + 1)
+    ]
+    assert sum(len(shard) for shard in shards) == len(keys)
+    assert set().union(*shards) == set(keys)
+    assert all(shards)
+
+
+def test_equivalent_images_share_shard():
+    assert canonical_image("redis") == canonical_image("docker.io/library/redis:latest")
+    assert canonical_image("gcr.io/a/b@sha256:abc") == "gcr.io/a/b@sha256:abc"
+
+
+def test_merge_reports():
+    shard1 = {
+        "Image Status": {
+            "All images": ["redis:6.0"],
+            "Failed to pull": [],
+            "gcr.io": {"Pushed": ["gcr.io/redis:6.0"], "Failed to push": []},
+        },
+        "Helm repository Status": {},
+        "Chart Status": {"stable/redis-1.0.0": {"pull": "Pulled succesfully"}},
+    }
+    shard2 = {
+        "Image Status": {
+            "All images": ["etcd:v3"],
+            "Failed to pull": ["etcd:v3"],
+            "gcr.io": {"Pushed": [], "Failed to push": []},
+        },
+        "Helm repository Status": {},
+        "Chart Status": {"stable/etcd-2.0.0": {"pull": "Pulled succesfully"}},
+    }
+    assert merge_reports([shard1, shard2]) == {
+        "Image Status": {
+            "All images": ["redis:6.0", "etcd:v3"],
+            "Failed to pull": ["etcd:v3"],
+            "gcr.io": {"Pushed": ["gcr.io/redis:6.0"], "Failed to push": []},
+        },
+        "Helm repository Status": {},
+        "Chart Status": {
+            "stable/redis-1.0.0": {"pull": "Pulled succesfully"},
+            "stable/etcd-2.0.0": {"pull": "Pulled succesfully"},
+        },
+    }
+
+
+def test_merge_reports_adds_up_counters():
+    shard1 = {
+        "Image Status": {
+            "Hedged pulls": 1,
+            "gcr.io": {
+                "Pushed": ["gcr.io/redis:6.0"], "Uncompressed bytes saved by layer reuse": 100,
+            },
+        },
+        "Blob Cache Status": {
+            "Hits": 3, "Misses": 1, "Bytes": 300, "Evicted": 0, "Hit ratio": 0.75,
+        },
+    }
+    shard2 = {
+        "Image Status": {
+            "Hedged pulls": 2,
+            "gcr.io": {
+                "Pushed": ["gcr.io/etcd:v3"], "Uncompressed bytes saved by layer reuse": 50,
+            },
+        },
+        "Blob Cache Status": {
+            "Hits": 0, "Misses": 4, "Bytes": 200, "Evicted": 2, "Hit ratio": 0,
+        },
+    }
+    assert merge_reports([shard1, shard2]) == {
+        "Image Status": {
+            "Hedged pulls": 3,
+            "gcr.io": {
+                "Pushed": ["gcr.io/redis:6.0", "gcr.io/etcd:v3"],
+                "Uncompressed bytes saved by layer reuse": 150,
+            },
+        },
+        "Blob Cache Status": {
+            "Hits": 3, "Misses": 5, "Bytes": 500, "Evicted": 2, "Hit ratio": 0.375,
+        },
+    }
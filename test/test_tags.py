@@ -0,0 +1,120 @@
+#!/usr/bin/python3
+
+import os
+import re
+import sys
+
+import pytest
+
+base_path = re.search("^(.*)/test/", os.path.abspath(__file__))
+sys.path.append(os.path.join(base_path.group(1), "src"))
+
+import helm_image_mirror
+from fake_registry import FakeRegistry
+from helm_image_mirror import (
+    ImageSelector,
+    Registry,
+    TagCache,
+    get_image_selectors,
+    get_tag_cache,
+    select_images,
+)
+
+
+@pytest.fixture(autouse=True)
+def reset_caches(monkeypatch):
+    monkeypatch.setattr(helm_image_mirror, "_registry_clients", {})
+    monkeypatch.setattr(helm_image_mirror, "TAG_CACHE", None)
+
+
+def add_tags(registry, repository, tags):
+    for tag in tags:
+        registry.add_manifest(repository, tag, {"tag": tag})
+
+
+def tag_requests(registry):
+    return [r for r in registry.requests if "/tags/list" in r[1]]
+
+
+def test_list_tags_follows_pagination():
+    with FakeRegistry() as registry:
+        add_tags(registry, "tool", ["v1.0", "v1.1", "v1.2", "v2.0", "v2.1"])
+        client = helm_image_mirror.get_registry_client(registry.host)
+        tags, etag = client.list_tags("tool", page_size=2)
+        assert tags == ["v1.0", "v1.1", "v1.2", "v2.0", "v2.1"]
+        # changes may not show on the first page of a paginated list
+        assert etag is None
+        assert len(tag_requests(registry)) == 3
+
+        tags, etag = client.list_tags("tool")
+        assert len(tags) == 5 and etag
+        assert client.list_tags("tool", etag=etag) == (None, etag)
+        assert client.list_tags("missing") == ([], None)
+
+
+def test_tag_cache(tmp_path):
+    path = str(tmp_path / "cache" / "tags.json")
+    with FakeRegistry() as registry:
+        add_tags(registry, "tool", ["v1.0", "v1.1"])
+        cache = TagCache(path, max_age=60)
+        assert cache.tags(registry.host, "tool") == {"v1.0", "v1.1"}
+        assert cache.tags(registry.host, "tool") == {"v1.0", "v1.1"}
+        cache.add("{}/tool:v1.2".format(registry.host))
+        cache.save()
+        assert cache.summary() == {"Hits": 1, "Revalidated": 0, "Fetched": 1}
+        assert len(tag_requests(registry)) == 1
+
+        # a later run uses the saved list including the pushed tag
+        cache = TagCache(path, max_age=60)
+        assert cache.tags(registry.host, "tool") == {"v1.0", "v1.1", "v1.2"}
+        assert len(tag_requests(registry)) == 1
+
+        # expired lists are revalidated, the pushed tag is dropped
+        cache = TagCache(path, max_age=0)
+        assert cache.tags(registry.host, "tool") == {"v1.0", "v1.1"}
+        add_tags(registry, "tool", ["v1.3"])
+        assert cache.tags(registry.host, "tool") == {"v1.0", "v1.1", "v1.3"}
+        assert cache.summary() == {"Hits": 0, "Revalidated": 0, "Fetched": 2}
+        assert cache.tags(registry.host, "tool") == {"v1.0", "v1.1", "v1.3"}
+        assert cache.summary()["Revalidated"] == 1
+
+
+def test_select_images_diffs_tags():
+    with FakeRegistry() as source, FakeRegistry() as target:
+        add_tags(source, "org/tool", ["v1.0", "v1.1", "v2.0"])
+        add_tags(target, "tool", ["v1.0"])
+        repository = "{}/org/tool".format(source.host)
+        registries = [Registry(target.host, True, False), Registry("local", False, False)]
+        missing, status, err = select_images(
+            [ImageSelector(repository, ["v1.*"])], registries
+        )
+        assert not err
+        assert missing == {target.host: {repository + ":v1.1"}, "local": set()}
+        assert status == {repository: {"Matched": ["v1.0", "v1.1"], target.host: ["v1.1"]}}
+        # no manifests are requested to find the missing tags
+        assert all("/tags/list" in r[1] for r in source.requests + target.requests)
+
+        missing, status, err = select_images(
+            [ImageSelector("{}/org/unknown".format(source.host), ["*"])], registries
+        )
+        assert missing[target.host] == set()
+
+
+def test_get_image_selectors():
+    selectors = get_image_selectors([
+        {"repository": "ghcr.io/org/tool", "tags": ["v1.*", 2]},
+        {"repository": "ghcr.io/org/tool:v1"},
+        {"repository": "ghcr.io/org/tool", "tags": "v1.*"},
+        {"tags": ["*"]},
+    ])
+    assert len(selectors) == 1
+    assert selectors[0].patterns == ["v1.*", "2"]
+    assert selectors[0].matches("v1.4") and not selectors[0].matches("v10")
+
+
+def test_get_tag_cache(tmp_path):
+    assert get_tag_cache(None) is None
+    assert get_tag_cache({"max_age": 60}) is None
+    assert get_tag_cache({"path": str(tmp_path / "tags.json"), "max_age": -1}) is None
+    cache = get_tag_cache({"path": str(tmp_path / "tags.json")})
+    assert cache.max_age == helm_image_mirror.DEFAULT_TAG_CACHE_MAX_AGE
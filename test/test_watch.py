@@ -0,0 +1,288 @@
+#!/usr/bin/python3
+
+import http.client
+import os
+import re
+import subprocess
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import yaml
+
+base_path = re.search("^(.*)/test/", os.path.abspath(__file__))
+sys.path.append(os.path.join(base_path.group(1), "src"))
+
+import helm_image_mirror
+from helm_image_mirror import (
+    Repo, Watcher, expand_version_patterns, matching_versions,
+    refresh_repo_index, serve_metrics,
+)
+
+
+INDEX = {
+    "apiVersion": "v1",
+    "entries": {
+        "redis": [
+            {"name": "redis", "version": "3.1.0"},
+            {"name": "redis", "version": "3.0.0"},
+            {"name": "redis", "version": "2.9.0"},
+        ],
+    },
+}
+
+
+class FakeIndexServer:
+    """Serves a helm repository index honouring If-None-Match"""
+
+    def __init__(self, index):
+        self.index = index
+        self.etag = '"1"'
+        self.requests = []
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                fake.requests.append(self.headers.get("If-None-Match"))
+                if self.headers.get("If-None-Match") == fake.etag:
+                    self.send_response(304)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                body = yaml.safe_dump(fake.index).encode()
+                self.send_response(200)
+                self.send_header("ETag", fake.etag)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}".format(self.server.server_address[1])
+
+    def publish(self, version):
+        self.index["entries"]["redis"].insert(0, {"name": "redis", "version": version})
+        self.etag = '"{}"'.format(int(self.etag.strip('"')) + 1)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def index_server():
+    server = FakeIndexServer(yaml.safe_load(yaml.safe_dump(INDEX)))
+    helm_image_mirror._repo_indexes.clear()
+    helm_image_mirror._repo_index_validators.clear()
+    yield server
+    server.close()
+    helm_image_mirror._repo_indexes.clear()
+    helm_image_mirror._repo_index_validators.clear()
+
+
+@pytest.mark.parametrize(
+    "pattern, expected",
+    [
+        ("3.*", ["3.1.0", "3.0.0"]),
+        ("*", ["3.1.0", "3.0.0", "2.9.0"]),
+        ("3.0.?", ["3.0.0"]),
+        ("4.*", []),
+    ],
+)
+def test_matching_versions(pattern, expected):
+    assert matching_versions(INDEX, "redis", pattern) == expected
+    assert matching_versions(INDEX, "mysql", pattern) == []
+
+
+def test_refresh_repo_index_conditional(index_server):
+    repo = Repo("stable", index_server.url, None, None)
+    index, changed = refresh_repo_index(repo)
+    assert changed
+    assert len(index["entries"]["redis"]) == 3
+    index, changed = refresh_repo_index(repo)
+    assert not changed
+    assert len(index["entries"]["redis"]) == 3
+    index_server.publish("3.2.0")
+    index, changed = refresh_repo_index(repo)
+    assert changed
+    assert index["entries"]["redis"][0]["version"] == "3.2.0"
+    assert index_server.requests == [None, '"1"', '"1"']
+
+
+def test_expand_version_patterns(index_server):
+    repos = [Repo("stable", index_server.url, None, None)]
+    charts = [
+        {"name": "redis", "repo": "stable", "version_pattern": "3.*",
+         "versions": [{"version": "3.0.0"}]},
+        {"name": "redis", "repo": "stable"},
+    ]
+    expanded, changed = expand_version_patterns(charts, repos)
+    assert changed
+    assert expanded == [
+        {"name": "redis", "repo": "stable", "version_pattern": "3.*",
+         "versions": [{"version": "3.1.0", "local_dir": "/tmp/stable/redis/3.1.0"}]},
+    ]
+    expanded, changed = expand_version_patterns(
+        charts, repos, seen={"stable/redis-3.1.0"}
+    )
+    assert not changed
+    assert expanded == []
+
+
+def test_watcher_mirrors_new_versions_once(index_server, monkeypatch):
+    mirrored = []
+
+    def mirror(config, charts, repos, shard=None):
+        mirrored.append([chart.combined_name for chart in charts])
+        return {}, False
+
+    monkeypatch.setattr(helm_image_mirror, "mirror", mirror)
+    monkeypatch.setattr(helm_image_mirror, "helm", lambda *args, **kwargs: (0, ""))
+    config = {"charts": [{"name": "redis", "repo": "stable", "version_pattern": "3.*"}]}
+    watcher = Watcher(config, [Repo("stable", index_server.url, None, None)], 60)
+    watcher.poll()
+    watcher.poll()
+    index_server.publish("3.2.0")
+    watcher.poll()
+    assert mirrored == [
+        ["stable/redis-3.1.0", "stable/redis-3.0.0"],
+        ["stable/redis-3.2.0"],
+    ]
+    assert watcher.polls == 3
+    assert watcher.backlog == 0
+
+
+def test_metrics_endpoint():
+    watcher = Watcher({}, [], 60)
+    server = serve_metrics(watcher, 0)
+    conn = http.client.HTTPConnection("127.0.0.1", server.server_address[1])
+    try:
+        conn.request("GET", "/healthz")
+        resp = conn.getresponse()
+        assert resp.read() == b"ok\n"
+        assert resp.status == 200
+        conn.request("GET", "/metrics")
+        resp = conn.getresponse()
+        body = resp.read().decode()
+        assert resp.status == 200
+        assert "helm_image_mirror_polls_total 0" in body
+        assert "helm_image_mirror_backlog 0" in body
+        watcher.last_poll = 0
+        conn.request("GET", "/healthz")
+        resp = conn.getresponse()
+        resp.read()
+        assert resp.status == 503
+    finally:
+        conn.close()
+        server.shutdown()
+        server.server_close()
+
+
+def test_watcher_retries_only_failed_versions(index_server, monkeypatch):
+    rendered = []
+    broken = {"stable/redis-3.0.0"}
+
+    def fetch(self):
+        rendered.append(self.combined_name)
+        if self.combined_name in broken:
+            raise subprocess.CalledProcessError(1, "helm fetch")
+
+    monkeypatch.setattr(helm_image_mirror.Chart, "fetch", fetch)
+    monkeypatch.setattr(helm_image_mirror.Chart, "images", lambda self, workers=1: set())
+    monkeypatch.setattr(
+        helm_image_mirror, "mirror_images",
+        lambda targets, registries, *args, **kwargs: ({"All images": []}, False),
+    )
+    monkeypatch.setattr(helm_image_mirror, "helm", lambda *args, **kwargs: b"")
+    config = {
+        "charts": [{"name": "redis", "repo": "stable", "version_pattern": "3.*"}],
+        "registries": [{"name": "gcr.io"}],
+    }
+    watcher = Watcher(config, [Repo("stable", index_server.url, None, None)], 60)
+    report = watcher.poll()
+    assert "render" in report["Chart Status"]["stable/redis-3.0.0"]
+    # the version that succeeded is not mirrored again
+    assert watcher.seen == {"stable/redis-3.1.0"}
+    assert watcher.retries["stable/redis-3.0.0"][0] == 1
+    assert watcher.failed_polls == 1
+
+    # the failed version waits for its backoff
+    rendered.clear()
+    watcher.poll()
+    assert rendered == []
+    watcher.retries["stable/redis-3.0.0"] = (1, 0)
+    watcher.poll()
+    assert rendered == ["stable/redis-3.0.0"]
+    assert watcher.retries["stable/redis-3.0.0"][0] == 2
+
+    broken.clear()
+    watcher.retries["stable/redis-3.0.0"] = (2, 0)
+    watcher.poll()
+    assert watcher.seen == {"stable/redis-3.0.0", "stable/redis-3.1.0"}
+    assert watcher.retries == {}
+
+
+def test_failed_images_and_chart_failed():
+    registry = helm_image_mirror.Registry("gcr.io", True, False)
+    status = {
+        "All images": ["redis:6.0", "etcd:v3", "nginx:1.19", "busybox:1"],
+        "Failed to pull": ["busybox:1"],
+        "gcr.io": {
+            "Failed to tag": [("nginx:1.19", "gcr.io/nginx:1.19")],
+            "Failed to push": ["gcr.io/etcd:v3"],
+        },
+    }
+    assert helm_image_mirror.failed_images(status, [registry]) == {
+        "busybox:1", "nginx:1.19", "etcd:v3"
+    }
+    chart_failed = helm_image_mirror.chart_failed
+    assert not chart_failed({"pull": "Pulled succesfully", "Pushed": ["a"],
+                             "Failed to push": {}, "Failed scripts": []})
+    assert chart_failed({"pull": "Unable to pull chart."})
+    assert chart_failed({"Failed images": ["etcd:v3"]})
+
+
+def test_watcher_refreshes_target_indexes(index_server, monkeypatch):
+    target = FakeIndexServer({"apiVersion": "v1", "entries": {}})
+    published = []
+
+    def mirror(config, charts, repos, shard=None):
+        published.append(helm_image_mirror.published_digest(repos[1], "redis", "3.1.0"))
+        # the chart is pushed, its images fail
+        target.index["entries"]["redis"] = [
+            {"name": "redis", "version": "3.1.0", "digest": "sha256:1"}
+        ]
+        target.etag = '"2"'
+        return {"Chart Status": {"stable/redis-3.1.0": {"Failed images": ["redis:6"]}}}, True
+
+    monkeypatch.setattr(helm_image_mirror, "mirror", mirror)
+    monkeypatch.setattr(helm_image_mirror, "helm", lambda *args, **kwargs: b"")
+    config = {"charts": [{"name": "redis", "repo": "stable", "version_pattern": "3.1.*",
+                          "push": ["target"]}]}
+    repos = [Repo("stable", index_server.url, None, None),
+             Repo("target", target.url, None, None)]
+    try:
+        watcher = Watcher(config, repos, 60)
+        watcher.poll()
+        watcher.retries["stable/redis-3.1.0"] = (1, 0)
+        watcher.poll()
+        # the retry sees the chart pushed by the first attempt
+        assert published == [None, "sha256:1"]
+    finally:
+        target.close()
+
+
+def test_index_fetch_failures_are_not_cached(index_server):
+    repo = Repo("stable", index_server.url, None, None)
+    index_server.close()
+    assert refresh_repo_index(repo) == ({}, False)
+    assert "stable" not in helm_image_mirror._repo_indexes